@@ -125,14 +125,8 @@ class ParticleFilter:
         if not self.time % self.resample_window:
             offset = (np.arange(self.number_of_particles) + np.random.uniform()) / self.number_of_particles
             cumsum = np.cumsum(self.weights)
-            i, j = 0, 0
-            indexes = np.zeros(self.number_of_particles, 'i')
-            while i < self.number_of_particles and j < self.number_of_particles:
-                if offset[i] < cumsum[j]:  # reject
-                    indexes[i] = j
-                    i += 1
-                else:
-                    j += 1
+            indexes = np.searchsorted(cumsum, offset, side='right')
+            indexes = np.minimum(indexes, self.number_of_particles - 1)  # round-off in cumsum
             self.states = self.states[indexes]
             #print(self.states)
             self.weights = self.weights[indexes]
@@ -3,8 +3,13 @@ Particle Filter - external data version
     modified by: patricia-ternes
     created: 19/06/2020
 '''
-#import sys
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..', 'stationsim'))
+from trajectory_store import open_frames
 from filter import Filter
+from resampling import systematic
 from stationsim_density_model import Model
 import numpy as np
 import matplotlib.pyplot as plt
@@ -69,6 +74,7 @@ class ParticleFilter(Filter):
         self.get_state_estimate()
         if self.do_external_data:
             self.set_initial_conditions()
+            self.external_frames = open_frames(self.external_info[0])
         self.dimensions = len(self.base_model.get_state(sensor='location'))
         self.states = np.zeros((self.number_of_particles, self.dimensions))
         self.weights = np.ones(self.number_of_particles)
@@ -334,54 +340,27 @@ class ParticleFilter(Filter):
          in one frame, and store in the 
          base_model variable.
         '''
-
-        file_name = self.external_info[0] + 'frame_' + str(time+1)+ '.0.dat'
         try:
-            agentID, x, y = np.loadtxt(file_name,unpack=True)
-            j = 0
-            for agent in self.base_model.agents:
-                if (agent.unique_id in agentID):
-                    agent.status = 1
-                    agent.location = (x[j], y[j])
-                    j += 1
-                elif (agent.status == 1):
-                    agent.status = 2
-                    agent.location = (None, None)
-        
-        except TypeError:
-            '''
-            This error occurs when only one agent is active. In
-            this case, the data is read as a float instead of an
-            array.
-            '''
-            for agent in self.base_model.agents:
-                if (agent.unique_id == agentID):
-                    agent.status = 1
-                    agent.location = (x, y)
-                elif (agent.status == 1):
-                    agent.status = 2
-                    agent.location = (None, None)
-        
-        except ValueError:
-            '''
-             This error occurs when there is no active agent in
-             the frame.
-             - Deactivate all active agents.
+            agentID, x, y = self.external_frames.get_frame(time+1)
+        except KeyError:
             '''
-            for agent in self.base_model.agents:
-                if (agent.status == 1):
-                    agent.status = 2
-                    agent.location = (None, None)
-
-        except OSError:
-            '''
-            This error occurs when there is no external file to
-            read. It should only occur at the end of the simulation.
+            There is no such frame in the external data. It should
+            only occur at the end of the simulation.
             - Deactivate all agent.
             '''
             for agent in self.base_model.agents:
                 agent.status = 2
                 agent.location = (None, None)
+            return
+
+        locations = dict(zip(agentID.tolist(), zip(x, y)))
+        for agent in self.base_model.agents:
+            if agent.unique_id in locations:
+                agent.status = 1
+                agent.location = locations[agent.unique_id]
+            elif (agent.status == 1):
+                agent.status = 2
+                agent.location = (None, None)
 
     def predict(self, numiter=1):
         '''
@@ -463,16 +442,7 @@ class ParticleFilter(Filter):
         update agent locations in particle models using
         multiprocessing methods.
         '''
-        offset_partition = ((np.arange(self.number_of_particles)
-                             + np.random.uniform()) / self.number_of_particles)
-        cumsum = np.cumsum(self.weights)
-        i, j = 0, 0
-        while i < self.number_of_particles:
-            if offset_partition[i] < cumsum[j]:
-                self.indexes[i] = j
-                i += 1
-            else:
-                j += 1
+        self.indexes[:] = systematic(self.weights)
 
         self.states[:] = self.states[self.indexes]
         self.weights[:] = self.weights[self.indexes]
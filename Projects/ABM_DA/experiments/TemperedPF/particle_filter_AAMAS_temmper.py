@@ -10,8 +10,14 @@ Particle Filter - external data version
     modified by: Vijay Kumar
     created: 19/06/2020
 '''
-#import sys
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..', 'stationsim'))
+from trajectory_store import open_frames
 from filter import Filter
+from resampling import systematic, effective_sample_size
+from likelihood import normalise_log_weights
 from stationsim_density_model_temper import Model
 import numpy as np
 import matplotlib.pyplot as plt
@@ -58,6 +64,14 @@ class ParticleFilter(Filter):
                                     or internally (False). The third element is a boolean to determine 
                                     whether it is to determine the gate_out using external data (True) 
                                     or internally (False).
+         - tempering:               'adaptive' (default) to choose the tempering ladder of each window
+                                    from the weights (see temper()), or 'fixed' for the fixed ladder
+                                    of 5 tempers (each followed by a Monte Carlo step)
+         - target_ess:              For adaptive tempering, the fraction of the number of particles
+                                    that the effective sample size of each temper should keep
+                                    (default 0.5)
+         - max_tempers:             For adaptive tempering, the largest number of tempers in a window
+                                    (default 5); the last one always reaches the full likelihood
         DESCRIPTION
         Firstly, set all attributes using filter parameters. Set time and
         initialise base model using model parameters. Initialise particle
@@ -76,6 +90,7 @@ class ParticleFilter(Filter):
         self.get_state_estimate()
         if self.do_external_data:
             self.set_initial_conditions()
+            self.external_frames = open_frames(self.external_info[0])
         self.dimensions = len(self.base_model.get_state(sensor='location'))
         self.states = np.zeros((self.number_of_particles, self.dimensions))
         self.weights = np.ones(self.number_of_particles)
@@ -94,6 +109,23 @@ class ParticleFilter(Filter):
         if not self.do_resample:
             print("**Warning**: Not resampling. This should only be used for benchmarking")
 
+        try:
+            self.tempering
+        except AttributeError:
+            self.tempering = 'adaptive'
+        if self.tempering not in ('adaptive', 'fixed'):
+            raise ValueError(f"Unknown tempering '{self.tempering}', choose 'adaptive' or 'fixed'")
+        try:
+            self.target_ess
+        except AttributeError:
+            self.target_ess = 0.5
+        try:
+            self.max_tempers
+        except AttributeError:
+            self.max_tempers = 5
+        self.temperatures = [] # The tempering ladder of each window (adaptive tempering only)
+        self.mc_steps = 0 # The number of Monte Carlo steps taken (extra propagations of every particle)
+
         ## We get problems when there are more processes than particles (larger particle variance for some reason)
         #if numcores > self.number_of_particles:
         #    numcores = self.number_of_particles
@@ -294,12 +326,15 @@ class ParticleFilter(Filter):
 
 
                         if self.do_resample: # Can turn off resampling for benchmarking                            
-                            dfactors=list(range(1,6))
-                            dfactors.reverse()
-                            for i in dfactors:
-                                self.reweight(dfactor=i)
-                                self.resample()
-                                self.predict_mc(numiter=1)
+                            if self.tempering == 'adaptive':
+                                self.temper()
+                            else:
+                                dfactors=list(range(1,6))
+                                dfactors.reverse()
+                                for i in dfactors:
+                                    self.reweight(dfactor=i)
+                                    self.resample()
+                                    self.predict_mc(numiter=1)
                             weightdf=pd.DataFrame(list(self.weights))
                             self.weight_hist = pd.concat([self.weight_hist,weightdf],axis=1)
 
@@ -374,54 +409,28 @@ class ParticleFilter(Filter):
          in one frame, and store in the 
          base_model variable.
         '''
-
-        file_name = self.external_info[0] + 'frame_' + str(time+1)+ '.0.dat'
         try:
-            agentID, x, y = np.loadtxt(file_name,unpack=True)
-            j = 0
-            for agent in self.base_model.agents:
-                if (agent.unique_id in agentID):
-                    agent.status = 1
-                    agent.location = (x[j], y[j])
-                    j += 1
-                elif (agent.status == 1):
-                    agent.status = 2
-#                    agent.location = (None, None)
-        
-        except TypeError:
+            agentID, x, y = self.external_frames.get_frame(time+1)
+        except KeyError:
             '''
-            This error occurs when only one agent is active. In
-            this case, the data is read as a float instead of an
-            array.
-            '''
-            for agent in self.base_model.agents:
-                if (agent.unique_id == agentID):
-                    agent.status = 1
-                    agent.location = (x, y)
-                elif (agent.status == 1):
-                    agent.status = 2
-#                    agent.location = (None, None)
-        
-        except ValueError:
-            '''
-             This error occurs when there is no active agent in
-             the frame.
-             - Deactivate all active agents.
-            '''
-            for agent in self.base_model.agents:
-                if (agent.status == 1):
-                    agent.status = 2
-                    agent.location = (None, None)
-
-        except OSError:
-            '''
-            This error occurs when there is no external file to
-            read. It should only occur at the end of the simulation.
+            There is no such frame in the external data. It should
+            only occur at the end of the simulation.
             - Deactivate all agent.
             '''
             for agent in self.base_model.agents:
                 agent.status = 2
                 agent.location = (None, None)
+            return
+
+        locations = dict(zip(agentID.tolist(), zip(x, y)))
+        for agent in self.base_model.agents:
+            if agent.unique_id in locations:
+                agent.status = 1
+                agent.location = locations[agent.unique_id]
+            elif (agent.status == 1):
+                agent.status = 2
+                if not locations:
+                    agent.location = (None, None)
 
     def predict(self, numiter=1):
         '''
@@ -482,7 +491,7 @@ class ParticleFilter(Filter):
         Predict
 
         DESCRIPTION
-        Take a Monte Carlo step for tempering Use a multiprocessing method to step
+        Take a Monte Carlo step for tempering. Use a multiprocessing method to step
         particle models, set the particle states as the agent
         locations, and reassign the
         locations of the particle agents using the new particle
@@ -493,18 +502,11 @@ class ParticleFilter(Filter):
         '''
 
 
-#        stepped_particles = self.pool.starmap(ParticleFilter.step_monte_carlo, list(zip( \
-#            range(self.number_of_particles),  # Particle numbers (in integer)
-#            [m for m in self.models]  # Associated Models (a Model object)# Number of iterations to step each particle (an integer)
-              # Particle std (for adding noise) (a float)
-              # Shape (for adding noise) (a tuple)
-#        )))
-        stepped_particles = list(itertools.starmap(ParticleFilter.step_monte_carlo, list(zip( \
+        stepped_particles = self.pool.starmap(ParticleFilter.step_monte_carlo, list(zip( \
             range(self.number_of_particles),  # Particle numbers (in integer)
             [m for m in self.models]  # Associated Models (a Model object)
-            #[self.particle_std] * self.number_of_particles,  # Particle std (for adding noise) (a float)
-            #[s.shape for s in self.states],  # Shape (for adding noise) (a tuple)
-        ))))
+        )))
+        self.mc_steps += 1
 
         self.models = [stepped_particles[i][0] for i in range(len(stepped_particles))]
         self.states = np.array([stepped_particles[i][1] for i in range(len(stepped_particles))])
@@ -512,6 +514,78 @@ class ParticleFilter(Filter):
         return
     
 
+    def temper(self):
+        '''
+        Temper
+
+        DESCRIPTION
+        Move the particles from the prior (temperature 0) to the full
+        likelihood of one measured state (temperature 1) in stages. Each
+        stage raises the temperature by the largest increment (found by
+        bisection) that keeps the effective sample size of the incremental
+        weights at target_ess * number_of_particles, resamples, and then takes
+        a Monte Carlo step in parallel to restore the particle diversity. It
+        stops as soon as the full likelihood is reached, without a Monte Carlo
+        step, so a window whose weights do not degenerate costs no extra model
+        propagations.
+        '''
+        measured_state = self.measure_state()
+        temperature = 0.0
+        ladder = []
+        while temperature < 1:
+            log_likelihood = self.log_likelihood(measured_state)
+            if len(ladder) == self.max_tempers - 1:
+                increment = 1 - temperature
+            else:
+                increment = self.next_increment(log_likelihood, 1 - temperature)
+            temperature = 1.0 if increment == 1 - temperature else temperature + increment
+            ladder.append(temperature)
+
+            self.weights = normalise_log_weights(increment * log_likelihood)
+            self.resample()
+            if temperature < 1:
+                self.predict_mc(numiter=1)
+        self.temperatures.append(ladder)
+
+    def next_increment(self, log_likelihood, max_increment):
+        '''
+        The largest temperature increment (up to max_increment) for which the
+        effective sample size of the incremental weights is at least
+        target_ess * number_of_particles, by bisection.
+        '''
+        target = self.target_ess * self.number_of_particles
+        def ess(increment):
+            return effective_sample_size(normalise_log_weights(increment * log_likelihood))
+
+        if ess(max_increment) >= target:
+            return max_increment
+        low, high = 0.0, max_increment
+        for _ in range(50):
+            middle = (low + high) / 2
+            if ess(middle) >= target:
+                low = middle
+            else:
+                high = middle
+        return low
+
+    def measure_state(self):
+        '''
+        Add noise to the base model state to get a measured state, or
+        use external data to get a measured state.
+        '''
+        if self.do_external_data: 
+            return self.base_model.get_state(sensor='location')
+        return (self.base_model.get_state(sensor='location')
+                + np.random.normal(0, self.model_std ** 2, size=self.states.shape))
+
+    def log_likelihood(self, measured_state):
+        '''
+        The log of the (unnormalised) weights of reweight(), i.e. of
+        1/distance**2, for each particle.
+        '''
+        distance = np.linalg.norm(self.states - measured_state, axis=1)
+        return -2 * np.log(distance + 1e-9)
+
     def reweight(self,dfactor=1):
         '''
         Reweight
@@ -523,11 +597,7 @@ class ParticleFilter(Filter):
         state and then calculate the new particle weights as 1/distance.
         Add a small term to avoid dividing by 0. Normalise the weights.
         '''
-        if self.do_external_data: 
-            measured_state = self.base_model.get_state(sensor='location')
-        else:        
-            measured_state = (self.base_model.get_state(sensor='location')
-                              + np.random.normal(0, self.model_std ** 2, size=self.states.shape))
+        measured_state = self.measure_state()
 
         distance = np.linalg.norm(self.states - measured_state, axis=1)
         self.weights = 1 / (distance + 1e-9) ** 2
@@ -550,16 +620,7 @@ class ParticleFilter(Filter):
         update agent locations in particle models using
         multiprocessing methods.
         '''
-        offset_partition = ((np.arange(self.number_of_particles)
-                             + np.random.uniform()) / self.number_of_particles)
-        cumsum = np.cumsum(self.weights)
-        i, j = 0, 0
-        while i < self.number_of_particles:
-            if offset_partition[i] < cumsum[j]:
-                self.indexes[i] = j
-                i += 1
-            else:
-                j += 1
+        self.indexes[:] = systematic(self.weights)
 
         self.states[:] = self.states[self.indexes]
         self.weights[:] = self.weights[self.indexes]
@@ -245,7 +245,7 @@ class Agent:
 
         
         #for set distance of 2.5m (35 pixels)
-        rand_dir= np.array((float(np.random.uniform(-1,1,1)),float(np.random.uniform(-1,1,1))))
+        rand_dir= np.array((float(np.random.uniform(-1,1)),float(np.random.uniform(-1,1))))
         f=rand_dir[0]/rand_dir[1]
         z=35/((f**2)+1)**0.5
         dist_vect=np.array([np.random.choice([1,-1])*z,np.random.choice([-1,1])*(z*np.abs(f))])
@@ -24,7 +24,11 @@ from stationsim_gcs_model import Model
 from ensemble_kalman_filter import EnsembleKalmanFilter
 from ensemble_kalman_filter import EnsembleKalmanFilterType
 from ensemble_kalman_filter import AgentIncluder
+from observation import SelectionOperator
 
+# Step the ensemble members in persistent worker processes, one per core
+# (see forecast.py)
+FORECAST_BACKEND = 'process'
 
 # Classes
 class Modeller():
@@ -75,7 +79,8 @@ class Modeller():
                          'R_vector': obs_noise_std * np.ones(data_vec_length),
                          'keep_results': True,
                          'run_vanilla': False,
-                         'vis': False}
+                         'vis': False,
+                         'forecast_backend': FORECAST_BACKEND}
 
         # Run enkf and process results
         enkf = cls.run_enkf(model_params, filter_params)
@@ -122,6 +127,7 @@ class Modeller():
             enkf.step()
             i += 1
 
+        enkf.close()
         return enkf
 
     @classmethod
@@ -157,7 +163,8 @@ class Modeller():
                          'H': observation_operator,
                          'R_vector': OBS_NOISE_STD * np.ones(vec_length),
                          'keep_results': True,
-                         'vis': False}
+                         'vis': False,
+                         'forecast_backend': FORECAST_BACKEND}
 
         errors = list()
         forecast_errors = list()
@@ -466,18 +473,12 @@ class Modeller():
 
     @classmethod
     def __make_observation_operator(cls, population_size, mode):
-        if mode == EnsembleKalmanFilterType.STATE:
-            return np.identity(2 * population_size)
-        elif mode == EnsembleKalmanFilterType.DUAL_EXIT:
-            return cls.__make_exit_observation_operator(population_size)
-        else:
-            raise ValueError(f'Unexpected filter mode: {mode}')
-
-    @staticmethod
-    def __make_exit_observation_operator(population_size):
-        a = np.identity(2 * population_size)
-        b = np.zeros(shape=(2 * population_size, population_size))
-        return np.hstack((a, b))
+        # The locations are observed, i.e. the first 2 * population_size
+        # entries of the state vector
+        state_vector_length = cls.__make_state_vector_length(population_size,
+                                                             mode)
+        return SelectionOperator(np.arange(2 * population_size),
+                                 state_vector_length)
 
     @staticmethod
     def __make_state_vector_length(population_size, mode):
@@ -571,7 +572,8 @@ class Modeller():
                          'R_vector': obs_noise_std * np.ones(data_vec_length),
                          'keep_results': True,
                          'run_vanilla': True,
-                         'vis': False}
+                         'vis': False,
+                         'forecast_backend': FORECAST_BACKEND}
 
         model_path = f'./results/models/gcs_model_exp_1/p{pop_size}/'
 
@@ -581,6 +583,7 @@ class Modeller():
 
             while enkf.active:
                 enkf.step()
+            enkf.close()
 
             with open(model_path + f'model_{i}.pkl', 'wb') as f:
                 pickle.dump(enkf, f)
@@ -623,7 +626,8 @@ class Modeller():
         filter_params = {'vanilla_ensemble_size': ensemble_size,
                          'state_vector_length': state_vec_length,
                          'mode': mode,
-                         'inclusion': inclusion}
+                         'inclusion': inclusion,
+                         'forecast_backend': FORECAST_BACKEND}
         model_params = {'pop_total': pop_size,
                         'station': 'Grand_Central',
                         'do_print': False}
@@ -632,6 +636,7 @@ class Modeller():
 
         while enkf.active:
             enkf.baseline_step()
+        enkf.close()
 
         with open('./results/models/baseline.pkl', 'wb') as f:
             pickle.dump(enkf, f)
@@ -673,12 +678,14 @@ class Modeller():
                          'R_vector': obs_noise_std * np.ones(data_vec_length),
                          'keep_results': True,
                          'run_vanilla': True,
-                         'vis': False}
+                         'vis': False,
+                         'forecast_backend': FORECAST_BACKEND}
         enkf = EnsembleKalmanFilter(Model, filter_params, model_params,
                                     filtering=True, benchmarking=True)
 
         while enkf.active:
             enkf.step()
+        enkf.close()
 
         metrics = pd.DataFrame(enkf.metrics)
         metrics.to_csv('./test_results.csv', index=False)
@@ -1237,7 +1244,7 @@ class Visualiser():
                          obs_y[enkf.agent_number]])
 
         # Plot ensemble members
-        for i, model in enumerate(enkf.models):
+        for i, model in enumerate(enkf.get_models()):
             state_vector = model.get_state(sensor='location')
             xs, ys = enkf.separate_coords(state_vector)
             if i == 0:
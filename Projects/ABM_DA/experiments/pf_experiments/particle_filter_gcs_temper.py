@@ -7,7 +7,8 @@ Created on Mon Jun 29 13:04:26 2020
 
 #import sys
 from filter import Filter
-from stationsim_gcs_model import Model
+from resampling import systematic
+from stationsim_gcs_model import HistoryRecorder, Model
 import numpy as np
 import matplotlib.pyplot as plt
 from copy import deepcopy
@@ -65,8 +66,12 @@ class ParticleFilter(Filter):
         self.number_of_iterations = model_params['batch_iterations']
         self.base_model = ModelClass(**model_params) # (Model does not need a unique id)
         self.models = list([deepcopy(self.base_model) for _ in range(self.number_of_particles)])
-        # To store the final result
+        # To store the final result (a GCS model records it in its history
+        # even if the models keep none)
         self.estimate_model = ModelClass(**model_params)
+        if isinstance(self.estimate_model, Model) and not self.estimate_model.do_history:
+            self.estimate_model.history = HistoryRecorder(self.estimate_model.pop_total,
+                                                          self.estimate_model.history_dtype)
         if self.do_external_data:
             self.set_initial_conditions()
         self.dimensions = len(self.base_model.get_state(sensor='location'))
@@ -543,16 +548,7 @@ class ParticleFilter(Filter):
         update agent locations in particle models using
         multiprocessing methods.
         '''
-        offset_partition = ((np.arange(self.number_of_particles)
-                             + np.random.uniform()) / self.number_of_particles)
-        cumsum = np.cumsum(self.weights)
-        i, j = 0, 0
-        while i < self.number_of_particles:
-            if offset_partition[i] < cumsum[j]:
-                self.indexes[i] = j
-                i += 1
-            else:
-                j += 1
+        self.indexes[:] = systematic(self.weights)
 
         self.states[:] = self.states[self.indexes]
         self.weights[:] = self.weights[self.indexes]
@@ -592,10 +588,20 @@ class ParticleFilter(Filter):
             mean = np.average(self.states[:, active_states], weights=self.weights, axis=0)
             #variance = np.average((self.states[:, active_states] - mean) ** 2, weights=self.weights, axis=0)
 
+        if isinstance(self.estimate_model, Model):
+            active = np.array([agent.status == 1 for agent in self.base_model.agents])
+            locations = np.full((self.base_model.pop_total, 2), np.nan)
+            if any(active_states):
+                locations[active] = np.reshape(mean, (-1, 2))
+            self.estimate_model.history.record(locations, active)
+            return
+
+        # Models whose agents keep their own history (e.g. the density
+        # model, whose step_mc() the tempering needs)
         i = 0
         for agent in self.base_model.agents:
             unique_id = agent.unique_id
-            if agent.status == 1:                
+            if agent.status == 1:
                 self.estimate_model.agents[unique_id].history_locations.append((mean[i], mean[i+1]))
                 #self.estimate_model.history_locations_err.append((variance[i], variance[i+1]))
                 i += 2
@@ -14,6 +14,8 @@ import sys
 sys.path.append('../../stationsim')
 sys.path.append('../..')
 from stationsim.particle_filter import ParticleFilter
+# The same module (and so the same class) as particle_filter uses
+from filter import FilterPool
 from stationsim.stationsim_model import Model
 
 import os
@@ -105,25 +107,29 @@ if __name__ == '__main__':
     print("Model params: " + str(model_params))
     print("Saving files to: {}".format(outfile))
 
-    for i in range(filter_params['number_of_runs']):
+    # Start the worker processes once, and share them between all the runs
+    with FilterPool(numcores=int(multiprocessing.cpu_count())) as pool:
+        print("Started {} worker processes in {}s".format(pool.numcores, round(pool.startup_time, 2)))
 
-        # Run the particle filter
+        for i in range(filter_params['number_of_runs']):
 
-        start_time = time.time()  # Time how long the whole run take
-        pf = ParticleFilter(Model, model_params, filter_params, numcores = int(multiprocessing.cpu_count()))
-        result = pf.step()
+            # Run the particle filter
 
+            start_time = time.time()  # Time how long the whole run take
+            pf = ParticleFilter(Model, model_params, filter_params, pool=pool)
+            result = pf.step()
 
-        with open(outfile, 'a') as f:
-            if result == None: # If no results then don't write anything
-                warnings.warn("Result from the particle filter is 'none' for some reason. This sometimes happens when there is only 1 agent in the model.")
-            else:
-                # Two sets of errors are created, those before resampling, and those after. Results is a list with two tuples.
-                # First tuple has eerrors before resampling, second has errors afterwards.
-                for before in [0, 1]:
-                    f.write(str(result[before])[1:-1].replace(" ", "") + "," + str(before) + "\n")  # (slice to get rid of the brackets aruond the tuple)
 
-        print("Run: {}, particles: {}, agents: {}, took: {}(s), result: {}".format(i, filter_params['number_of_particles'], model_params['pop_total'], round(time.time() - start_time), result), flush=True)
+            with open(outfile, 'a') as f:
+                if result == None: # If no results then don't write anything
+                    warnings.warn("Result from the particle filter is 'none' for some reason. This sometimes happens when there is only 1 agent in the model.")
+                else:
+                    # Two sets of errors are created, those before resampling, and those after. Results is a list with two tuples.
+                    # First tuple has eerrors before resampling, second has errors afterwards.
+                    for before in [0, 1]:
+                        f.write(str(result[before])[1:-1].replace(" ", "") + "," + str(before) + "\n")  # (slice to get rid of the brackets aruond the tuple)
+
+            print("Run: {}, particles: {}, agents: {}, took: {}(s), result: {}".format(i, filter_params['number_of_particles'], model_params['pop_total'], round(time.time() - start_time), result), flush=True)
 
     print("Finished single run")
 
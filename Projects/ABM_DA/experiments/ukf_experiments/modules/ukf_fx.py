@@ -11,7 +11,9 @@ import sys
 import numpy as np
 
 "used in fx to restore stepped model"
-from copy import deepcopy  
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "..", "..", "stationsim"))
+from filter import Filter
 
 class HiddenPrints:
     
@@ -59,7 +61,7 @@ def fx(x, **fx_kwargs):
     #model = pickle.load(f)
     #f.close()
     base_model = fx_kwargs["base_model"]
-    model = deepcopy(base_model)
+    model = Filter.copy_model(base_model)
     if x is not None:
         model.set_state(state = x, sensor="location")    
     with HiddenPrints():
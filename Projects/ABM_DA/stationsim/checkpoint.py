@@ -0,0 +1,187 @@
+"""
+checkpoint.py
+Checkpoints of long filter runs, so that they can be resumed.
+
+A checkpoint is a single uncompressed .npz file (no pickles) holding
+    - arrays:   named arrays, or dicts of named arrays (e.g. the stacked
+                snapshots of the ensemble models, see snapshot_models())
+    - lists:    named lists of numbers or arrays (e.g. per-window errors);
+                the arrays can differ in length
+    - records:  named lists of dicts with the same keys (e.g. the metrics
+                of an EnKF), stored field by field like the lists
+
+    write_checkpoint()      # write a checkpoint (atomically)
+    read_checkpoint()       # read it back
+    rng_state()             # numpy's global random state as arrays
+    set_rng_state()         # and back
+    snapshot_models()       # Model.snapshot() of many models, stacked
+    unstack_snapshots()     # the stacked snapshots, one per model
+    restore_models()        # Model.restore() of many models
+"""
+# Imports
+import os
+import numpy as np
+
+
+# Functions
+def _list_arrays(values):
+    """
+    Encode a list of numbers or equally ranked arrays as the flattened
+    values and the shape of every item.
+    """
+    items = [np.asarray(value) for value in values]
+    if any(item.dtype == object for item in items):
+        raise ValueError('Only numbers and arrays of numbers can be stored.')
+    ndim = items[0].ndim if items else 0
+    if any(item.ndim != ndim for item in items):
+        raise ValueError('The items of a list must have the same rank.')
+    shapes = np.array([item.shape for item in items], dtype=int)
+    shapes = shapes.reshape(len(items), ndim)
+    if items:
+        flat = np.concatenate([item.ravel() for item in items])
+    else:
+        flat = np.zeros(0)
+    return flat, shapes
+
+
+def _array_list(flat, shapes):
+    """
+    Decode a list encoded by _list_arrays().
+    """
+    if shapes.shape[1] == 0:
+        return flat.tolist()
+    values = list()
+    start = 0
+    for shape in shapes:
+        stop = start + int(np.prod(shape))
+        values.append(flat[start:stop].reshape(shape))
+        start = stop
+    return values
+
+
+def write_checkpoint(path, arrays, lists=None, records=None):
+    """
+    Write a checkpoint.
+
+    The file is written next to the path and then moved over it, so an
+    interrupted write does not destroy the previous checkpoint.
+
+    Params:
+        path
+        arrays      # dict of arrays, or of dicts of arrays
+        lists       # dict of lists of numbers or arrays
+        records     # dict of lists of dicts with the same keys
+
+    Returns:
+        None
+    """
+    data = dict()
+    for name, value in arrays.items():
+        if isinstance(value, dict):
+            for key, array in value.items():
+                data[f'array:{name}/{key}'] = np.asarray(array)
+        else:
+            data[f'array:{name}'] = np.asarray(value)
+    for name, values in (lists or dict()).items():
+        data[f'list:{name}:values'], data[f'list:{name}:shapes'] = \
+            _list_arrays(values)
+    for name, rows in (records or dict()).items():
+        data[f'record:{name}:length'] = np.array(len(rows))
+        keys = list(rows[0]) if rows else list()
+        if any(list(row) != keys for row in rows):
+            raise ValueError(f"The records of '{name}' differ in their keys.")
+        for key in keys:
+            data[f'record:{name}:{key}:values'], \
+                data[f'record:{name}:{key}:shapes'] = \
+                _list_arrays([row[key] for row in rows])
+
+    temporary = f'{path}.tmp'
+    with open(temporary, 'wb') as f:
+        np.savez(f, **data)
+    os.replace(temporary, path)
+
+
+def read_checkpoint(path):
+    """
+    Read a checkpoint written by write_checkpoint().
+
+    Returns:
+        arrays, lists, records  # as they were written (numbers in
+                                  lists and records come back as Python
+                                  numbers)
+    """
+    arrays, lists, records = dict(), dict(), dict()
+    with np.load(path, allow_pickle=False) as data:
+        data = {name: data[name] for name in data.files}
+
+    for name, value in data.items():
+        kind, _, name = name.partition(':')
+        if kind == 'array':
+            name, _, key = name.partition('/')
+            if key:
+                arrays.setdefault(name, dict())[key] = value
+            else:
+                arrays[name] = value
+        elif kind == 'list' and name.endswith(':values'):
+            name = name[:-len(':values')]
+            lists[name] = _array_list(value, data[f'list:{name}:shapes'])
+        elif kind == 'record' and name.endswith(':length'):
+            name = name[:-len(':length')]
+            prefix = f'record:{name}:'
+            keys = [key[len(prefix):-len(':values')] for key in data
+                    if key.startswith(prefix) and key.endswith(':values')]
+            fields = {key: _array_list(data[f'{prefix}{key}:values'],
+                                       data[f'{prefix}{key}:shapes'])
+                      for key in keys}
+            records[name] = [{key: fields[key][i] for key in keys}
+                             for i in range(int(value))]
+    return arrays, lists, records
+
+
+def rng_state():
+    """
+    Returns the state of numpy's global random generator as a dict of
+    arrays.
+    """
+    _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {'keys': keys,
+            'pos': np.array(pos),
+            'has_gauss': np.array(has_gauss),
+            'cached_gaussian': np.array(cached_gaussian)}
+
+
+def set_rng_state(state):
+    """
+    Set the state of numpy's global random generator from rng_state().
+    """
+    np.random.set_state(('MT19937', state['keys'], int(state['pos']),
+                         int(state['has_gauss']),
+                         float(state['cached_gaussian'])))
+
+
+def snapshot_models(models):
+    """
+    Returns the snapshots (see Model.snapshot()) of the models, stacked
+    into a dict of arrays with one row per model.
+    """
+    snapshots = [model.snapshot() for model in models]
+    return {name: np.stack([snapshot[name] for snapshot in snapshots])
+            for name in snapshots[0]}
+
+
+def unstack_snapshots(snapshots):
+    """
+    Split the stacked snapshots of snapshot_models() into one snapshot
+    per model.
+    """
+    number_of_models = len(next(iter(snapshots.values())))
+    return [{name: values[i] for name, values in snapshots.items()}
+            for i in range(number_of_models)]
+
+
+def restore_models(models, snapshots):
+    """
+    Restore the models from the stacked snapshots of snapshot_models().
+    """
+    for model, snapshot in zip(models, unstack_snapshots(snapshots)):
+        model.restore(snapshot)
@@ -6,13 +6,19 @@ A class to represent a general Ensemble Kalman Filter for use with StationSim.
 """
 
 # Imports
-from copy import deepcopy as dcopy
+from concurrent.futures import ThreadPoolExecutor
+from checkpoint import (read_checkpoint, rng_state, set_rng_state,
+                        write_checkpoint)
 from enum import Enum, auto
 from filter import Filter
+from forecast import make_forecast, SerialForecast
 from math import atan2, pi
+from observation import make_observation_operator, ObservationOperator
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+from scipy.linalg import cho_factor, cho_solve
+from scipy.spatial import cKDTree
 from sklearn.metrics import accuracy_score
 import statistics
 from typing import List, Tuple
@@ -83,13 +89,22 @@ class EnsembleKalmanFilter(Filter):
 
             # Set up ensemble of models
             self.models = self.__set_up_models()
+            # The backend that steps the ensemble (see forecast.py); with
+            # the 'process' backend the models live in the worker processes
+            self.forecast = make_forecast(self.models, self.forecast_backend,
+                                          self.forecast_workers)
+            if self.forecast_backend == 'process':
+                self.models = None
             # Make sure that models have state
             # for m in self.models:
             # if not hasattr(m, 'state'):
             # raise AttributeError("Model has no 'state' attribute.")
 
-            # We're going to need H.T very often, so just do it once and store
-            self.H_transpose = self.H.T
+            # Observe by indexing rather than by dense products where
+            # possible (see observation.py)
+            self.H = make_observation_operator(self.H,
+                                               self.state_vector_length)
+            self.H_transpose = None
 
             # Make sure that we have a data covariance matrix
             """
@@ -102,6 +117,7 @@ class EnsembleKalmanFilter(Filter):
             """
             if not self.data_covariance:
                 self.data_covariance = np.diag(self.R_vector)
+            self._checked_covariance = None
 
             # Create placeholders for ensembles
             self.__set_up_ensembles()
@@ -146,6 +162,11 @@ class EnsembleKalmanFilter(Filter):
     def __set_up_baseline(self) -> None:
         # Ensemble of vanilla models is always 10 (control variable)
         self.vanilla_models = self.__set_up_models(self.vanilla_ensemble_size)
+        self.vanilla_forecast = make_forecast(self.vanilla_models,
+                                              self.forecast_backend,
+                                              self.forecast_workers)
+        if self.forecast_backend == 'process':
+            self.vanilla_models = None
         # self.vanilla_models = [dcopy(self.base_model) for _ in
         #                        range(self.vanilla_ensemble_size)]
         self.vanilla_state_mean = None
@@ -200,6 +221,14 @@ class EnsembleKalmanFilter(Filter):
             EnsembleKalmanFilterType.DUAL_EXIT: self.make_dual_errors
         }
         self.ensemble_errors = False
+        self.checkpoint_every = None
+        self.checkpoint_path = None
+        self.forecast_backend = 'serial'
+        self.forecast_workers = None
+        self.gain_method = 'ensemble'
+        self.localisation_radius = None
+        self.localisation_tile = None
+        self.analysis_workers = 1
         self.set_up_dict = {
             ExitRandomisation.NONE: self.set_up_models_none,
             ExitRandomisation.BY_AGENT: self.set_up_models_by_agent,
@@ -226,7 +255,7 @@ class EnsembleKalmanFilter(Filter):
         # Set up ensemble of models
         # Deep copy preserves knowledge of agent origins and destinations
         n = self.ensemble_size if n is None else n
-        models = [dcopy(self.base_model) for _ in range(n)]
+        models = [self.copy_model(self.base_model) for _ in range(n)]
 
         try:
             set_up_func = self.set_up_dict[self.exit_randomisation]
@@ -318,19 +347,17 @@ class EnsembleKalmanFilter(Filter):
             self.corner_angles[corner] = angle
 
     def __set_gates_edge_angles(self):
-        n_gates = len(self.base_model.gates_locations)
+        # Gate edges and their angles from the centre of the station are
+        # precomputed by the model's Station geometry
+        station = self.base_model.geometry
 
         self.gate_angles = dict()
         gate_angles = list()
 
-        for gate_number in range(n_gates):
-            gate_loc = self.base_model.gates_locations[gate_number]
-            gate_width = self.base_model.gates_width[gate_number]
-            edge_loc_1, edge_loc_2 = self.__get_gate_edge_locations(gate_loc,
-                                                                    gate_width)
-            edge_1, edge_2 = self.__get_gate_edge_angles(self.model_centre,
-                                                         edge_loc_1,
-                                                         edge_loc_2)
+        for gate_number in range(len(station)):
+            edge_loc_1, edge_loc_2 = [tuple(edge) for edge in
+                                      station.gate_edges[gate_number].tolist()]
+            edge_1, edge_2 = station.gate_edge_angles[gate_number].tolist()
             self.gate_angles[gate_number] = (edge_1, edge_2)
             gate_angles.extend([(edge_1, edge_loc_1),
                                 (edge_2, edge_loc_2)])
@@ -354,30 +381,19 @@ class EnsembleKalmanFilter(Filter):
                              12: 6, 13: 7, 17: 10,
                              18: 0}
 
-    def __get_gate_edge_locations(self, gate_loc, gate_width):
-        wd = gate_width / 2
-
-        if(gate_loc[0] == 0):
-            edge_loc_1 = (0, gate_loc[1] + wd)
-            edge_loc_2 = (0, gate_loc[1] - wd)
-        elif(gate_loc[0] == self.base_model.width):
-            edge_loc_1 = (self.base_model.width, gate_loc[1] + wd)
-            edge_loc_2 = (self.base_model.width, gate_loc[1] - wd)
-        elif(gate_loc[1] == 0):
-            edge_loc_1 = (gate_loc[0] + wd, 0)
-            edge_loc_2 = (gate_loc[0] - wd, 0)
-        elif(gate_loc[1] == self.base_model.height):
-            edge_loc_1 = (gate_loc[0] + wd, self.base_model.height)
-            edge_loc_2 = (gate_loc[0] - wd, self.base_model.height)
-        else:
-            raise ValueError(f'Invalid gate location: {gate_loc}')
-        return edge_loc_1, edge_loc_2
-
-    def __get_gate_edge_angles(self, centre_loc, edge_loc_1, edge_loc_2):
-        edge_angle_1 = self.get_angle(centre_loc, edge_loc_1)
-        edge_angle_2 = self.get_angle(centre_loc, edge_loc_2)
-
-        return edge_angle_1, edge_angle_2
+        # The same as arrays, to map the angles of all the agents at once:
+        # the gate of each insertion index and of each edge index (-1 for
+        # none)
+        self.unique_gate_angle_array = np.array(self.unique_gate_angles)
+        self.unique_gate_edge_array = np.array(self.unique_gate_edges)
+        self.in_gate_lookup = np.full(len(self.unique_gate_angles) + 1, -1)
+        for idx, gate in self.in_gate_idx.items():
+            self.in_gate_lookup[idx] = gate
+        self.out_gate_lookup = np.zeros(len(self.in_gate_lookup), dtype=bool)
+        self.out_gate_lookup[list(self.out_gate_idx)] = True
+        self.edge_gate_lookup = np.full(len(self.unique_gate_angles), -1)
+        for edge, gate in self.edge_to_gate.items():
+            self.edge_gate_lookup[edge] = gate
 
     def make_random_destination(self, gates_in: int,
                                 gates_out: int, gate_in: int) -> int:
@@ -492,6 +508,10 @@ class EnsembleKalmanFilter(Filter):
                                       prior_ensemble)
         self.results.append(result)
 
+        if self.checkpoint_every and \
+                len(self.metrics) % self.checkpoint_every == 0:
+            self.checkpoint(self.checkpoint_path)
+
     def baseline_step(self) -> None:
         # Check if any of the models are active
         self.update_status()
@@ -517,18 +537,61 @@ class EnsembleKalmanFilter(Filter):
         """
         Step the model forward by one time-step to produce a prediction.
 
+        The ensemble members are stepped by the forecast backend (see
+        forecast_backend), while the base model is stepped here.
+
         Params:
 
         Returns:
             None
         """
+        forecasts = self.get_forecasts()
+        for forecast in forecasts:
+            forecast.begin_step()
         self.base_model.step()
+        for forecast in forecasts:
+            forecast.end_step()
+
+    def get_forecasts(self) -> list:
+        """
+        Returns the forecast backends of the ensemble and of the vanilla
+        ensemble, if they are run.
+        """
+        forecasts = list()
+        if self.filtering:
+            forecasts.append(self.forecast)
+        if self.run_vanilla:
+            forecasts.append(self.vanilla_forecast)
+        return forecasts
+
+    def get_models(self) -> list:
+        """
+        Returns the ensemble models (copies of them with the 'process'
+        forecast backend).
+        """
+        return self.forecast.get_models()
+
+    def close(self) -> None:
+        """
+        Stop the forecast backends (e.g. the worker processes). The
+        ensemble members are brought back into this process first, so the
+        filter can still be inspected, pickled or stepped (serially).
+        """
         if self.filtering:
-            for i in range(self.ensemble_size):
-                self.models[i].step()
+            self.models = self.forecast.get_models()
+            self.forecast.close()
+            self.forecast = SerialForecast(self.models)
         if self.run_vanilla:
-            for i in range(self.vanilla_ensemble_size):
-                self.vanilla_models[i].step()
+            self.vanilla_models = self.vanilla_forecast.get_models()
+            self.vanilla_forecast.close()
+            self.vanilla_forecast = SerialForecast(self.vanilla_models)
+        self.forecast_backend = 'serial'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def update(self, data) -> None:
         """
@@ -544,6 +607,13 @@ class EnsembleKalmanFilter(Filter):
         #     w = 'len(data)={0}, expected {1}'.format(len(data),
         #                                              self.data_vector_length)
         #     warns.warn(w, RuntimeWarning)
+        if self.localisation_radius is not None:
+            if data.ndim != 1:
+                raise ValueError('The localised analysis needs a data vector.')
+            self.state_ensemble = self.make_local_analysis(self.state_ensemble,
+                                                           data)
+            return
+
         X = np.zeros(shape=(self.state_vector_length, self.ensemble_size))
 
         if data.ndim == 1:
@@ -560,6 +630,19 @@ class EnsembleKalmanFilter(Filter):
         else:
             n_state = 2
 
+        if self.gain_method == 'ensemble' and not self.standardise_state:
+            # The data covariance of standardised ensembles is an ensemble
+            # covariance, which is singular, so that uses the explicit gain
+            data_covariance = self.get_data_variances()
+            if data_covariance is None:
+                data_covariance = self.data_covariance
+            self.state_ensemble = self.make_analysis(self.state_ensemble,
+                                                     self.data_ensemble,
+                                                     data_covariance, self.H)
+            return
+        elif self.gain_method not in ('ensemble', 'covariance'):
+            raise ValueError(f'Unrecognised gain method: {self.gain_method}')
+
         if self.standardise_state:
             state_ensemble = self.standardise_ensemble(self.state_ensemble,
                                                        n_state)
@@ -579,6 +662,101 @@ class EnsembleKalmanFilter(Filter):
             X = self.unstandardise_ensemble(X, n_state)
         self.state_ensemble = X
 
+    # --- Checkpoints --- #
+    def checkpoint(self, path: str) -> None:
+        """
+        Write the state of the filter to a checkpoint file (see
+        checkpoint.py).
+
+        The checkpoint holds the ensemble, the snapshots of the base and
+        ensemble models (and the baseline models), the base model
+        history, the random state, the time and the metrics and results
+        recorded so far. Written every checkpoint_every assimilation
+        steps if checkpoint_path is set; the filter can be resumed from
+        it with resume().
+
+        Params:
+            path
+
+        Returns:
+            None
+        """
+        arrays = {'counters': np.array([self.time, self.active]),
+                  'rng': rng_state(),
+                  'base_model': self.base_model.snapshot()}
+        if self.base_model.do_history:
+            arrays['base_history'] = self.base_model.history.arrays()
+        if self.filtering:
+            arrays['models'] = self.forecast.snapshots()
+            arrays['state_ensemble'] = self.state_ensemble
+            arrays['state_mean'] = self.state_mean
+        if self.run_vanilla:
+            arrays['vanilla_models'] = self.vanilla_forecast.snapshots()
+            arrays['vanilla_state_ensemble'] = self.vanilla_state_ensemble
+            arrays['vanilla_state_mean'] = self.vanilla_state_mean
+
+        lists = dict()
+        for name in ('exits', 'initial_gates', 'vanilla_results'):
+            if hasattr(self, name):
+                lists[name] = getattr(self, name)
+        records = {'metrics': self.metrics,
+                   'forecast_error': self.forecast_error,
+                   'results': self.results}
+        if self.run_vanilla:
+            records['vanilla_metrics'] = self.vanilla_metrics
+        write_checkpoint(path, arrays, lists, records)
+
+    def load_checkpoint(self, path: str) -> None:
+        """
+        Return the filter to the state saved by checkpoint().
+
+        Params:
+            path
+
+        Returns:
+            None
+        """
+        arrays, lists, records = read_checkpoint(path)
+        self.time = int(arrays['counters'][0])
+        self.active = bool(arrays['counters'][1])
+        set_rng_state(arrays['rng'])
+        self.base_model.restore(arrays['base_model'])
+        if 'base_history' in arrays:
+            self.base_model.history.load(arrays['base_history'])
+        if self.filtering:
+            self.forecast.restore(arrays['models'])
+            self.state_ensemble = arrays['state_ensemble']
+            self.state_mean = arrays['state_mean']
+        if self.run_vanilla:
+            self.vanilla_forecast.restore(arrays['vanilla_models'])
+            self.vanilla_state_ensemble = arrays['vanilla_state_ensemble']
+            self.vanilla_state_mean = arrays['vanilla_state_mean']
+        for name, values in lists.items():
+            setattr(self, name, values)
+        for name, values in records.items():
+            setattr(self, name, values)
+
+    @classmethod
+    def resume(cls, path: str, model, filter_params, model_params,
+               filtering=True, benchmarking=False):
+        """
+        Create a filter with the parameters of an interrupted run and
+        return it to the state saved in a checkpoint, so that stepping
+        it carries on from there.
+
+        Params:
+            path
+            model, filter_params, model_params, filtering, benchmarking
+                (as passed to the interrupted filter)
+
+        Returns:
+            EnsembleKalmanFilter
+        """
+        enkf = cls(model, filter_params, model_params, filtering=filtering,
+                   benchmarking=benchmarking)
+        enkf.load_checkpoint(path)
+        return enkf
+
     # --- Error calculation --- #
     @classmethod
     def get_x_y_diffs(cls, truth: np.ndarray,
@@ -1016,17 +1194,18 @@ class EnsembleKalmanFilter(Filter):
         else:
             raise ValueError(f'Unrecognised mode: {self.mode}')
         if self.filtering:
-            for i in range(self.ensemble_size):
-                state = self.models[i].get_state(sensor=st)
-                processed_state = self.process_state_vector(state)
-                self.state_ensemble[:, i] = processed_state
+            states = np.array(self.forecast.get_states(st)).T
+            self.state_ensemble[:, :] = self.process_state_vector(states)
         if self.run_vanilla:
-            for i in range(self.vanilla_ensemble_size):
-                state = self.vanilla_models[i].get_state(sensor=st)
-                processed_state = self.process_state_vector(state)
-                self.vanilla_state_ensemble[:, i] = processed_state
+            states = np.array(self.vanilla_forecast.get_states(st)).T
+            self.vanilla_state_ensemble[:, :] = \
+                self.process_state_vector(states)
 
     def process_state_vector(self, state):
+        """
+        Convert a state vector from the models, or the (length, m) array of
+        the state vectors of an ensemble, to the state vector of the filter.
+        """
         if self.mode == EnsembleKalmanFilterType.STATE:
             return state
         elif self.mode == EnsembleKalmanFilterType.DUAL_EXIT:
@@ -1034,17 +1213,14 @@ class EnsembleKalmanFilter(Filter):
                 return state
             else:
                 # state is x, y, g, d_x, d_y
-                state = np.array(state)
+                state = np.asarray(state)
                 locations = state[:2 * self.population_size]
                 destinations = state[3 * self.population_size:]
 
-                # Set up empty array to fill with angles
-                angles = np.zeros(self.population_size)
-
-                for i in range(self.population_size):
-                    loc = (destinations[i],
-                           destinations[self.population_size + i])
-                    angles[i] = self.get_angle(self.model_centre, loc)
+                # The angles of the destinations from the centre
+                x = destinations[:self.population_size] - self.model_centre[0]
+                y = destinations[self.population_size:] - self.model_centre[1]
+                angles = np.arctan2(y, x)
 
                 reduced_state = np.concatenate((locations, angles))
                 return reduced_state
@@ -1085,45 +1261,47 @@ class EnsembleKalmanFilter(Filter):
         R - data covariance; this should be either a number or a vector with
         same length as the data.
         """
-        x = np.zeros(shape=(len(data), self.ensemble_size))
-        for i in range(self.ensemble_size):
-            x[:, i] = data + np.random.normal(0, self.R_vector, len(data))
-
-        self.data_ensemble = x
+        # One draw for the whole ensemble, member by member
+        noise = np.random.normal(0, self.R_vector,
+                                 size=(self.ensemble_size, len(data)))
+        self.data_ensemble = np.asarray(data)[:, np.newaxis] + noise.T
 
     def update_models(self) -> None:
         """
         Update individual model states based on state ensemble.
+
+        The new state vectors are built for the whole ensemble at once and
+        passed to the forecast backend in one go.
         """
-        for i in range(self.ensemble_size):
-            state_vector = self.state_ensemble[:, i]
+        state_ensemble = self.state_ensemble
 
-            # Update based on enkf type
-            if self.mode == EnsembleKalmanFilterType.STATE:
-                self.models[i].set_state(state_vector, sensor='location')
-            elif self.mode == EnsembleKalmanFilterType.DUAL_EXIT:
-                if self.gate_estimator == GateEstimator.ROUNDING:
-                    # Update locations
-                    locations = state_vector[:2 * self.population_size]
-
-                    # Update destinations
-                    destinations = state_vector[2 * self.population_size:]
-                    destinations = self.round_destinations(destinations,
-                                                           self.n_exits)
-                    x = np.concatenate((locations, destinations))
-                    self.models[i].set_state(x, sensor='loc_exit')
-                elif self.gate_estimator == GateEstimator.ANGLE:
-                    locations = state_vector[:2 * self.population_size]
-                    angles = state_vector[2 * self.population_size:]
-                    # Make sure that we have exactly the correct number of
-                    # angles
-                    assert len(angles) == self.population_size
-                    gates, gate_locs = self.construct_state_from_angles(angles)
-                    x = np.concatenate((locations, gates, gate_locs))
-                    self.models[i].set_state(x, sensor='enkf_gate_angle')
-                else:
-                    s = f'Gate estimator no recognised: {self.gate_estimator}'
-                    raise ValueError(s)
+        # Update based on enkf type
+        if self.mode == EnsembleKalmanFilterType.STATE:
+            sensor = 'location'
+            states = state_ensemble
+        elif self.mode == EnsembleKalmanFilterType.DUAL_EXIT:
+            locations = state_ensemble[:2 * self.population_size]
+            if self.gate_estimator == GateEstimator.ROUNDING:
+                # Update destinations (as round_destinations())
+                destinations = state_ensemble[2 * self.population_size:]
+                destinations = np.mod(np.round(destinations).astype(int),
+                                      self.n_exits)
+                states = np.concatenate((locations, destinations))
+                sensor = 'loc_exit'
+            elif self.gate_estimator == GateEstimator.ANGLE:
+                angles = state_ensemble[2 * self.population_size:]
+                # Make sure that we have exactly the correct number of
+                # angles
+                assert len(angles) == self.population_size
+                gates, gate_locs = self.construct_state_from_angles(angles)
+                states = np.concatenate((locations, gates, gate_locs))
+                sensor = 'enkf_gate_angle'
+            else:
+                s = f'Gate estimator no recognised: {self.gate_estimator}'
+                raise ValueError(s)
+        else:
+            raise ValueError(f'Unrecognised mode: {self.mode}')
+        self.forecast.set_states(list(states.T), sensor)
 
     def update_status(self) -> None:
         """
@@ -1134,12 +1312,12 @@ class EnsembleKalmanFilter(Filter):
         model in the ensemble.
         """
         if self.filtering:
-            m_statuses = [m.status == 1 for m in self.models]
+            m_statuses = self.forecast.statuses() == 1
         else:
             m_statuses = [False]
 
         if self.run_vanilla:
-            vanilla_m_statuses = [m.status == 1 for m in self.vanilla_models]
+            vanilla_m_statuses = self.vanilla_forecast.statuses() == 1
         else:
             vanilla_m_statuses = [False]
 
@@ -1174,6 +1352,9 @@ class EnsembleKalmanFilter(Filter):
                          H, H_transpose) -> np.ndarray:
         """
         Create kalman gain matrix.
+
+        H is an observation operator (see observation.py), or a matrix
+        with its transpose H_transpose.
         """
         """
         Version from Gillijns, Barrero Mendoza, etc.
@@ -1208,11 +1389,242 @@ class EnsembleKalmanFilter(Filter):
         else:
             raise ValueError(f'Unrecognised inflation: {self.inflation}')
 
-        state_covariance = H @ (C @ H_transpose)
+        if isinstance(H, ObservationOperator):
+            state_covariance = H.project(C)
+            cross_covariance = H.cross(C)
+        else:
+            state_covariance = H @ (C @ H_transpose)
+            cross_covariance = C @ H_transpose
         total = state_covariance + data_covariance
-        K = C @ (H_transpose @ np.linalg.inv(total))
+        K = cross_covariance @ np.linalg.inv(total)
         return K
 
+    def get_data_variances(self):
+        """
+        Returns the variances of the data covariance if it is diagonal
+        (otherwise None). Checked once for each data covariance matrix.
+        """
+        C = self.data_covariance
+        if self._checked_covariance is not C:
+            self._checked_covariance = C
+            diagonal = np.diagonal(C)
+            if np.count_nonzero(C) == np.count_nonzero(diagonal):
+                self._data_variances = diagonal.copy()
+            else:
+                self._data_variances = None
+        return self._data_variances
+
+    def make_analysis(self, state_ensemble: np.ndarray,
+                      data_ensemble: np.ndarray, data_covariance: np.ndarray,
+                      H) -> np.ndarray:
+        """
+        Create the analysis ensemble in ensemble space, without forming the
+        state covariance or the gain matrix.
+
+        With the (inflated) state anomalies A, the anomalies Y of their
+        observations and the innovations D = data_ensemble - H
+        state_ensemble, the update
+        K D = A G^-1 Y^T R^-1 D, where G = (m - 1) I + Y^T R^-1 Y is only
+        m x m for an ensemble of size m. This costs O(n m^2 + m^3) (plus
+        applying H and R^-1), and G is solved by Cholesky factorisation. It
+        gives the same analysis as make_gain_matrix(), and H only has to be
+        applied to the ensemble, so it can be nonlinear.
+
+        Params:
+            state_ensemble
+            data_ensemble
+            data_covariance     # the variances (a vector) if the data
+                                  covariance is diagonal, or the matrix
+            H
+
+        Returns:
+            analysis ensemble
+        """
+        m = state_ensemble.shape[1]
+        anomalies = state_ensemble - np.mean(state_ensemble, axis=1,
+                                             keepdims=True)
+        obs_ensemble = H @ state_ensemble
+        obs_anomalies = obs_ensemble - np.mean(obs_ensemble, axis=1,
+                                               keepdims=True)
+        innovations = data_ensemble - obs_ensemble
+
+        if self.inflation == Inflation.MULTIPLICATIVE:
+            # Same as multiplying the state covariance by the rate
+            anomalies = np.sqrt(self.inflation_rate) * anomalies
+            obs_anomalies = np.sqrt(self.inflation_rate) * obs_anomalies
+        elif self.inflation == Inflation.NONE:
+            pass
+        elif self.inflation == Inflation.ADDITIVE:
+            raise NotImplementedError('Additive inflation not implemented')
+        else:
+            raise ValueError(f'Unrecognised inflation: {self.inflation}')
+
+        # Y^T R^-1
+        if data_covariance.ndim == 1:
+            weighted = obs_anomalies.T / data_covariance
+        else:
+            weighted = cho_solve(cho_factor(data_covariance),
+                                 obs_anomalies).T
+
+        G = (m - 1) * np.eye(m) + weighted @ obs_anomalies
+        weights = cho_solve(cho_factor(G), weighted @ innovations)
+        return state_ensemble + anomalies @ weights
+
+    def make_local_analysis(self, state_ensemble: np.ndarray,
+                            data: np.ndarray) -> np.ndarray:
+        """
+        Create the analysis ensemble with the local ensemble transform
+        Kalman filter (LETKF, Hunt et al. 2007).
+
+        The state of each agent (or of each square tile of the station of
+        side localisation_tile) is updated on its own, using only the
+        observations of the agents within localisation_radius of it. Those
+        are found with a KD-tree over the observed locations, and weighted
+        by their distance with the Gaspari-Cohn taper. Each local analysis
+        transforms the ensemble in ensemble space (an m x m eigenproblem for
+        an ensemble of size m), so the local analyses are independent and
+        are run by a pool of analysis_workers threads.
+
+        Params:
+            state_ensemble
+            data    # the observation vector (x0, y0, x1, y1, ...)
+
+        Returns:
+            analysis ensemble
+        """
+        m = state_ensemble.shape[1]
+        variances = self.get_data_variances()
+        if variances is None:
+            raise ValueError('The localised analysis needs a diagonal data '
+                             'covariance.')
+
+        if self.inflation == Inflation.MULTIPLICATIVE:
+            rate = self.inflation_rate
+        elif self.inflation == Inflation.NONE:
+            rate = 1
+        elif self.inflation == Inflation.ADDITIVE:
+            raise NotImplementedError('Additive inflation not implemented')
+        else:
+            raise ValueError(f'Unrecognised inflation: {self.inflation}')
+
+        state_mean = np.mean(state_ensemble, axis=1)
+        anomalies = state_ensemble - state_mean[:, np.newaxis]
+        obs_ensemble = self.H @ state_ensemble
+        obs_mean = np.mean(obs_ensemble, axis=1)
+        obs_anomalies = obs_ensemble - obs_mean[:, np.newaxis]
+        if self.mode == EnsembleKalmanFilterType.DUAL_EXIT:
+            observations = self.convert_alternating_to_sequential(data)
+        else:
+            observations = data
+        innovations = observations - obs_mean
+
+        # The state rows of each agent, and the two rows of each observed
+        # location in the observation vector
+        state_rows = self.group_rows(self.get_state_agents())
+        agent_locations = self.get_agent_locations(state_mean)
+        obs_locations = np.reshape(data, (-1, 2))
+        obs_rows = np.arange(len(data)).reshape(-1, 2)
+        if self.mode == EnsembleKalmanFilterType.DUAL_EXIT:
+            obs_rows = obs_rows.reshape(2, -1).T
+        tree = cKDTree(obs_locations)
+        analysis = np.empty(state_ensemble.shape)
+
+        def analyse(agents):
+            rows = np.concatenate([state_rows[a] for a in agents])
+            locations = agent_locations[agents]
+            near = np.unique(np.concatenate(
+                [*tree.query_ball_point(locations, self.localisation_radius),
+                 []])).astype(int)
+            distances = np.min(np.linalg.norm(
+                obs_locations[near][:, np.newaxis] - locations, axis=2),
+                axis=1)
+            taper = self.gaspari_cohn(distances, self.localisation_radius)
+            local_obs = np.ravel(obs_rows[near])
+            weights = np.repeat(taper, 2)
+            local_obs, weights = local_obs[weights > 0], weights[weights > 0]
+            if len(local_obs) == 0:
+                analysis[rows] = state_ensemble[rows]
+                return
+
+            Y = obs_anomalies[local_obs]
+            C = Y.T * (weights / variances[local_obs])
+            eigenvalues, eigenvectors = np.linalg.eigh(
+                (m - 1) / rate * np.eye(m) + C @ Y)
+            P = (eigenvectors / eigenvalues) @ eigenvectors.T
+            W = (eigenvectors * np.sqrt((m - 1) / eigenvalues)) @ \
+                eigenvectors.T
+            W += (P @ (C @ innovations[local_obs]))[:, np.newaxis]
+            analysis[rows] = state_mean[rows, np.newaxis] + \
+                anomalies[rows] @ W
+
+        groups = self.get_local_groups(agent_locations)
+        if self.analysis_workers > 1:
+            with ThreadPoolExecutor(self.analysis_workers) as executor:
+                list(executor.map(analyse, groups))
+        else:
+            for agents in groups:
+                analyse(agents)
+        return analysis
+
+    def get_state_agents(self) -> np.ndarray:
+        """
+        Returns the agent of each row of the state vector.
+        """
+        rows = np.arange(self.state_vector_length)
+        if self.mode == EnsembleKalmanFilterType.DUAL_EXIT:
+            # x, ..., y, ..., exit (or angle), ...
+            return rows % self.population_size
+        # x0, y0, x1, y1, ...
+        return rows // 2
+
+    def get_agent_locations(self, state: np.ndarray) -> np.ndarray:
+        """
+        Returns the (agents, 2) locations of the agents in a state vector.
+        """
+        if self.mode == EnsembleKalmanFilterType.DUAL_EXIT:
+            x = state[:self.population_size]
+            y = state[self.population_size:2 * self.population_size]
+        else:
+            x, y = self.separate_coords(state)
+        return np.column_stack((x, y))
+
+    def get_local_groups(self, agent_locations: np.ndarray) -> list:
+        """
+        Returns the groups of agents that are analysed together: each agent
+        on its own, or the agents in each tile of side localisation_tile.
+        """
+        if self.localisation_tile is None:
+            return [np.array([a]) for a in range(len(agent_locations))]
+        tiles = np.floor(agent_locations / self.localisation_tile)
+        _, tile_of_agent = np.unique(tiles, axis=0, return_inverse=True)
+        return self.group_rows(np.ravel(tile_of_agent))
+
+    @staticmethod
+    def group_rows(groups: np.ndarray) -> list:
+        """
+        Returns the indices of the rows in each group (0, 1, ...).
+        """
+        order = np.argsort(groups, kind='stable')
+        bounds = np.searchsorted(groups[order], np.arange(np.max(groups) + 2))
+        return [order[bounds[i]:bounds[i + 1]]
+                for i in range(len(bounds) - 1)]
+
+    @staticmethod
+    def gaspari_cohn(distance, radius) -> np.ndarray:
+        """
+        The Gaspari-Cohn taper, from 1 at distance 0 to 0 at the radius.
+        """
+        z = 2 * np.asarray(distance, dtype=float) / radius
+        taper = np.zeros(z.shape)
+        inner = z <= 1
+        outer = (z > 1) & (z < 2)
+        z1, z2 = z[inner], z[outer]
+        taper[inner] = (-z1 ** 5 / 4 + z1 ** 4 / 2 + 5 * z1 ** 3 / 8 -
+                        5 * z1 ** 2 / 3 + 1)
+        taper[outer] = (z2 ** 5 / 12 - z2 ** 4 / 2 + 5 * z2 ** 3 / 8 +
+                        5 * z2 ** 2 / 3 - 5 * z2 + 4 - 2 / (3 * z2))
+        return taper
+
     @staticmethod
     def separate_coords(arr):
         """
@@ -1473,9 +1885,9 @@ class EnsembleKalmanFilter(Filter):
             en_statuses = [list() for _ in range(self.population_size)]
 
             # Get list of statuses for each agent
-            for model in self.models:
-                for j, agent in enumerate(model.agents):
-                    en_statuses[j].append(agent.status == 1)
+            for model_statuses in self.forecast.agent_statuses():
+                for j, status in enumerate(model_statuses):
+                    en_statuses[j].append(status == 1)
 
             # Assigned status is the modal status across the ensemble of models
             statuses = [statistics.mode(status) for status in en_statuses]
@@ -1524,14 +1936,11 @@ class EnsembleKalmanFilter(Filter):
 
     def set_ensemble_statuses(self,
                               ensemble_statuses: List[List[int]]) -> None:
-        assert len(ensemble_statuses) == len(self.models)
-
-        for i, model in enumerate(self.models):
-            assert len(model.agents) == len(ensemble_statuses[i])
-
-            for j, agent in enumerate(model.agents):
-                agent.status = ensemble_statuses[i][j]
+        assert len(ensemble_statuses) == len(self.forecast)
 
+        # Through the forecast backend, which may hold the models in
+        # worker processes
+        self.forecast.set_agent_statuses(ensemble_statuses)
         return None
 
     def construct_state_from_angles(self, angles) -> Tuple[np.ndarray,
@@ -1542,28 +1951,62 @@ class EnsembleKalmanFilter(Filter):
 
         Take a list of gates - one per agent in the population - and for each
         angle identify the gate number and destination location to which the
-        agent will head. Use this information to construct a state vector.
+        agent will head, as get_destination_angle() does. Use this
+        information to construct a state vector. The angles of a whole
+        ensemble, one column per member, are mapped at once with
+        np.searchsorted over the gate edge angles.
 
         Parameters
         ----------
         angles : iterable
-            List of angles pertaining to the agent population.
+            List of angles pertaining to the agent population, or array of
+            shape (population_size, ensemble_size).
 
         Returns
         -------
         Tuple[np.ndarray,
                                                                    np.ndarray]:
-            Numpy array of gate numbers and numpy array of gate locations.
-        """
-        locations = np.zeros(2 * self.population_size)
-        gates = np.zeros(self.population_size)
-        for i, angle in enumerate(angles):
-            loc, gate = self.get_destination_angle(angle, gate_out=True)
-            gates[i] = gate
-            locations[i] = loc[0]
-            locations[self.population_size + i] = loc[1]
-
-        return gates, locations
+            Numpy array of gate numbers and numpy array of gate locations
+            (x, ..., y, ...), with a column per member for an ensemble.
+        """
+        # Work member by member (rows), so that random locations are drawn
+        # in the same order as by get_destination_angle(); the random
+        # choices between two equally near gate edges are drawn after all
+        # of them, rather than in between
+        angles = np.asarray(angles, dtype=float).T
+        ascending_angles = self.unique_gate_angle_array[::-1]
+        insertion_idx = len(ascending_angles) - np.searchsorted(
+            ascending_angles, angles, side='right')
+
+        in_gate = self.in_gate_lookup[insertion_idx] >= 0
+        out_gate = self.out_gate_lookup[insertion_idx]
+        if not np.all(in_gate | out_gate):
+            idx = insertion_idx[~(in_gate | out_gate)][0]
+            raise ValueError(f'Unrecognised insertion index: {idx}')
+
+        gates = np.zeros(angles.shape)
+        destinations = np.zeros(angles.shape + (2,))
+
+        # Agents heading to an entrance gate head for a random location
+        # along it
+        gates[in_gate] = self.in_gate_lookup[insertion_idx[in_gate]]
+        gates[in_gate] %= self.base_model.gates_out
+        size = self.base_model.agents[0].size
+        destinations[in_gate] = self.base_model.geometry.get_gate_locations(
+            gates[in_gate], size)
+
+        # Others head for the nearest gate edge
+        edge_idx = self.round_target_angles(angles[out_gate],
+                                            insertion_idx[out_gate])
+        edge_gates = self.edge_gate_lookup[edge_idx]
+        if np.any(edge_gates < 0):
+            raise KeyError(edge_idx[edge_gates < 0][0])
+        gates[out_gate] = edge_gates % self.base_model.gates_out
+        destinations[out_gate] = self.unique_gate_edge_array[edge_idx]
+
+        locations = np.concatenate((destinations[..., 0].T,
+                                    destinations[..., 1].T))
+        return gates.T, locations
 
     def get_destination_angle(self, angle: float, gate_out: bool = False):
 
@@ -1616,18 +2059,28 @@ class EnsembleKalmanFilter(Filter):
         int:
             Adjacent index to which it is rounded.
         """
-        adjacent_idx = (insertion_idx - 1, insertion_idx)
-        adjacent_angles = (self.unique_gate_angles[adjacent_idx[0]],
-                           self.unique_gate_angles[adjacent_idx[1]])
-        diff_0 = abs(angle - adjacent_angles[0])
-        diff_1 = abs(angle - adjacent_angles[1])
+        return int(self.round_target_angles([angle], [insertion_idx])[0])
 
-        if diff_0 < diff_1:
-            return adjacent_idx[0]
-        elif diff_1 < diff_0:
-            return adjacent_idx[1]
-        else:
-            return np.random.choice(adjacent_idx)
+    def round_target_angles(self, angles, insertion_idxs) -> np.ndarray:
+        """
+        Apply round_target_angle() to arrays of angles and their insertion
+        indices.
+        """
+        angles = np.asarray(angles, dtype=float)
+        insertion_idxs = np.asarray(insertion_idxs, dtype=int)
+        gate_angles = self.unique_gate_angle_array
+        diff_0 = np.abs(angles - gate_angles[insertion_idxs - 1])
+        diff_1 = np.abs(angles - gate_angles[insertion_idxs])
+
+        edge_idxs = np.where(diff_0 < diff_1, insertion_idxs - 1,
+                             insertion_idxs)
+        # Equally near to both edges: pick one at random
+        ties = diff_0 == diff_1
+        if np.any(ties):
+            n_ties = np.count_nonzero(ties)
+            edge_idxs[ties] = (insertion_idxs[ties] - 1 +
+                               np.random.randint(2, size=n_ties))
+        return edge_idxs
 
     @staticmethod
     def bisect_left_reverse(element, iterable) -> int:
@@ -1751,7 +2204,7 @@ class EnsembleKalmanFilter(Filter):
             plt.scatter(g[0], g[1], c='black', alpha=0.5)
 
         # Plot ensembles
-        for model in self.models:
+        for model in self.get_models():
             for agent in model.agents:
                 plt.scatter(agent.location[0], agent.location[1],
                             c='red', s=0.1)
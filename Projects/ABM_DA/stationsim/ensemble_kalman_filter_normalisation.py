@@ -6,7 +6,6 @@ A class to represent a general Ensemble Kalman Filter for use with StationSim.
 """
 
 # Imports
-from copy import deepcopy as dcopy
 from enum import Enum, auto
 from filter import Filter
 import matplotlib.pyplot as plt
@@ -186,7 +185,7 @@ class EnsembleKalmanFilter(Filter):
         # Set up ensemble of models
         # Deep copy preserves knowledge of agent origins and destinations
         n = self.ensemble_size if n is None else n
-        models = [dcopy(self.base_model) for _ in range(n)]
+        models = [self.copy_model(self.base_model) for _ in range(n)]
 
         if self.mode == EnsembleKalmanFilterType.DUAL_EXIT:
             for model in models:
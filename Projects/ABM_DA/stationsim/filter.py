@@ -5,9 +5,18 @@ date_created: 19/05/30
 A general base class on which to base filters
 """
 # Imports
+from copy import deepcopy
+import multiprocessing
+import os
+import time
 import warnings as warns
 
 
+# Functions
+def _worker_ready(_):
+    return os.getpid()
+
+
 # Classes
 class Filter:
     """
@@ -62,6 +71,24 @@ class Filter:
         b = all(has_methods)
         return b
 
+    @staticmethod
+    def copy_model(model):
+        """
+        Make an independent copy of a model.
+        Uses the model's clone method where it has one (which shares the
+        station geometry with the original), and a deep copy otherwise.
+
+        Params:
+            model
+
+        Returns:
+            model
+        """
+        clone = getattr(model, 'clone', None)
+        if callable(clone):
+            return clone()
+        return deepcopy(model)
+
     @staticmethod
     def has_method(model, method):
         """
@@ -79,3 +106,56 @@ class Filter:
             warns.warn(w, RuntimeWarning)
             b = False
         return b
+
+
+class FilterPool:
+    """
+    A multiprocessing pool that can be shared by several filters, e.g.
+    all the runs and parameter combinations of an experiment, so that
+    the worker processes are only started once:
+
+        with FilterPool(numcores) as pool:
+            for run in range(number_of_runs):
+                pf = ParticleFilter(Model, model_params, filter_params,
+                                    pool=pool)
+                pf.step()
+
+    The time taken to start the workers is kept in startup_time.
+    """
+    def __init__(self, numcores=None):
+        """
+        Start the worker processes.
+
+        Params:
+            numcores    # the number of workers (default: one per core)
+
+        Returns:
+            None
+        """
+        start_time = time.time()
+        if numcores is None:
+            numcores = multiprocessing.cpu_count()
+        self.numcores = numcores
+        self.pool = multiprocessing.Pool(processes=numcores)
+        # Wait for every worker to be up (and to have imported its modules)
+        self.pool.map(_worker_ready, range(numcores), chunksize=1)
+        self.startup_time = time.time() - start_time
+
+    def starmap(self, function, iterable):
+        return self.pool.starmap(function, iterable)
+
+    def map(self, function, iterable):
+        return self.pool.map(function, iterable)
+
+    def close(self):
+        """
+        Stop the worker processes once their tasks are finished.
+        """
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
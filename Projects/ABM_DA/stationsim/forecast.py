@@ -0,0 +1,347 @@
+"""
+forecast.py
+Execution backends for the forecast step of an ensemble filter, i.e.
+stepping every member of the ensemble forward in time.
+
+Every backend holds a list of member models and exchanges only state
+vectors with the filter:
+
+    forecast = make_forecast(models, 'process', numcores)
+    forecast.begin_step()       # start stepping every member
+    ...                         # e.g. step the base model meanwhile
+    forecast.end_step()         # wait for the members
+    states = forecast.get_states('location')
+    forecast.set_states(states, 'location')
+    forecast.close()
+
+    SerialForecast      # steps the members one after another
+    BatchForecast       # steps the members together as a ModelBatch (the
+                          agents of every member in the same arrays)
+    ThreadForecast      # steps the members in a thread pool (shares the
+                          global random generator, so runs can not be
+                          reproduced exactly)
+    ProcessForecast     # persistent worker processes, each owning a fixed
+                          shard of the members for the whole run (seeded
+                          from the filter's random generator)
+    make_forecast()     # any of the above, by name
+"""
+# Imports
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import numpy as np
+from checkpoint import restore_models, snapshot_models
+from stationsim_gcs_model import ModelBatch
+
+
+# Functions
+def _forecast_worker(connection, models, seed):
+    """
+    The loop run by each worker process of a ProcessForecast.
+    """
+    np.random.seed(seed)
+    try:
+        while True:
+            command, args = connection.recv()
+            if command == 'close':
+                break
+            try:
+                reply = _run_command(models, command, args)
+            except Exception as error:
+                reply = error
+            connection.send(reply)
+    finally:
+        connection.close()
+
+
+def _run_command(models, command, args):
+    if command == 'step':
+        for model in models:
+            model.step()
+        return None
+    if command == 'get_states':
+        sensor, = args
+        return [model.get_state(sensor=sensor) for model in models]
+    if command == 'set_states':
+        states, sensor = args
+        for model, state in zip(models, states):
+            model.set_state(state, sensor=sensor)
+        return None
+    if command == 'statuses':
+        return [model.status for model in models]
+    if command == 'agent_statuses':
+        return [[agent.status for agent in model.agents] for model in models]
+    if command == 'set_agent_statuses':
+        statuses, = args
+        for model, model_statuses in zip(models, statuses):
+            if len(model.agents) != len(model_statuses):
+                raise ValueError('Expected one status per agent.')
+            for agent, status in zip(model.agents, model_statuses):
+                agent.status = status
+        return None
+    if command == 'models':
+        return models
+    if command == 'snapshot':
+        return snapshot_models(models)
+    if command == 'restore':
+        snapshots, = args
+        restore_models(models, snapshots)
+        return None
+    raise ValueError(f"Unknown command '{command}'")
+
+
+# Classes
+class SerialForecast:
+    """
+    Step the members one after another in this process.
+    """
+    def __init__(self, models):
+        self.models = models
+
+    def __len__(self):
+        return len(self.models)
+
+    def begin_step(self):
+        pass
+
+    def end_step(self):
+        _run_command(self.models, 'step', None)
+
+    def step(self):
+        self.begin_step()
+        self.end_step()
+
+    def get_states(self, sensor):
+        """
+        Returns the state vector of every member.
+        """
+        return _run_command(self.models, 'get_states', (sensor,))
+
+    def set_states(self, states, sensor):
+        """
+        Set the state vector of every member.
+        """
+        _run_command(self.models, 'set_states', (states, sensor))
+
+    def statuses(self):
+        """
+        Returns the status of every member model.
+        """
+        return np.array(_run_command(self.models, 'statuses', None))
+
+    def agent_statuses(self):
+        """
+        Returns the (members, agents) statuses of the agents.
+        """
+        return np.array(_run_command(self.models, 'agent_statuses', None))
+
+    def set_agent_statuses(self, statuses):
+        """
+        Set the statuses of the agents from a (members, agents) array.
+        """
+        _run_command(self.models, 'set_agent_statuses', (statuses,))
+
+    def get_models(self):
+        """
+        Returns the member models (copies of them for ProcessForecast).
+        """
+        return self.models
+
+    def snapshots(self):
+        """
+        Returns the stacked snapshots of the members (see
+        checkpoint.snapshot_models()).
+        """
+        return snapshot_models(self.models)
+
+    def restore(self, snapshots):
+        restore_models(self.models, snapshots)
+
+    def close(self):
+        pass
+
+
+class BatchForecast(SerialForecast):
+    """
+    Step the members together as a ModelBatch (GCS models only), so the
+    moves and collisions of the agents of every member are computed at
+    once rather than member by member.
+    """
+    def __init__(self, models):
+        self.batch = ModelBatch(models)
+        super().__init__(self.batch.models)
+
+    def end_step(self):
+        self.batch.step()
+
+    def get_states(self, sensor):
+        return list(self.batch.get_state(sensor))
+
+    def set_states(self, states, sensor):
+        self.batch.set_state(states, sensor)
+
+
+class ThreadForecast(SerialForecast):
+    """
+    Step the members in a pool of threads.
+    """
+    def __init__(self, models, numcores=None):
+        super().__init__(models)
+        if numcores is None:
+            numcores = multiprocessing.cpu_count()
+        self.executor = ThreadPoolExecutor(max_workers=numcores)
+        self.futures = list()
+
+    def begin_step(self):
+        self.futures = [self.executor.submit(model.step)
+                        for model in self.models]
+
+    def end_step(self):
+        futures, self.futures = self.futures, list()
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class ProcessForecast:
+    """
+    Step the members in persistent worker processes. Each worker owns a
+    fixed shard of the members for the whole run, so the models are only
+    sent to the workers once; afterwards only commands and state vectors
+    go through the pipes. Each worker is seeded from numpy's global
+    random generator when it is started.
+    """
+    def __init__(self, models, numcores=None):
+        if numcores is None:
+            numcores = multiprocessing.cpu_count()
+        numcores = max(1, min(numcores, len(models)))
+        self.number_of_models = len(models)
+        bounds = np.linspace(0, len(models), numcores + 1).astype(int)
+        self.shards = list(zip(bounds[:-1], bounds[1:]))
+        seeds = np.random.randint(2 ** 32, size=numcores, dtype=np.int64)
+
+        self.connections = list()
+        self.processes = list()
+        for (first, last), seed in zip(self.shards, seeds):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_forecast_worker, daemon=True,
+                args=(worker_connection, models[first:last], seed))
+            process.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    def __len__(self):
+        return self.number_of_models
+
+    def _send(self, command, args=None):
+        for connection in self.connections:
+            connection.send((command, args))
+
+    def _send_shards(self, command, values, *args):
+        for connection, (first, last) in zip(self.connections, self.shards):
+            connection.send((command, (values[first:last], *args)))
+
+    def _gather(self):
+        replies = [connection.recv() for connection in self.connections]
+        for reply in replies:
+            if isinstance(reply, Exception):
+                raise reply
+        return replies
+
+    def _gather_list(self):
+        return [value for reply in self._gather() for value in reply]
+
+    def begin_step(self):
+        self._send('step')
+
+    def end_step(self):
+        self._gather()
+
+    def step(self):
+        self.begin_step()
+        self.end_step()
+
+    def get_states(self, sensor):
+        self._send('get_states', (sensor,))
+        return self._gather_list()
+
+    def set_states(self, states, sensor):
+        self._send_shards('set_states', states, sensor)
+        self._gather()
+
+    def statuses(self):
+        self._send('statuses')
+        return np.array(self._gather_list())
+
+    def agent_statuses(self):
+        self._send('agent_statuses')
+        return np.array(self._gather_list())
+
+    def set_agent_statuses(self, statuses):
+        self._send_shards('set_agent_statuses', statuses)
+        self._gather()
+
+    def get_models(self):
+        self._send('models')
+        return self._gather_list()
+
+    def snapshots(self):
+        self._send('snapshot')
+        snapshots = self._gather()
+        return {name: np.concatenate([shard[name] for shard in snapshots])
+                for name in snapshots[0]}
+
+    def restore(self, snapshots):
+        shards = [{name: values[first:last]
+                   for name, values in snapshots.items()}
+                  for first, last in self.shards]
+        for connection, shard in zip(self.connections, shards):
+            connection.send(('restore', (shard,)))
+        self._gather()
+
+    def close(self):
+        """
+        Stop the worker processes. The members are lost with the workers,
+        so call get_models() first if they are still needed (as the EnKF
+        does before closing its forecasts).
+        """
+        self._send('close')
+        for process in self.processes:
+            process.join()
+        for connection in self.connections:
+            connection.close()
+        self.connections = list()
+        self.processes = list()
+
+
+BACKENDS = {'serial': SerialForecast,
+            'batch': BatchForecast,
+            'thread': ThreadForecast,
+            'process': ProcessForecast}
+
+
+def make_forecast(models, backend='serial', numcores=None):
+    """
+    Create the forecast backend for a list of member models.
+
+    Params:
+        models
+        backend     # 'serial', 'batch', 'thread' or 'process' (see
+                      BACKENDS)
+        numcores    # the number of threads or processes (default: one
+                      per core)
+
+    Returns:
+        forecast backend
+    """
+    try:
+        cls = BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"Unknown forecast backend '{backend}', "
+                         f"choose from {list(BACKENDS)}")
+    if cls in (SerialForecast, BatchForecast):
+        return cls(models)
+    return cls(models, numcores)
@@ -0,0 +1,133 @@
+"""
+likelihood.py
+Observation likelihoods for the particle filters, in log-space.
+
+The particle states and the observation are agent locations, flattened
+as (x0, y0, x1, y1, ...) like Model.get_state(sensor='location'). Only
+the agents in the active mask (e.g. the agents active in the base
+model) contribute. Every likelihood returns one log-weight per particle;
+the terms that are the same for all the particles are left out, since
+they cancel when the weights are normalised.
+
+    gaussian()              # isotropic Gaussian sensor error
+    student_t()             # heavy-tailed error, per agent
+    mahalanobis()           # Gaussian with a variance per agent (and axis)
+    log_likelihood()        # any of the above, by name
+    agent_log_likelihoods() # the terms of one of the above for each agent
+    normalise_log_weights() # log-weights to normalised weights
+"""
+# Imports
+import numpy as np
+
+
+# Functions
+def _residuals(states, observation, active):
+    """
+    The (particles, active agents, 2) displacements of the particles'
+    agents from the observation.
+    """
+    states = np.asarray(states, dtype=float)
+    number_of_particles = states.shape[0]
+    states = states.reshape(number_of_particles, -1, 2)
+    observation = np.asarray(observation, dtype=float).reshape(-1, 2)
+    if active is None:
+        return states - observation
+    active = np.asarray(active, dtype=bool)
+    return states[:, active] - observation[active]
+
+
+def _gaussian_terms(states, observation, active=None, std=1.0):
+    residuals = _residuals(states, observation, active)
+    return -0.5 * np.sum(residuals ** 2, axis=2) / std ** 2
+
+
+def _student_t_terms(states, observation, active=None, std=1.0, dof=4.0):
+    residuals = _residuals(states, observation, active)
+    distance2 = np.sum(residuals ** 2, axis=2)
+    return -0.5 * (dof + 2) * np.log1p(distance2 / (dof * std ** 2))
+
+
+def _mahalanobis_terms(states, observation, active=None, variance=1.0):
+    variance = np.asarray(variance, dtype=float)
+    if variance.ndim == 1:
+        variance = variance[:, np.newaxis]
+    if variance.ndim and active is not None:
+        variance = variance[np.asarray(active, dtype=bool)]
+    residuals = _residuals(states, observation, active)
+    return -0.5 * np.sum(residuals ** 2 / variance, axis=2)
+
+
+def gaussian(states, observation, active=None, std=1.0):
+    return np.sum(_gaussian_terms(states, observation, active, std), axis=1)
+
+
+def student_t(states, observation, active=None, std=1.0, dof=4.0):
+    return np.sum(_student_t_terms(states, observation, active, std, dof),
+                  axis=1)
+
+
+def mahalanobis(states, observation, active=None, variance=1.0):
+    """
+    The variance is a scalar, one value per agent, or an (agents, 2)
+    array with a value per agent and axis.
+    """
+    return np.sum(_mahalanobis_terms(states, observation, active, variance),
+                  axis=1)
+
+
+LIKELIHOODS = {'gaussian': gaussian,
+               'student_t': student_t,
+               'mahalanobis': mahalanobis}
+
+AGENT_TERMS = {'gaussian': _gaussian_terms,
+               'student_t': _student_t_terms,
+               'mahalanobis': _mahalanobis_terms}
+
+
+def log_likelihood(name, states, observation, active=None, **kwargs):
+    """
+    Log-likelihood of an observation for each particle.
+
+    Params:
+        name            # the name of a likelihood (see LIKELIHOODS)
+        states          # (particles, 2 * agents) particle states
+        observation     # (2 * agents,) observed state
+        active          # (agents,) boolean mask of the agents to compare
+                          (default: all of them)
+        kwargs          # parameters of the likelihood (e.g. std)
+
+    Returns:
+        (particles,) array of log-weights
+    """
+    try:
+        function = LIKELIHOODS[name]
+    except KeyError:
+        raise ValueError(f"Unknown likelihood '{name}', "
+                         f"choose from {list(LIKELIHOODS)}")
+    return function(states, observation, active, **kwargs)
+
+
+def agent_log_likelihoods(name, states, observation, active=None, **kwargs):
+    """
+    The log-likelihood of each agent's observation for each particle, i.e.
+    the terms that log_likelihood() sums over the agents. Used to weight
+    parts of the particles separately (e.g. in a localised filter).
+
+    Returns:
+        (particles, active agents) array of log-weights
+    """
+    try:
+        function = AGENT_TERMS[name]
+    except KeyError:
+        raise ValueError(f"Unknown likelihood '{name}', "
+                         f"choose from {list(AGENT_TERMS)}")
+    return function(states, observation, active, **kwargs)
+
+
+def normalise_log_weights(log_weights):
+    """
+    Convert log-weights to weights that sum to one, without underflow.
+    """
+    log_weights = np.asarray(log_weights, dtype=float)
+    weights = np.exp(log_weights - np.max(log_weights))
+    return weights / np.sum(weights)
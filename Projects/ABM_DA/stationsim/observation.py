@@ -0,0 +1,159 @@
+"""
+observation.py
+Observation operators for the ensemble filters, i.e. the map H from a
+state vector to the observation vector.
+
+A dense H is mostly an identity with rows dropped (it selects the
+observed coordinates), so multiplying by it wastes O(d n) work for each
+member. The operators only do the work that is needed:
+
+    H = make_observation_operator(H, state_vector_length)
+    observations = H @ states       # a state vector, or (n, m) ensemble
+    H.project(C)                    # H C H^T
+    H.cross(C)                      # C H^T
+    H.to_matrix()                   # the dense matrix
+
+    SelectionOperator   # picks the observed coordinates by indexing
+    MatrixOperator      # a dense or scipy.sparse matrix
+    CallableOperator    # any function of the state vectors (e.g. the
+                          counts of agents seen by a camera); only the
+                          ensemble analysis can use a nonlinear one
+"""
+# Imports
+import numpy as np
+from scipy import sparse
+
+
+# Classes
+class ObservationOperator:
+    """
+    The interface of the observation operators (H @ states).
+    """
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+
+    def __matmul__(self, states):
+        return self.apply(states)
+
+    def apply(self, states):
+        """
+        Returns the observations of a state vector, or of the columns of
+        an ensemble.
+        """
+        raise NotImplementedError
+
+    def project(self, C):
+        """
+        Returns H C H^T (e.g. the state covariance in observation space).
+        """
+        return self.apply(self.cross(C))
+
+    def cross(self, C):
+        """
+        Returns C H^T.
+        """
+        return self.apply(C.T).T
+
+    def to_matrix(self):
+        """
+        Returns H as a dense matrix.
+        """
+        return self.cross(np.eye(self.shape[1])).T
+
+
+class SelectionOperator(ObservationOperator):
+    """
+    Observe the state coordinates with the given indices.
+    """
+    def __init__(self, indices, state_vector_length):
+        self.indices = np.asarray(indices, dtype=int)
+        super().__init__((len(self.indices), state_vector_length))
+
+    def apply(self, states):
+        return states[self.indices]
+
+    def project(self, C):
+        return C[np.ix_(self.indices, self.indices)]
+
+    def cross(self, C):
+        return C[:, self.indices]
+
+    def to_matrix(self):
+        return np.eye(self.shape[1])[self.indices]
+
+
+class MatrixOperator(ObservationOperator):
+    """
+    Observe through a dense or scipy.sparse matrix.
+    """
+    def __init__(self, matrix):
+        self.matrix = matrix
+        super().__init__(matrix.shape)
+
+    def apply(self, states):
+        return self.matrix @ states
+
+    def to_matrix(self):
+        if sparse.issparse(self.matrix):
+            return self.matrix.toarray()
+        return np.asarray(self.matrix)
+
+
+class CallableOperator(ObservationOperator):
+    """
+    Observe through a function of the states. The function takes a state
+    vector, or an (n, m) ensemble, and returns the observation vector, or
+    the (d, m) observations of the ensemble. project(), cross() and
+    to_matrix() are only valid if the function is linear.
+    """
+    def __init__(self, function, shape, linear=False):
+        self.function = function
+        self.linear = linear
+        super().__init__(shape)
+
+    def apply(self, states):
+        return self.function(states)
+
+    def cross(self, C):
+        if not self.linear:
+            raise ValueError('A nonlinear observation operator has no '
+                             'matrix; use the ensemble analysis.')
+        return super().cross(C)
+
+
+# Functions
+def make_observation_operator(H, state_vector_length=None):
+    """
+    Create the observation operator for an observation operator, a dense
+    or sparse matrix or a function.
+
+    A dense matrix whose rows each hold a single one is turned into a
+    SelectionOperator.
+
+    Params:
+        H
+        state_vector_length     # needed for a function
+
+    Returns:
+        observation operator
+    """
+    if isinstance(H, ObservationOperator):
+        return H
+    if sparse.issparse(H):
+        return MatrixOperator(H)
+    if callable(H):
+        if state_vector_length is None:
+            raise ValueError('An observation function needs the state vector '
+                             'length.')
+        n_obs = len(H(np.zeros(state_vector_length)))
+        return CallableOperator(H, (n_obs, state_vector_length))
+
+    H = np.asarray(H)
+    if H.ndim != 2:
+        raise ValueError(f'Observation matrix has unexpected ndim: {H.ndim}')
+    indices = np.argmax(H != 0, axis=1)
+    selected = H[np.arange(len(H)), indices]
+    if (np.all(np.count_nonzero(H, axis=1) == 1) and
+            np.all(selected == 1)):
+        return SelectionOperator(indices, H.shape[1])
+    return MatrixOperator(H)
@@ -1,4 +1,5 @@
-from filter import Filter
+from filter import Filter, FilterPool
+from resampling import systematic
 from stationsim_model import Model
 
 
@@ -19,7 +20,8 @@ class ParticleFilter(Filter):
     TODO: refactor to properly inherit from Filter.
     '''
 
-    def __init__(self, ModelClass:Model, model_params:dict, filter_params:dict, numcores:int = None):
+    def __init__(self, ModelClass:Model, model_params:dict, filter_params:dict, numcores:int = None,
+                 pool:FilterPool = None):
         '''
         Initialise Particle Filter
             
@@ -45,6 +47,8 @@ class ParticleFilter(Filter):
         models using a deepcopy of base model. Determine particle filter 
         dimensions, initialise all remaining arrays, and set initial
         particle states to the base model state using multiprocessing. 
+        The multiprocessing pool is started by the filter and closed at the end of step(), unless
+        an (already started) FilterPool is passed as pool, e.g. to share one pool between runs.
         '''
         for key, value in filter_params.items():
             setattr(self, key, value)
@@ -72,7 +76,12 @@ class ParticleFilter(Filter):
         ## We get problems when there are more processes than particles (larger particle variance for some reason)
         #if numcores > self.number_of_particles:
         #    numcores = self.number_of_particles
-        self.pool = multiprocessing.Pool(processes=numcores)
+        self.own_pool = pool is None
+        if self.own_pool:
+            pool = FilterPool(numcores)
+            print("Started {} worker processes in {}s".format(pool.numcores, round(pool.startup_time, 2)))
+        self.pool = pool
+        numcores = self.pool.numcores
         if self.do_save or self.p_save:
             self.active_agents = []
             self.mean_states = [] # Mean state of all partciles, weighted by distance from observations
@@ -256,8 +265,9 @@ class ParticleFilter(Filter):
             # If not saving then just return null
             return
 
-        finally: # Whatever happens, make sure the multiprocessing pool is colsed
-            self.pool.close()
+        finally: # Whatever happens, make sure the multiprocessing pool is colsed (if it is ours)
+            if self.own_pool:
+                self.pool.close()
 
     def predict(self, numiter=1):
         '''
@@ -319,16 +329,7 @@ class ParticleFilter(Filter):
         update agent locations in particle models using
         multiprocessing methods.
         '''
-        offset_partition = ((np.arange(self.number_of_particles)
-                             + np.random.uniform()) / self.number_of_particles)
-        cumsum = np.cumsum(self.weights)
-        i, j = 0, 0
-        while i < self.number_of_particles:
-            if offset_partition[i] < cumsum[j]:
-                self.indexes[i] = j
-                i += 1
-            else:
-                j += 1
+        self.indexes[:] = systematic(self.weights)
 
         self.states[:] = self.states[self.indexes]
         self.weights[:] = self.weights[self.indexes]
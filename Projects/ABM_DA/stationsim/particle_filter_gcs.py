@@ -4,17 +4,43 @@ Particle Filter - GCT data version
     modified: 19/06/2020
 '''
 #import sys
-from filter import Filter
-from stationsim_gcs_model import Model
+from filter import Filter, FilterPool
+from stationsim_gcs_model import HistoryRecorder, Model
+from trajectory_store import ObservationFeed, open_frames
+from resampling import effective_sample_size, resample
+from likelihood import agent_log_likelihoods, log_likelihood, normalise_log_weights
+from timing import PhaseTimer
+from checkpoint import (read_checkpoint, restore_models, rng_state, set_rng_state,
+                        snapshot_models, write_checkpoint)
 import numpy as np
 import matplotlib.pyplot as plt
-from copy import deepcopy
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 import multiprocessing
+from multiprocessing import shared_memory
+import pickle
 import warnings
-import itertools
 import time
 
 
+# The hidden agent parameters that the 'sir' method resamples with the particles
+LATENT_FIELDS = ('speed', 'gate_out', 'loc_desire')
+
+# The per-window results of the filter that are kept in checkpoints
+RESULT_LISTS = ('active_agents', 'mean_states', 'mean_errors', 'variances', 'absolute_errors',
+                'unique_particles', 'before_resample', 'ess', 'resampled')
+
+
+def get_latent(models):
+    '''
+    Returns a dict with an array of each of the LATENT_FIELDS of the
+    agents, with one row per model.
+    '''
+    return {name: np.array([getattr(model.agent_arrays, name) for model in models])
+            for name in LATENT_FIELDS}
+
+
 class ParticleFilter(Filter): 
     '''
     A particle filter to model the dynamics of the
@@ -23,7 +49,8 @@ class ParticleFilter(Filter):
     TODO: refactor to properly inherit from Filter.
     '''
 
-    def __init__(self, ModelClass:Model, model_params:dict, filter_params:dict, numcores:int = None):
+    def __init__(self, ModelClass:Model, model_params:dict, filter_params:dict, numcores:int = None,
+                 pool:FilterPool = None):
         '''
         Initialise Particle Filter
             
@@ -45,29 +72,68 @@ class ParticleFilter(Filter):
          - do_external_data:     	Boolean to determine whether base data should be created 
                                     internally (False) or loaded from external files (True).
          - external_info:           List with 3 elements. The first element is the 'directory/' with
-                                    the external data. The second element is a boolean to determine 
+                                    the external data (frame_*.dat files, or a
+                                    trajectories.traj store; see trajectory_store.py). The second element is a boolean to determine 
                                     whether it is to determine the speed using external data (True) 
                                     or internally (False). The third element is a boolean to determine 
                                     whether it is to determine the gate_out using external data (True) 
                                     or internally (False).
         - pf_method:                The name of the desired PF method: 'sir', 'hybrid', 'tempered'                                    
+        - resampling_scheme:        The resampling scheme: 'systematic' (default), 'stratified',
+                                    'residual' or 'multinomial' (see resampling.py)
+        - ess_threshold:            If set, only resample when the effective sample size falls below
+                                    this fraction of the number of particles; the weights are then
+                                    carried over (and multiplied) between windows until resampling.
+                                    If None (default), resample at the end of every window.
+        - likelihood:               If set, the name of the likelihood used to weight the particles:
+                                    'gaussian', 'student_t' or 'mahalanobis' (see likelihood.py). The
+                                    weights are then calculated in log-space over the active agents
+                                    only. If None (default), the weights are 1/distance**2.
+        - likelihood_params:        Parameters of the likelihood, e.g. {'std': 1.0} or
+                                    {'variance': <per agent sensor variance>} (default {})
+        - checkpoint_every:         If set, write a checkpoint to checkpoint_path every this many
+                                    windows (see checkpoint() and resume())
+        - checkpoint_path:          The file to write checkpoints to
+        - worker_resident:          Whether each worker process should own a fixed shard of the
+                                    particle models for the whole run (default False; see
+                                    ResidentParticles). Otherwise the models are sent to and from
+                                    a multiprocessing pool on every predict().
+        - localisation:             If set, weight and resample parts of the particles separately
+                                    (see reweight_local()): 'agent' for each observed agent, or
+                                    'cluster' for each group of observed agents that are (through
+                                    their neighbours) within localisation_radius of each other.
+                                    The particles are then recombined from the resampled parts.
+                                    The weights use the likelihood ('gaussian' if None). If None
+                                    (default), every particle has a single weight.
+        - localisation_radius:      The neighbour distance of the 'cluster' localisation (default 50)
         DESCRIPTION
         Firstly, set all attributes using filter parameters. Set time and
         initialise base model using model parameters. Initialise particle
-        models using a deepcopy of base model. Determine particle filter 
+        models using copies of the base model (see Filter.copy_model). Determine particle filter 
         dimensions, initialise all remaining arrays, and set initial
         particle states to the base model state using multiprocessing. 
+        The multiprocessing pool is started by the filter and closed at the end of step(), unless
+        an (already started) FilterPool is passed as pool, e.g. to share one pool between runs.
+        The time, calls and bytes sent to and from the workers in each phase of each window are
+        recorded in self.timer (a timing.PhaseTimer, which can export them as CSV or JSON).
         '''
         for key, value in filter_params.items():
             setattr(self, key, value)
         self.time = 0
         self.number_of_iterations = model_params['batch_iterations']
         self.base_model = ModelClass(**model_params) # (Model does not need a unique id)
-        self.models = list([deepcopy(self.base_model) for _ in range(self.number_of_particles)])
-        # To store the final result
+        self.models = list([self.copy_model(self.base_model) for _ in range(self.number_of_particles)])
+        # To store the final result (recorded in its history even if the
+        # models keep none)
         self.estimate_model = ModelClass(**model_params)
+        if not self.estimate_model.do_history:
+            self.estimate_model.history = HistoryRecorder(self.estimate_model.pop_total,
+                                                          self.estimate_model.history_dtype)
         if self.do_external_data:
             self.set_initial_conditions()
+            # The frames are loaded ahead in a background thread
+            self.observation_feed = ObservationFeed(open_frames(self.external_info[0]),
+                                                    [agent.unique_id for agent in self.base_model.agents])
         self.dimensions = len(self.base_model.get_state(sensor='location'))
         self.states = np.zeros((self.number_of_particles, self.dimensions))
         self.weights = np.ones(self.number_of_particles)
@@ -85,10 +151,61 @@ class ParticleFilter(Filter):
         if not self.do_resample:
             print("**Warning**: Not resampling. This should only be used for benchmarking")
 
+        try:
+            self.worker_resident
+        except AttributeError:
+            self.worker_resident = False
+
+        try:
+            self.resampling_scheme
+        except AttributeError:
+            self.resampling_scheme = 'systematic'
+        try:
+            self.ess_threshold
+        except AttributeError:
+            self.ess_threshold = None
+
+        try:
+            self.likelihood
+        except AttributeError:
+            self.likelihood = None
+        try:
+            self.likelihood_params
+        except AttributeError:
+            self.likelihood_params = {}
+
+        try:
+            self.localisation
+        except AttributeError:
+            self.localisation = None
+        if self.localisation not in (None, 'agent', 'cluster'):
+            raise ValueError(f"Unknown localisation '{self.localisation}', choose None, 'agent' or 'cluster'")
+        if self.localisation is not None and self.ess_threshold is not None:
+            raise ValueError("The localised filter resamples every window, so ess_threshold must be None")
+        try:
+            self.localisation_radius
+        except AttributeError:
+            self.localisation_radius = 50
+
+        try:
+            self.checkpoint_every
+        except AttributeError:
+            self.checkpoint_every = None
+
         ## We get problems when there are more processes than particles (larger particle variance for some reason)
         #if numcores > self.number_of_particles:
         #    numcores = self.number_of_particles
-        self.pool = multiprocessing.Pool(processes=numcores)
+        self.own_pool = pool is None
+        if self.worker_resident:
+            # The resident workers are started below, once the particles are set up
+            if pool is not None:
+                numcores = pool.numcores
+        else:
+            if self.own_pool:
+                pool = FilterPool(numcores)
+                print("Started {} worker processes in {}s".format(pool.numcores, round(pool.startup_time, 2)))
+            self.pool = pool
+            numcores = self.pool.numcores
         if self.do_save or self.p_save:
             self.active_agents = []
             self.mean_states = [] # Mean state of all partciles, weighted by distance from observations
@@ -97,18 +214,108 @@ class ParticleFilter(Filter):
             self.absolute_errors = [] # Unweighted distance between mean state and the true state
             self.unique_particles = []
             self.before_resample = [] # Records whether the errors were before or after resampling
+        self.ess = [] # Effective sample size in each window (after reweighting)
+        self.resampled = [] # Whether the particles were resampled in each window
 
         self.animation = [] # Keep a record of each plot created if animating so the individual ones can be viewed later
+        # Wall time, calls and bytes sent to/from the workers in each phase of each window
+        self.timer = PhaseTimer()
 
         #print("Creating initial states ... ")
         base_model_state = self.base_model.get_state(sensor='location')
         self.states = np.array([ self.initial_state(i, base_model_state) for i in range(self.number_of_particles )])
         #print("\t ... finished")
+        if self.worker_resident:
+            # The models now live in the workers, and the states and
+            # indexes in shared memory
+            self.workers = ResidentParticles(self.models, self.states, numcores)
+            self.states = self.workers.states
+            self.indexes = self.workers.indexes
+            self.models = None
         print("Running filter with {} particles and {} runs (on {} cores) with {} agents.".format(
             filter_params['number_of_particles'], filter_params['number_of_runs'], numcores, model_params["pop_total"]),
             flush=True)
         
         #self.estimate_model.history_locations_err = []
+    def set_external_frame(self, time):
+        '''
+        Set the base model agents to the real pedestrian positions in
+        one frame of the external data.
+        Agents in the frame are activated at their recorded location,
+        and active agents missing from it are deactivated. If the frame
+        is not in the data (the end of the simulation), all agents are
+        deactivated.
+        '''
+        arrays = self.base_model.agent_arrays
+        observation = self.observation_feed.get(time)
+        if observation is None:
+            arrays.status[:] = 2
+            return
+        index, locations = observation
+        observed = np.zeros(len(arrays), dtype=bool)
+        observed[index] = True
+        arrays.status[(arrays.status == 1) & ~observed] = 2
+        arrays.status[index] = 1
+        arrays.location[index] = locations
+
+    def checkpoint(self, path):
+        '''
+        Write the state of the filter to a checkpoint file (see
+        checkpoint.py): the particle states, weights and models, the
+        base and estimate models, the random state, the time and the
+        results recorded so far. The filter can be resumed from it with
+        resume().
+        '''
+        if self.worker_resident:
+            models = self.workers.snapshots()
+        else:
+            models = snapshot_models(self.models)
+        arrays = {'states': self.states,
+                  'weights': self.weights,
+                  'indexes': self.indexes,
+                  'counters': np.array([self.time, self.window_counter]),
+                  'rng': rng_state(),
+                  'models': models,
+                  'base_model': self.base_model.snapshot()}
+        for name, model in (('base_history', self.base_model), ('estimate_history', self.estimate_model)):
+            if hasattr(model, 'history'):
+                arrays[name] = model.history.arrays()
+        lists = {name: getattr(self, name) for name in RESULT_LISTS if hasattr(self, name)}
+        write_checkpoint(path, arrays, lists)
+
+    def load_checkpoint(self, path):
+        '''
+        Return the filter to the state saved by checkpoint().
+        '''
+        arrays, lists, _ = read_checkpoint(path)
+        self.states[:] = arrays['states']
+        self.weights = arrays['weights'].copy()
+        self.indexes[:] = arrays['indexes']
+        self.time, self.window_counter = (int(c) for c in arrays['counters'])
+        set_rng_state(arrays['rng'])
+        if self.worker_resident:
+            self.workers.restore(arrays['models'])
+        else:
+            restore_models(self.models, arrays['models'])
+        self.base_model.restore(arrays['base_model'])
+        for name, model in (('base_history', self.base_model), ('estimate_history', self.estimate_model)):
+            if name in arrays:
+                model.history.load(arrays[name])
+        for name, values in lists.items():
+            setattr(self, name, values)
+
+    @classmethod
+    def resume(cls, path, ModelClass:Model, model_params:dict, filter_params:dict, numcores:int = None,
+               pool:FilterPool = None):
+        '''
+        Create a filter (with the same parameters as the interrupted run)
+        and return it to the state saved in a checkpoint, so that step()
+        carries on from there.
+        '''
+        pf = cls(ModelClass, model_params, filter_params, numcores=numcores, pool=pool)
+        pf.load_checkpoint(path)
+        return pf
+
     def initial_state(self, particle_number, base_model_state):
         """
         Set the state of the particles to the state of the
@@ -217,6 +424,13 @@ class ParticleFilter(Filter):
         model.set_state(state, sensor='location')
         return model, state
 
+    @classmethod
+    def step_particle_pickled(cls, task: bytes) -> bytes:
+        """
+        step_particle() with pickled arguments and result (see predict()).
+        """
+        return pickle.dumps(cls.step_particle(*pickle.loads(task)), protocol=pickle.HIGHEST_PROTOCOL)
+
     def step(self):
         '''
         Step Particle Filter
@@ -269,22 +483,36 @@ class ParticleFilter(Filter):
 
                         # Store the model states before and after resampling
                         if self.do_save or self.p_save:
-                            self.save(before=True)
+                            with self.timer.phase('save'):
+                                self.save(before=True)
 
 
                         if self.do_resample: # Can turn off resampling for benchmarking
-                            self.reweight()
-                            self.resample()
+                            with self.timer.phase('reweight'):
+                                self.reweight()
+                            self.ess.append(effective_sample_size(self.weights))
+                            self.resampled.append(bool(self.ess_threshold is None or
+                                                       self.ess[-1] < self.ess_threshold * self.number_of_particles))
+                            if self.resampled[-1]:
+                                with self.timer.phase('resample'):
+                                    self.resample()
                             #self.get_state_estimate()
                         #self.get_state_estimate()
                         # Store the model states before and after resampling
                         if self.do_save or self.p_save:
-                            self.save(before=False)
+                            with self.timer.phase('save'):
+                                self.save(before=False)
 
                         # Animate this window
                         if self.do_ani:
-                            self.ani()
+                            with self.timer.phase('animate'):
+                                self.ani()
+
+                        if self.checkpoint_every and self.window_counter % self.checkpoint_every == 0:
+                            with self.timer.phase('checkpoint'):
+                                self.checkpoint(self.checkpoint_path)
 
+                        self.timer.end_window(self.window_counter)
                         print("\tFinished window {}, step {} (took {}s)".format(
                             self.window_counter, self.time, round(float(time.time() - window_start_time), 2)))
                         window_start_time = time.time()
@@ -337,8 +565,35 @@ class ParticleFilter(Filter):
             return
 
         finally: # Whatever happens, make sure the multiprocessing pool is colsed
+            self.close()
+
+    def close(self):
+        '''
+        Close the multiprocessing pool (unless it is shared), or the
+        resident workers (the states and indexes are copied out of shared
+        memory first), and the observation feed.
+        '''
+        if self.do_external_data:
+            self.observation_feed.close()
+        if self.worker_resident:
+            if self.workers is not None:
+                self.states = np.array(self.states)
+                self.indexes = np.array(self.indexes)
+                self.workers.close()
+                self.workers = None
+        elif self.own_pool:
             self.pool.close()
 
+    def get_models(self):
+        '''
+        Returns the particle models. With resident workers these are
+        copies fetched from the workers (this is slow, so it is only
+        used for the animation).
+        '''
+        if self.worker_resident:
+            return self.workers.get_models()
+        return self.models
+
     def predict(self, numiter=1):
         '''
         Predict
@@ -356,67 +611,44 @@ class ParticleFilter(Filter):
 
         time = self.time - numiter
 
-        if self.do_external_data:
-            for i in range(numiter):
-                time = time + 1
-                file_name = self.external_info[0] + 'frame_' + str(time)+ '.0.dat'
-                try:
-                    agentID, x, y = np.loadtxt(file_name,unpack=True)
-                    j = 0
-                    for agent in self.base_model.agents:
-                        if (agent.unique_id in agentID):
-                            
-                            agent.status = 1
-                            agent.location = [x[j], y[j]]
-                            j += 1
-                        elif (agent.status == 1):
-                            agent.status = 2
-                except TypeError:
-                    '''
-                    This error occurs when only one agent is active. In
-                    this case, the data is read as a float instead of an
-                    array.
-                    '''
-                    for agent in self.base_model.agents:
-                        if (agent.unique_id == agentID):
-                            agent.status = 1
-                            agent.location = [x, y]
-                        elif (agent.status == 1):
-                            agent.status = 2
-                except ValueError:
-                    '''
-                     This error occurs when there is no active agent in
-                     the frame.
-                     - Deactivate all active agents.
-                    '''
-                    for agent in self.base_model.agents:
-                        if (agent.status == 1):
-                            agent.status = 2
-
-                except OSError:
-                    '''
-                    This error occurs when there is no external file to
-                    read. It should only occur at the end of the simulation.
-                    - Deactivate all agent.
-                    '''
-                    for agent in self.base_model.agents:
-                        agent.status = 2
-                
-        else:
-            for i in range(numiter):
-                self.base_model.step()
-        
-        stepped_particles = self.pool.starmap(ParticleFilter.step_particle, list(zip( \
-            range(self.number_of_particles),  # Particle numbers (in integer)
-            [m for m in self.models],  # Associated Models (a Model object)
-            [numiter] * self.number_of_particles,  # Number of iterations to step each particle (an integer)
-            [self.particle_std] * self.number_of_particles,  # Particle std (for adding noise) (a float)
-            [s.shape for s in self.states],  # Shape (for adding noise) (a tuple)
-        )))
+        with self.timer.phase('base_model'):
+            if self.do_external_data:
+                for i in range(numiter):
+                    time = time + 1
+                    self.set_external_frame(time)
+            else:
+                for i in range(numiter):
+                    self.base_model.step()
+
+        if self.worker_resident:
+            with self.timer.phase('predict'):
+                seeds = np.random.randint(2 ** 32, size=self.number_of_particles, dtype=np.int64)
+                sent, received = self.workers.bytes_sent, self.workers.bytes_received
+                self.workers.predict(numiter, self.particle_std, seeds)
+                self.timer.add_bytes('predict', sent=self.workers.bytes_sent - sent,
+                                     received=self.workers.bytes_received - received)
+            with self.timer.phase('estimate'):
+                self.get_state_estimate()
+            return
 
-        self.models = [stepped_particles[i][0] for i in range(len(stepped_particles))]
-        self.states = np.array([stepped_particles[i][1] for i in range(len(stepped_particles))])
-        self.get_state_estimate()
+        with self.timer.phase('predict'):
+            # The arguments and results are pickled here (rather than by the pool) to count the bytes
+            tasks = [pickle.dumps(args, protocol=pickle.HIGHEST_PROTOCOL) for args in zip(
+                range(self.number_of_particles),  # Particle numbers (in integer)
+                [m for m in self.models],  # Associated Models (a Model object)
+                [numiter] * self.number_of_particles,  # Number of iterations to step each particle (an integer)
+                [self.particle_std] * self.number_of_particles,  # Particle std (for adding noise) (a float)
+                [s.shape for s in self.states],  # Shape (for adding noise) (a tuple)
+            )]
+            results = self.pool.map(ParticleFilter.step_particle_pickled, tasks)
+            self.timer.add_bytes('predict', sent=sum(len(task) for task in tasks),
+                                 received=sum(len(result) for result in results))
+            stepped_particles = [pickle.loads(result) for result in results]
+
+            self.models = [stepped_particles[i][0] for i in range(len(stepped_particles))]
+            self.states = np.array([stepped_particles[i][1] for i in range(len(stepped_particles))])
+        with self.timer.phase('estimate'):
+            self.get_state_estimate()
         
 
         '''
@@ -444,7 +676,18 @@ class ParticleFilter(Filter):
         the distance between the particle states and the measured base model
         state and then calculate the new particle weights as 1/distance.
         Add a small term to avoid dividing by 0. Normalise the weights.
+
+        If a likelihood is set, the weights are instead calculated in
+        log-space from that likelihood (see likelihood.py), comparing only
+        the agents that are active in the base model.
         '''
+        if self.localisation is not None:
+            self.reweight_local()
+            return
+        if self.likelihood is not None:
+            self.reweight_likelihood()
+            return
+
         if self.do_external_data: 
             measured_state = self.base_model.get_state(sensor='location')
         else:        
@@ -452,62 +695,156 @@ class ParticleFilter(Filter):
                               + np.random.normal(0, self.model_std ** 2, size=self.states.shape))
 
         distance = np.linalg.norm(self.states - measured_state, axis=1)
-        self.weights = 1 / (distance + 1e-9) ** 2
+        if self.ess_threshold is None:
+            self.weights = 1 / (distance + 1e-9) ** 2
+        else:
+            # The particles are not resampled every window, so carry over the weights
+            self.weights = self.weights / (distance + 1e-9) ** 2
         self.weights /= np.sum(self.weights)
 
         return
 
+    def reweight_likelihood(self):
+        '''
+        Reweight the particles with the log-likelihood of the measured
+        state, over the agents active in the base model only.
+        '''
+        measured_state = self.base_model.get_state(sensor='location')
+        if not self.do_external_data:
+            measured_state = measured_state + np.random.normal(0, self.model_std ** 2, size=self.dimensions)
+
+        active = self.base_model.agent_arrays.status == 1
+        log_weights = log_likelihood(self.likelihood, self.states, measured_state,
+                                     active, **self.likelihood_params)
+        if self.ess_threshold is not None:
+            # The particles are not resampled every window, so carry over the weights
+            with np.errstate(divide='ignore'):
+                log_weights += np.log(self.weights)
+        self.weights = normalise_log_weights(log_weights)
+
+    def get_blocks(self, measured_state, active):
+        '''
+        Split the observed agents into the blocks that are weighted
+        separately by the localised filter: one per agent, or one per
+        cluster of agents linked by neighbours within localisation_radius
+        of their measured locations (like the model's neighbour queries,
+        with a KD-tree).
+
+        :param measured_state: The measured state
+        :param active: Boolean mask of the observed agents
+        :return: The block of each agent (-1 if it is not observed), and the
+            number of blocks
+        '''
+        agents = np.flatnonzero(active)
+        blocks = np.full(len(active), -1)
+        if self.localisation == 'agent' or len(agents) < 2:
+            blocks[agents] = np.arange(len(agents))
+            return blocks, len(agents)
+        locations = np.reshape(measured_state, (-1, 2))[agents]
+        pairs = cKDTree(locations).query_pairs(self.localisation_radius, output_type='ndarray')
+        graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                           shape=(len(agents), len(agents)))
+        number_of_blocks, labels = connected_components(graph, directed=False)
+        blocks[agents] = labels
+        return blocks, number_of_blocks
+
+    def reweight_local(self):
+        '''
+        Reweight the parts of the particles separately (localised filter).
+
+        The observed agents are split into blocks (see get_blocks()) and
+        every block gets its own weights from the likelihood of its agents
+        only, so the weights do not degenerate as the crowd grows. The
+        particles are given the weights of the whole observation, which are
+        only used for the estimates before resampling.
+        '''
+        measured_state = self.base_model.get_state(sensor='location')
+        if not self.do_external_data:
+            measured_state = measured_state + np.random.normal(0, self.model_std ** 2, size=self.dimensions)
+
+        active = self.base_model.agent_arrays.status == 1
+        self.blocks, number_of_blocks = self.get_blocks(measured_state, active)
+        terms = agent_log_likelihoods(self.likelihood or 'gaussian', self.states, measured_state,
+                                      active, **self.likelihood_params)
+        log_weights = np.zeros((number_of_blocks, self.number_of_particles))
+        np.add.at(log_weights, self.blocks[active], terms.T)
+        self.local_weights = np.array([normalise_log_weights(w) for w in log_weights])
+        self.weights = normalise_log_weights(np.sum(terms, axis=1))
+
+    def resample_local(self):
+        '''
+        Resample each block of agents separately with its own weights,
+        and recombine the particles from the resampled blocks.
+
+        :return: (particles, agents) array with the particle that each
+            agent of each particle is copied from
+        '''
+        sources = np.tile(np.arange(self.number_of_particles)[:, np.newaxis], (1, len(self.blocks)))
+        if len(self.local_weights):
+            indexes = np.array([resample(w, self.resampling_scheme) for w in self.local_weights])
+            observed = self.blocks >= 0
+            sources[:, observed] = indexes[self.blocks[observed]].T
+        return sources
+
     def resample(self):
         '''
         Resample
 
         DESCRIPTION
-        Calculate a random partition of (0,1) and then
-        take the cumulative sum of the particle weights.
-        Carry out a systematic resample of particles.
+        Resample the particles with the resampling_scheme
+        (systematic by default, see resampling.py).
         Set the new particle states and weights and then
         update agent locations in particle models using
         multiprocessing methods.
+
+        The localised filter resamples every block of agents separately
+        instead (see resample_local()).
         '''
-        offset_partition = ((np.arange(self.number_of_particles)
-                             + np.random.uniform()) / self.number_of_particles)
-        cumsum = np.cumsum(self.weights)
-        i, j = 0, 0
-        while i < self.number_of_particles:
-            if offset_partition[i] < cumsum[j]:
-                self.indexes[i] = j
-                i += 1
+        agents = np.arange(self.base_model.pop_total)
+        if self.localisation is None:
+            self.indexes[:] = resample(self.weights, self.resampling_scheme)
+            sources = self.indexes[:, np.newaxis]
+            self.states[:] = self.states[self.indexes]
+            if self.ess_threshold is None:
+                self.weights[:] = self.weights[self.indexes]
             else:
-                j += 1
+                # The weights are carried over to the next window, so start again from equal weights
+                self.weights[:] = 1 / self.number_of_particles
+        else:
+            sources = self.resample_local()
+            # The particles keep their number, only their agents are copied
+            self.indexes[:] = np.arange(self.number_of_particles)
+            self.states[:] = np.reshape(np.reshape(self.states, (self.number_of_particles, -1, 2))[sources, agents],
+                                        (self.number_of_particles, -1))
+            self.weights[:] = 1 / self.number_of_particles
+
+        if self.worker_resident:
+            # The workers read the new states and indexes from shared memory
+            self.workers.resample(copy_latent=self.pf_method == 'sir',
+                                  sources=None if self.localisation is None else sources)
+            return
 
-        self.states[:] = self.states[self.indexes]
-        self.weights[:] = self.weights[self.indexes]
-        
-        if self.pf_method is 'sir':
+        if self.pf_method == 'sir':
             '''
              In addition to updating and resampling the position of agents 
              (self.states), we will also resample the speed and gate_out. The
-             ideal would be to pass this information on self.states, but this
-             would require a change in many parts of the code.
+             hidden agent parameters (see LATENT_FIELDS) of all the particles
+             are gathered into arrays, resampled with the same indexes (per
+             agent for the localised filter), and copied back to the particles
+             that changed.
             '''
             #for the hybrid version, the speed and the gate_out are not resampled!!!
-            for i in range(self.number_of_particles):
-                if (i != self.indexes[i]):
-                    model1 = self.models[i]
-                    model2 = self.models[self.indexes[i]]
-                    for i in range(self.base_model.pop_total):
-                        model1.agents[i].speed = model2.agents[i].speed
-                        model1.agents[i].loc_desire = model2.agents[i].loc_desire
-        
-       
-        # Could use pool.starmap here, but it's quicker to do it in a single process
-        self.models = list(itertools.starmap(ParticleFilter.assign_agents, list(zip(
-            range(self.number_of_particles),  # Particle numbers (in integer)
-            [s for s in self.states],  # States
-            [m for m in self.models]  # Associated Models (a Model object)
-        ))))
+            latent = get_latent(self.models)
+            copied = np.flatnonzero(np.any(sources != np.arange(self.number_of_particles)[:, np.newaxis], axis=1))
+            for name, values in latent.items():
+                values = values[sources, agents]
+                for i in copied:
+                    getattr(self.models[i].agent_arrays, name)[:] = values[i]
+
+        for model, state in zip(self.models, self.states):
+            model.set_state(state, sensor='location')
         return
-    
+
     def get_state_estimate(self):
         '''
         # Save particles location estimate.
@@ -518,14 +855,11 @@ class ParticleFilter(Filter):
             mean = np.average(self.states[:, active_states], weights=self.weights, axis=0)
             #variance = np.average((self.states[:, active_states] - mean) ** 2, weights=self.weights, axis=0)
 
-        i = 0
-        for agent in self.base_model.agents:
-            unique_id = agent.unique_id
-            if agent.status == 1:                
-                self.estimate_model.agents[unique_id].history_locations.append((mean[i], mean[i+1]))
-                i += 2
-            else:
-                self.estimate_model.agents[unique_id].history_locations.append((None, None))
+        active = np.array([agent.status == 1 for agent in self.base_model.agents])
+        locations = np.full((self.base_model.pop_total, 2), np.nan)
+        if any(active_states):
+            locations[active] = np.reshape(mean, (-1, 2))
+        self.estimate_model.history.record(locations, active)
 
     def save(self, before: bool):
         '''
@@ -621,7 +955,8 @@ class ParticleFilter(Filter):
             markersizes += 8 - np.mean(markersizes)  # remean
 
             particle = -1
-            for model in self.models:
+            models = self.get_models()
+            for model in models:
                 particle += 1
                 markersize = np.clip(markersizes[particle], .5, 8)
                 for agent in model.agents[:self.agents_to_visualise]:
@@ -637,7 +972,7 @@ class ParticleFilter(Filter):
                     plt.plot(*agent.location, 'sk', markersize=4)
 
             plt.axis(np.ravel(self.base_model.boundaries, 'F'))
-            plt.title(f"{self.models[0].pop_total} agents, {self.number_of_particles} particles, {self.time} iterations", fontsize=13)
+            plt.title(f"{models[0].pop_total} agents, {self.number_of_particles} particles, {self.time} iterations", fontsize=13)
             plt.xlabel("X position")
             plt.ylabel("Y position")
             if self.show_ani:
@@ -646,6 +981,228 @@ class ParticleFilter(Filter):
             self.animation.append(fig) # Store this plot to browse later
 
 
+def _send(connection, message):
+    """
+    Send a message through a pipe, and return its size in bytes.
+    """
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    connection.send_bytes(data)
+    return len(data)
+
+
+def _receive(connection):
+    """
+    Receive a message sent with _send(), and its size in bytes.
+    """
+    data = connection.recv_bytes()
+    return pickle.loads(data), len(data)
+
+
+def _resident_worker(connection, models, first, shared):
+    """
+    The loop run by each resident worker process (see ResidentParticles).
+
+    :param connection: The worker's end of the pipe to the filter
+    :param models: The particle models of this worker's shard
+    :param first: The number of the first particle in the shard
+    :param shared: (name, shape, dtype) of the shared states, indexes
+        and LATENT_FIELDS
+    """
+    blocks = [shared_memory.SharedMemory(name=name) for name, _, _ in shared]
+    arrays = [np.ndarray(shape, dtype=dtype, buffer=block.buf)
+              for block, (_, shape, dtype) in zip(blocks, shared)]
+    states, indexes = arrays[:2]
+    latent = dict(zip(LATENT_FIELDS, arrays[2:]))
+    particles = range(first, first + len(models))
+    try:
+        while True:
+            (command, args), _ = _receive(connection)
+            if command == 'close':
+                break
+            try:
+                if command == 'predict':
+                    num_iter, particle_std, seeds = args
+                    for i, model, seed in zip(particles, models, seeds):
+                        model.set_random_seed(seed)
+                        for _ in range(num_iter):
+                            model.step()
+                        noise = np.random.normal(0, particle_std ** 2, size=states[i].shape)
+                        state = model.get_state(sensor='location') + noise
+                        model.set_state(state, sensor='location')
+                        states[i] = state
+                        for name, values in latent.items():
+                            values[i] = getattr(model.agent_arrays, name)
+                    _send(connection, None)
+                elif command == 'resample':
+                    copy_latent, sources = args
+                    for i, model in zip(particles, models):
+                        model.set_state(states[i], sensor='location')
+                        # The particle (or for each agent, see ParticleFilter.resample_local()) to copy from
+                        j = indexes[i] if sources is None else sources[i - first]
+                        if copy_latent and np.any(j != i):
+                            agents = np.arange(len(model.agent_arrays))
+                            for name, values in latent.items():
+                                getattr(model.agent_arrays, name)[:] = values[j, agents]
+                    _send(connection, None)
+                elif command == 'models':
+                    _send(connection, models)
+                elif command == 'snapshot':
+                    _send(connection, snapshot_models(models))
+                elif command == 'restore':
+                    snapshots, = args
+                    restore_models(models, snapshots)
+                    _send(connection, None)
+                else:
+                    raise ValueError(f"Unknown command '{command}'")
+            except Exception as error:
+                _send(connection, error)
+    finally:
+        del states, indexes, latent, arrays
+        for block in blocks:
+            block.close()
+        connection.close()
+
+
+class ResidentParticles:
+    '''
+    Particle models that stay resident in worker processes.
+
+    DESCRIPTION
+    Each worker process owns a fixed shard of the particle models for
+    the whole run, so the models are only pickled once, when the
+    workers start. The particle states, the resampling indexes and the
+    hidden agent parameters (LATENT_FIELDS, which the 'sir' method copies
+    between particles) are kept in shared memory, and the messages to
+    the workers only carry the noise seeds of their particles.
+
+    In predict() the workers step their particles and write the noisy
+    states to the shared states. The filter then reweights and resamples
+    the shared states and indexes in place, and in resample() the
+    workers set their models' locations from the new states and copy the
+    hidden parameters of the particles they were resampled from.
+    '''
+    def __init__(self, models, states, numcores):
+        '''
+        :param models: The particle models (sent to the workers)
+        :param states: The initial particle states
+        :param numcores: The number of worker processes
+        '''
+        number_of_particles = len(models)
+        self.blocks = []
+        self.states = self.__share(states)
+        self.indexes = self.__share(np.zeros(number_of_particles, 'i'))
+        self.latent = {name: self.__share(values) for name, values in get_latent(models).items()}
+        shared = [(block.name, array.shape, array.dtype) for block, array in
+                  zip(self.blocks, [self.states, self.indexes, *self.latent.values()])]
+
+        numcores = max(1, min(numcores, number_of_particles))
+        bounds = np.linspace(0, number_of_particles, numcores + 1).astype(int)
+        self.shards = list(zip(bounds[:-1], bounds[1:]))
+        self.connections = []
+        self.processes = []
+        self.bytes_sent = 0 # Bytes of the messages to and from the workers (see timing.py)
+        self.bytes_received = 0
+        for first, last in self.shards:
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_resident_worker, daemon=True,
+                args=(worker_connection, models[first:last], first, shared))
+            process.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    def __share(self, array):
+        block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        self.blocks.append(block)
+        shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        shared[:] = array
+        return shared
+
+    def __send_to(self, connection, command, args=None):
+        self.bytes_sent += _send(connection, (command, args))
+
+    def __send(self, command, args=None):
+        for connection in self.connections:
+            self.__send_to(connection, command, args)
+
+    def __gather(self):
+        replies = []
+        for connection in self.connections:
+            reply, size = _receive(connection)
+            self.bytes_received += size
+            replies.append(reply)
+        for reply in replies:
+            if isinstance(reply, Exception):
+                raise reply
+        return replies
+
+    def predict(self, num_iter, particle_std, seeds):
+        '''
+        Step every particle num_iter times and add noise to its state.
+
+        :param num_iter: The number of iterations to step
+        :param particle_std: the particle noise standard deviation
+        :param seeds: A random seed for each particle
+        '''
+        for connection, (first, last) in zip(self.connections, self.shards):
+            self.__send_to(connection, 'predict', (num_iter, particle_std, seeds[first:last]))
+        self.__gather()
+
+    def resample(self, copy_latent, sources=None):
+        '''
+        Set the particle models to the (resampled) shared states.
+
+        :param copy_latent: Whether to also copy the hidden parameters
+            (LATENT_FIELDS) of the particles given by the shared indexes
+        :param sources: If given, a (particles, agents) array with the
+            particle to copy each agent from instead of the shared indexes
+        '''
+        for connection, (first, last) in zip(self.connections, self.shards):
+            shard = None if sources is None else sources[first:last]
+            self.__send_to(connection, 'resample', (copy_latent, shard))
+        self.__gather()
+
+    def get_models(self):
+        '''
+        Returns copies of all the particle models.
+        '''
+        self.__send('models')
+        return [model for models in self.__gather() for model in models]
+
+    def snapshots(self):
+        '''
+        Returns the stacked snapshots of all the particle models (see
+        checkpoint.snapshot_models()).
+        '''
+        self.__send('snapshot')
+        snapshots = self.__gather()
+        return {name: np.concatenate([shard[name] for shard in snapshots])
+                for name in snapshots[0]}
+
+    def restore(self, snapshots):
+        '''
+        Restore the particle models from stacked snapshots.
+        '''
+        for connection, (first, last) in zip(self.connections, self.shards):
+            shard = {name: values[first:last] for name, values in snapshots.items()}
+            self.__send_to(connection, 'restore', (shard,))
+        self.__gather()
+
+    def close(self):
+        '''
+        Stop the workers and free the shared memory. The shared arrays
+        can not be used afterwards.
+        '''
+        self.__send('close')
+        for process in self.processes:
+            process.join()
+        del self.states, self.indexes, self.latent
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+
 if __name__ == '__main__':
     warnings.warn("The particle_filter.py code should not be run directly. Create a separate script and use that "
                   "to run experimets (e.g. see ABM_DA/experiments/pf_experiments/run_pf.py")
@@ -0,0 +1,96 @@
+"""
+resampling.py
+Resampling schemes for the particle filters.
+
+Every scheme takes the particle weights and returns the index of the
+particle that each new particle is copied from. The weights do not need
+to be normalised. The indexes of the systematic, stratified and
+multinomial schemes are sorted.
+
+    systematic()                # one random offset for all the particles
+    stratified()                # one random offset per particle
+    multinomial()               # independent draws
+    residual()                  # deterministic copies, then multinomial
+    resample()                  # any of the above, by name
+    effective_sample_size()     # 1 / sum(w ** 2) of the normalised weights
+"""
+# Imports
+import numpy as np
+
+
+# Functions
+def _search(weights, positions):
+    """
+    Find the particle whose cumulative weight interval holds each of the
+    (sorted) positions in [0, 1).
+    """
+    cumsum = np.cumsum(weights)
+    cumsum /= cumsum[-1]
+    indexes = np.searchsorted(cumsum, positions, side='right')
+    # Round-off can leave the last cumulative weight just below 1
+    return np.minimum(indexes, len(weights) - 1).astype('i')
+
+
+def systematic(weights):
+    n = len(weights)
+    positions = (np.arange(n) + np.random.uniform()) / n
+    return _search(weights, positions)
+
+
+def stratified(weights):
+    n = len(weights)
+    positions = (np.arange(n) + np.random.uniform(size=n)) / n
+    return _search(weights, positions)
+
+
+def multinomial(weights):
+    positions = np.sort(np.random.uniform(size=len(weights)))
+    return _search(weights, positions)
+
+
+def residual(weights):
+    n = len(weights)
+    weights = np.asarray(weights, dtype=float) * n / np.sum(weights)
+    copies = np.floor(weights).astype(int)
+    indexes = np.repeat(np.arange(n), copies).astype('i')
+    remaining = n - len(indexes)
+    if remaining:
+        residuals = weights - copies
+        positions = np.sort(np.random.uniform(size=remaining))
+        indexes = np.concatenate((indexes, _search(residuals, positions)))
+    return indexes
+
+
+SCHEMES = {'systematic': systematic,
+           'stratified': stratified,
+           'multinomial': multinomial,
+           'residual': residual}
+
+
+def resample(weights, scheme='systematic'):
+    """
+    Resample particles.
+
+    Params:
+        weights     # the particle weights
+        scheme      # the name of a resampling scheme (see SCHEMES)
+
+    Returns:
+        indexes     # the particle each new particle is copied from
+    """
+    try:
+        function = SCHEMES[scheme]
+    except KeyError:
+        raise ValueError(f"Unknown resampling scheme '{scheme}', "
+                         f"choose from {list(SCHEMES)}")
+    return function(weights)
+
+
+def effective_sample_size(weights):
+    """
+    The effective sample size of the (not necessarily normalised)
+    weights, between 1 and the number of particles.
+    """
+    weights = np.asarray(weights, dtype=float)
+    weights = weights / np.sum(weights)
+    return 1 / np.sum(weights ** 2)
@@ -1,7 +1,4 @@
-<<<<<<< HEAD
-=======
 # -*- coding: utf-8 -*-
->>>>>>> master
 '''
 StationSim - Density version
     author: patricia-ternes
@@ -11,9 +8,12 @@ StationSim - Density version
 import warnings
 import numpy as np
 import os
-from scipy.spatial import cKDTree
 import matplotlib.pyplot as plt
 from matplotlib.animation import FuncAnimation
+try:
+    from stationsim_gcs_model import SpatialIndex
+except ImportError:
+    from stationsim.stationsim_gcs_model import SpatialIndex
 # Dont automatically load seaborn as it isn't needed on the HPC
 try:
     from seaborn import kdeplot as sns_kdeplot
@@ -30,20 +30,12 @@ class Agent:
     def __init__(self, model, unique_id):
         '''
         Initialise a new agent.
-<<<<<<< HEAD
-
-=======
->>>>>>> master
         Desctiption:
             Creates a new agent and gives it a randomly chosen exit,
             and desired speed.
             All agents start with active state 0 ('not started').
             Their initial location (** (x,y) tuple-floats **) is set to
             (0,0) and changed when the agent is activated.
-<<<<<<< HEAD
-
-=======
->>>>>>> master
         Parameters:
             model - a pointer to the StationSim model that is creating
             this agent
@@ -109,10 +101,6 @@ class Agent:
     def step(self):
         '''
         Iterate the agent.
-<<<<<<< HEAD
-
-=======
->>>>>>> master
         Description:
             If they are active then they move and maybe leave the model.
         '''
@@ -131,6 +119,7 @@ class Agent:
             if self.model.step_id > self.steps_activate:
                 new_location = self.set_agent_location(self.gate_in)
                 self.location = new_location
+                self.model.spatial_index.move(self.unique_id, self.location)
                 self.status = 1
                 self.model.pop_active += 1
                 self.step_start = self.model.step_id
@@ -139,10 +128,6 @@ class Agent:
     def set_agent_location(self, gate):
         '''
             Define one final or initial position for the agent.
-<<<<<<< HEAD
-
-=======
->>>>>>> master
             It is necessary to ensure that the agent has a distance from
             the station wall compatible with its own size.
         '''
@@ -213,10 +198,6 @@ class Agent:
          Move the agent towards their destination.
          The speed and direction of movement can
          change depends on the local_density value.
-<<<<<<< HEAD
-
-=======
->>>>>>> master
          - self.local_density: 0.0 to 1.0 value.
         '''
 
@@ -229,6 +210,7 @@ class Agent:
 
         self.location = self.location + velocity * new_direction # velocity * new_direction * time_step
         self.location = self.model.re_bound(self, self.location)
+        self.model.spatial_index.move(self.unique_id, self.location)
 
     def get_local_density(self):
         '''
@@ -242,9 +224,8 @@ class Agent:
         #self.local_density = np.random.uniform()
 
 
-        state = self.model.get_state('location2D')
-        self.model.tree = cKDTree(state)
-        neighbouring_agents = self.model.tree.query_ball_point(self.location, self.local_density_radius)
+        neighbouring_agents = self.model.spatial_index.query_ball_point(
+            self.location, self.local_density_radius)
         self.local_density = len(neighbouring_agents) * self.size**2 / (self.local_density_radius**2 - self.size**2) # density between 0-1
 
     def deactivate(self):
@@ -280,39 +261,20 @@ class Agent:
 class Model:
     '''
     StationSim Model
-<<<<<<< HEAD
-
-    Description:
-        An Agent-Based Model (ABM) that synchronously `steps`
-        step()
-
-=======
     Description:
         An Agent-Based Model (ABM) that synchronously `steps`
         step()
->>>>>>> master
     Params:
         unique_id
         **kwargs    # check `params`, and `params_changed`
         do_history  # save memory
         do_print    # mute printing
-<<<<<<< HEAD
-
-=======
->>>>>>> master
     Returns:
         step_id
         params
         params_changed
-<<<<<<< HEAD
-
-        get_state()
-        set_state()
-
-=======
         get_state()
         set_state()
->>>>>>> master
         get_analytics()
         get_trails()
         get_timehist()
@@ -381,6 +343,7 @@ class Model:
         # Initialise agents
         self.agents = [Agent(self, unique_id) for unique_id in
                        range(self.pop_total)]
+        self.spatial_index = SpatialIndex(self.get_state('location2D'))
 
         if self.do_history:
             self.history_state = []
@@ -459,10 +422,6 @@ class Model:
     def _init_kwargs(dict0, dict1):
         '''
         Internal dictionary update tool
-<<<<<<< HEAD
-
-=======
->>>>>>> master
         dict0 is updated by dict1 adding no new keys.
         dict2 is the changes excluding 'do_' keys.
         '''
@@ -490,6 +449,7 @@ class Model:
             if self.do_print and self.step_id % 100 == 0:
                 print(f'\tIteration: {self.step_id}/{self.step_limit}')
 
+            self.spatial_index.rebuild(self.get_state('location2D'))
             [agent.activate() for agent in self.agents]
 
             [agent.step() for agent in self.agents]
@@ -576,10 +536,6 @@ class Model:
                    'r'), xlim=None, ylim=None):
         '''
         Make a figure showing the trails of the agents.
-<<<<<<< HEAD
-
-=======
->>>>>>> master
         :param plot_axis: Whether to show the axis (default False)
         :param plot_legend: Whether to show the legend (default False)
         :param colours: Optional tuple with three values representing
@@ -651,10 +607,6 @@ class Model:
 
     def get_wiggle_map(self, do_kdeplot=True, title="Collision Map"):
         """ Show where wiggles and collisions took place
-<<<<<<< HEAD
-
-=======
->>>>>>> master
         :param do_kdeplot:
         :param title: (optional) title for the graph
         :return: The figure object
@@ -677,10 +629,6 @@ class Model:
                          color_bar=False, plot_axis=False):
         '''
         Create a density plot of the agents' locations
-<<<<<<< HEAD
-
-=======
->>>>>>> master
         :param do_kdeplot:
         :param title: (optional) title for the plot
         :return:
@@ -786,8 +734,4 @@ if __name__ == '__main__':
                   ". Create a separate script and use that to run experimets "
                   "(e.g. see ABM_DA/experiments/StationSim basic experiment."
                   "ipynb )")
-<<<<<<< HEAD
-    print("Nothing to do")
-=======
     print("Nothing to do")
->>>>>>> master
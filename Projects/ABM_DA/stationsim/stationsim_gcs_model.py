@@ -4,12 +4,19 @@ StationSim - GrandCentral version
     modified: 19/06/2020
 '''
 
+import itertools
+from math import atan2
+from copy import copy
 import warnings
 import numpy as np
 import os
 from scipy.spatial import cKDTree
 import matplotlib.pyplot as plt
 from matplotlib.animation import FuncAnimation
+try:
+    from trajectory_store import STORE_NAME, write_trajectories
+except ImportError:
+    from stationsim.trajectory_store import STORE_NAME, write_trajectories
 # Dont automatically load seaborn as it isn't needed on the HPC
 try:
     from seaborn import kdeplot as sns_kdeplot
@@ -19,11 +26,186 @@ except ImportError:
                   "map) then it will fail.")
 
 
+def _to_step(value):
+    return None if np.isnan(value) else float(value)
+
+
+def _from_step(value):
+    return np.nan if value is None else value
+
+
+class _AgentField:
+    '''
+    Descriptor exposing one column of the model's AgentArrays as an
+    attribute of an Agent.
+
+    Agents that are not bound to any arrays (e.g. the clock) keep the
+    value in their own __dict__, so they behave like plain objects.
+    '''
+
+    def __init__(self, getter=None, setter=None):
+        self.getter = getter
+        self.setter = setter
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, agent, owner=None):
+        if agent is None:
+            return self
+        arrays = agent.__dict__.get('_arrays')
+        if arrays is None:
+            return agent.__dict__[self.name]
+        value = getattr(arrays, self.name)[agent.unique_id]
+        return value if self.getter is None else self.getter(value)
+
+    def __set__(self, agent, value):
+        arrays = agent.__dict__.get('_arrays')
+        if arrays is None:
+            agent.__dict__[self.name] = value
+        else:
+            if self.setter is not None:
+                value = self.setter(value)
+            getattr(arrays, self.name)[agent.unique_id] = value
+
+
+class Station:
+    '''
+    Immutable geometry of a StationSim station.
+
+    Description:
+        Built once by Model.set_station() and shared by the model, its
+        clones and the filters. Holds, as read-only arrays:
+        - the gate locations and widths, and for every gate the unit
+          vector pointing into the station (gate_normals) and the unit
+          vector along the gate (gate_axes);
+        - the two edges of every gate (gate_edges) and their angles seen
+          from the centre of the station (gate_edge_angles);
+        - for every entrance gate, the exit gates an agent may choose
+          (exit_options, exit_gates) and their probabilities
+          (exit_probabilities);
+        - the segment on which an agent of size agent_size enters or
+          leaves through every gate (spawn_low, spawn_high).
+
+    Params:
+        width, height
+        gates_locations     # (G, 2)
+        gates_width         # (G,)
+        exit_options        # (G, G) bool: exit_options[gate_in, gate_out]
+        agent_size
+    '''
+
+    def __init__(self, width, height, gates_locations, gates_width,
+                 exit_options, agent_size):
+        gates_locations = np.array(gates_locations)
+        gates_width = np.array(gates_width)
+        n_gates = len(gates_locations)
+
+        gate_normals = np.zeros((n_gates, 2))
+        gate_axes = np.zeros((n_gates, 2))
+        for gate, (x, y) in enumerate(gates_locations):
+            if (x == 0):
+                gate_normals[gate], gate_axes[gate] = (1, 0), (0, 1)
+            elif (x == width):
+                gate_normals[gate], gate_axes[gate] = (-1, 0), (0, 1)
+            elif (y == 0):
+                gate_normals[gate], gate_axes[gate] = (0, 1), (1, 0)
+            elif (y == height):
+                gate_normals[gate], gate_axes[gate] = (0, -1), (1, 0)
+            else:
+                raise ValueError(f'Invalid gate location: {(x, y)}')
+
+        half_width = gates_width[:, None] / 2
+        gate_edges = np.stack((gates_locations + gate_axes * half_width,
+                               gates_locations - gate_axes * half_width),
+                              axis=1)
+        centre = np.array([width / 2, height / 2])
+        gate_edge_angles = np.array(
+            [[atan2(edge[1] - centre[1], edge[0] - centre[0])
+              for edge in edges] for edges in gate_edges])
+
+        exit_options = np.array(exit_options, dtype=bool)
+        exit_probabilities = (exit_options /
+                              exit_options.sum(axis=1, keepdims=True))
+        spawn_origin = gates_locations + gate_normals * (1.05 * agent_size)
+
+        arrays = dict(gates_locations=gates_locations,
+                      gates_width=gates_width, gate_normals=gate_normals,
+                      gate_axes=gate_axes, gate_edges=gate_edges,
+                      gate_edge_angles=gate_edge_angles, centre=centre,
+                      exit_options=exit_options,
+                      exit_probabilities=exit_probabilities,
+                      spawn_low=spawn_origin - gate_axes * half_width,
+                      spawn_high=spawn_origin + gate_axes * half_width)
+        for name, value in arrays.items():
+            value.flags.writeable = False
+            object.__setattr__(self, name, value)
+        exit_gates = tuple(np.flatnonzero(options)
+                           for options in exit_options)
+        for options in exit_gates:
+            options.flags.writeable = False
+        object.__setattr__(self, 'exit_gates', exit_gates)
+        object.__setattr__(self, 'width', width)
+        object.__setattr__(self, 'height', height)
+        object.__setattr__(self, 'agent_size', agent_size)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Station geometry is immutable.')
+
+    def __len__(self):
+        return len(self.gates_locations)
+
+    def choose_gate_out(self, gate_in):
+        '''
+        Choose at random one of the exit gates available from gate_in.
+        '''
+        if not 0 <= gate_in < len(self):
+            raise ValueError(f'Invalid entrance gates: {gate_in}')
+        return np.random.choice(self.exit_gates[gate_in])
+
+    def get_gate_location(self, gate, size):
+        '''
+        Returns a random location along gate for an agent of the given
+        size, far enough from the wall to fit in the station.
+        '''
+        wd = self.gates_width[gate] / 2.0
+        lateral_perturb = np.random.uniform(-wd, +wd)
+        return (self.gates_locations[gate] +
+                self.gate_normals[gate] * (1.05 * size) +
+                self.gate_axes[gate] * lateral_perturb)
+
+    def get_gate_locations(self, gates, size):
+        '''
+        Returns the (len(gates), 2) random locations of get_gate_location()
+        for many gates at once (drawn in the same order).
+        '''
+        gates = np.asarray(gates, dtype=int)
+        wd = self.gates_width[gates] / 2.0
+        lateral_perturb = np.random.uniform(-wd, +wd)
+        return (self.gates_locations[gates] +
+                self.gate_normals[gates] * (1.05 * size) +
+                self.gate_axes[gates] * lateral_perturb[:, None])
+
+
 class Agent:
     '''
     A class representing a generic agent for the StationSim ABM.
+
+    The agents of a Model are thin views onto the model's AgentArrays:
+    reading `location` returns a copy of the agent's row and assigning to
+    it writes the row back. `loc_desire` is returned as an (x, y) tuple.
     '''
 
+    location = _AgentField(getter=np.array)
+    loc_desire = _AgentField(getter=tuple)
+    speed = _AgentField(getter=float)
+    status = _AgentField(getter=int)
+    gate_in = _AgentField(getter=int)
+    gate_out = _AgentField(getter=int)
+    step_start = _AgentField(getter=_to_step, setter=_from_step)
+    steps_activate = _AgentField(getter=float)
+    size = _AgentField(getter=float)
+
     def __init__(self, model, unique_id):
         '''
         Initialise a new agent.
@@ -40,6 +222,7 @@ class Agent:
             this agent
         '''
         # Required
+        self._arrays = None  # set by AgentArrays.bind()
         self.model = model
         self.unique_id = unique_id
         self.status = 0  # 0 Not Started, 1 Active, 2 Finished
@@ -60,7 +243,6 @@ class Agent:
         self.steps_activate = self.unique_id * 25.0 / model.birth_rate
 
         # History
-        self.history_locations = []
         self.step_start = None
         self.step_end = None
         if model.do_history:
@@ -79,37 +261,7 @@ class Agent:
 
         if gate_in is None:
             gate_in = self.gate_in
-
-        if (self.model.station == 'Grand_Central'):
-            # Use set differences to allocate gate_out on different side to
-            # gate_in
-            gate_out = self.choose_gate_out_gcs(gate_in)
-        else:
-            random_gate_out = np.random.randint(self.model.gates_out)
-            gate_out = random_gate_out + self.model.gates_in
-        return gate_out
-
-    @staticmethod
-    def choose_gate_out_gcs(gate_in):
-        gates_left = {0}
-        gates_top = {1, 2}
-        gates_right = {3, 4, 5, 6}
-        gates_bottom = {7, 8, 9, 10}
-        all_gates = [gates_left, gates_top, gates_right, gates_bottom]
-        gates = set().union(*all_gates)
-
-        if (gate_in in gates_left):
-            options = list(gates - gates_left)
-        elif (gate_in in gates_top):
-            options = list(gates - gates_top)
-        elif (gate_in in gates_right):
-            options = list(gates - gates_right)
-        elif (gate_in in gates_bottom):
-            options = list(gates - gates_bottom)
-        else:
-            raise ValueError(f'Invalid entrance gates: {gate_in}')
-        gate_out = np.random.choice(options)
-        return gate_out
+        return self.model.geometry.choose_gate_out(gate_in)
 
     def step(self, time):
         '''
@@ -118,9 +270,7 @@ class Agent:
         Description:
             If they are active then they move and maybe leave the model.
         '''
-        if self.status == 1:
-            self.move(time)
-            self.deactivate()
+        self._arrays.step(time, [self.unique_id])
 
     def activate(self):
         '''
@@ -132,23 +282,7 @@ class Agent:
         different from the position of all active agents. If it was not
         possible, activate the agent on next time step.
         '''
-        if self.status == 0:
-            if self.model.total_time > self.steps_activate:
-                state = self.model.get_state('location2D')
-                self.model.tree = cKDTree(state)
-                for _ in range(10):
-                    new_location = self.set_agent_location(self.gate_in)
-                    neighbour_agents = self.model.tree.query_ball_point(
-                        new_location, self.size*1.1)
-                    if (neighbour_agents == [] or
-                            neighbour_agents == [self.unique_id]):
-                        self.location = new_location
-                        self.status = 1
-                        self.model.pop_active += 1
-                        # self.model.step_id
-                        self.step_start = self.model.total_time
-                        self.loc_start = self.location
-                        break
+        self._arrays.activate([self.unique_id])
 
     def set_agent_location(self, gate):
         '''
@@ -157,33 +291,7 @@ class Agent:
             It is necessary to ensure that the agent has a distance from
             the station wall compatible with its own size.
         '''
-        wd = self.model.gates_width[gate] / 2.0
-        lateral_perturb = np.random.uniform(-wd, +wd)
-        wall_offset = 1.05 * self.size
-        gate_location = self.model.gates_locations[gate]
-
-        if(gate_location[0] == 0):
-            perturb = np.array([wall_offset, lateral_perturb])
-        elif(gate_location[0] == self.model.width):
-            perturb = np.array([-wall_offset, lateral_perturb])
-        elif(gate_location[1] == 0):
-            perturb = np.array([lateral_perturb, wall_offset])
-        elif(gate_location[1] == self.model.height):
-            perturb = np.array([lateral_perturb, -wall_offset])
-        else:
-            raise ValueError(f'Invalid gate location: {gate_location}')
-
-        new_location = gate_location + perturb
-        # print(gate_location, perturb, new_location)
-        # '''
-        #     As there are gates near the corners it is possible to create
-        #     a position outside the station. To fix this, rebound:
-        # '''
-        # if not self.model.is_within_bounds(self, new_location):
-        #     print('bounce')
-        #     new_location = self.model.re_bound(self, new_location)
-
-        return new_location
+        return self.model.geometry.get_gate_location(gate, self.size)
 
     @staticmethod
     def distance(loc1, loc2):
@@ -228,8 +336,7 @@ class Agent:
         maximum distance they can given their maximum possible speed
         (self.speed_desire) and the time_step.
         '''
-        direction = self.get_direction(self.loc_desire, self.location)
-        self.location = self.location + self.speed * direction * time_step
+        self._arrays.move(time_step, [self.unique_id])
 
     def set_wiggle(self):
         '''
@@ -248,8 +355,6 @@ class Agent:
         '''
         direction = self.get_direction(self.loc_desire, self.location)
 
-        state = self.model.get_state('location2D')
-        self.model.tree = cKDTree(state)
         for _ in range(10):
             normal_direction = self.get_normal_direction(direction)
             new_location = self.location +\
@@ -263,23 +368,23 @@ class Agent:
             # collision_map
             if self.model.do_history:
                 self.history_collisions += 1
-                self.model.history_collision_locs.append(new_location)
-                tt = self.model.total_time
-                self.model.history_collision_times.append(tt)
+                self.model.history.record_collision(new_location,
+                                                    self.model.total_time)
 
             # Check if the new location is possible
-            tree = self.model.tree
-            neighbouring_agents = tree.query_ball_point(new_location,
-                                                        self.size*1.1)
+            spatial_index = self.model.spatial_index
+            neighbouring_agents = spatial_index.query_ball_point(
+                new_location, self.size*1.1)
             dist = self.distance(new_location, self.model.clock.location)
             if (dist > (self.size + self.model.clock.size)):
                 if (neighbouring_agents == [] or
                         neighbouring_agents == [self.unique_id]):
                     self.location = new_location
+                    spatial_index.move(self.unique_id, new_location)
                     # wiggle_map
                     if self.model.do_history:
                         self.history_wiggles += 1
-                        self.model.history_wiggle_locs.append(new_location)
+                        self.model.history.record_wiggle(new_location)
                     break
 
             '''
@@ -300,83 +405,728 @@ class Agent:
         Determine whether the agent should leave the model and, if so,
         remove them. Otherwise do nothing.
         '''
-        dist = self.distance(self.location, self.loc_desire)
-        if dist < self.model.gates_space:
-            if self.model.do_print:
-                print('deactivating agent')
-            self.status = 2
-            self.step_end = self.model.total_time
-            self.model.pop_active -= 1
-            self.model.pop_finished += 1
-            if self.model.do_history:
-                steps_exped = (self.distance(self.loc_start, self.loc_desire) -
-                               self.model.gates_space) / self.speeds[0]
-                self.model.steps_exped.append(steps_exped)
-                steps_taken = self.model.total_time - self.step_start
-                self.model.steps_taken.append(steps_taken)
-                steps_delay = steps_taken - steps_exped
-                self.model.steps_delay.append(steps_delay)
+        self._arrays.deactivate([self.unique_id])
 
-    def history(self):
+    @property
+    def history_locations(self):
         '''
-        Save agent location.
+        The recorded locations (steps, 2) of the agent, NaN where it was
+        not active.
         '''
-        if self.status == 1:
-            self.history_locations.append(self.location)
-        else:
-            self.history_locations.append((None, None))
+        if not self.model.do_history:
+            return np.empty((0, 2))
+        return self.model.history.locations[:, self.unique_id]
 
     def get_collisionTime2Agents(self, agentB):
         '''
         Returns the collision time between two agents.
         '''
-        tmin = 1.0e300
-
         rAB = self.location - agentB.location
         directionA = self.get_direction(self.loc_desire, self.location)
         directionB = agentB.get_direction(agentB.loc_desire, agentB.location)
-        sizeAB = self.size + agentB.size
-
-        vA = self.speed
-        vB = agentB.speed
-        vAB = vA*directionA - vB*directionB
-        bAB = np.dot(vAB, rAB)
-        if bAB < 0.0:
-            delta = bAB**2 - (np.dot(vAB, vAB)*(np.dot(rAB, rAB) - sizeAB**2))
-            if (delta > 0.0):
-                collisionTime = abs((-bAB - np.sqrt(delta)) / np.dot(vAB, vAB))
-                tmin = collisionTime
-
-        return tmin
+        vAB = self.speed*directionA - agentB.speed*directionB
+        return collision_time_agents(rAB, vAB, self.size + agentB.size)
 
     def get_collisionTimeWall(self):
         '''
         Returns the shortest collision time between an agent and a wall.
         '''
-        tmin = 1.0e300
-        collisionTime = 1.0e300
-
         direction = self.get_direction(self.loc_desire, self.location)
-        vx = self.speed * direction[0]  # horizontal velocity
-        vy = self.speed * direction[1]  # vertical velocity
-
-        if(vy > 0):  # collision in botton wall
-            collisionTime = (self.model.height - self.size -
-                             self.location[1]) / vy
-        elif (vy < 0):  # collision in top wall
-            collisionTime = (self.size - self.location[1]) / vy
-        if (collisionTime < tmin):
-            tmin = collisionTime
-        if(vx > 0):  # collision in right wall
-            collisionTime = (self.model.width - self.size -
-                             self.location[0]) / vx
-        elif (vx < 0):  # collision in left wall
-            collisionTime = (self.size - self.location[0]) / vx
-        if (collisionTime < tmin):
+        return collision_time_wall(self.location, self.speed * direction,
+                                   self.size, self.model.width,
+                                   self.model.height)
+
+
+def collision_time_agents(rAB, vAB, sizeAB):
+    '''
+    Returns the collision time between two discs with relative position
+    rAB, relative velocity vAB and summed radii sizeAB (1.0e300 if they
+    never collide).
+    '''
+    tmin = 1.0e300
+    bAB = np.dot(vAB, rAB)
+    if bAB < 0.0:
+        delta = bAB**2 - (np.dot(vAB, vAB)*(np.dot(rAB, rAB) - sizeAB**2))
+        if (delta > 0.0):
+            collisionTime = abs((-bAB - np.sqrt(delta)) / np.dot(vAB, vAB))
             tmin = collisionTime
 
+    return tmin
+
+
+def collision_time_wall(location, velocity, size, width, height):
+    '''
+    Returns the shortest collision time between a disc of radius size,
+    moving with the given velocity, and the walls of a width x height
+    station.
+    '''
+    tmin = 1.0e300
+    collisionTime = 1.0e300
+
+    vx = velocity[0]  # horizontal velocity
+    vy = velocity[1]  # vertical velocity
+
+    if(vy > 0):  # collision in botton wall
+        collisionTime = (height - size - location[1]) / vy
+    elif (vy < 0):  # collision in top wall
+        collisionTime = (size - location[1]) / vy
+    if (collisionTime < tmin):
+        tmin = collisionTime
+    if(vx > 0):  # collision in right wall
+        collisionTime = (width - size - location[0]) / vx
+    elif (vx < 0):  # collision in left wall
+        collisionTime = (size - location[0]) / vx
+    if (collisionTime < tmin):
+        tmin = collisionTime
+
+    return tmin
+
+
+def collision_times_agents(rAB, vAB, sizeAB):
+    '''
+    Vectorised collision_time_agents: returns the collision times of k
+    pairs of discs given their relative positions and velocities (k, 2)
+    and summed radii (k,).
+    '''
+    tmin = np.full(len(rAB), 1.0e300)
+    bAB = np.einsum('ij,ij->i', vAB, rAB)
+    vAB2 = np.einsum('ij,ij->i', vAB, vAB)
+    delta = bAB**2 - vAB2*(np.einsum('ij,ij->i', rAB, rAB) - sizeAB**2)
+    collide = (bAB < 0.0) & (delta > 0.0)
+    tmin[collide] = np.abs((-bAB[collide] - np.sqrt(delta[collide])) /
+                           vAB2[collide])
+    return tmin
+
+
+def collision_times_wall(location, velocity, size, width, height):
+    '''
+    Vectorised collision_time_wall for k discs with locations and
+    velocities (k, 2) and radii (k,).
+    '''
+    tmin = np.full(len(location), 1.0e300)
+    upper = np.array([width, height]) - size[:, None]
+    lower = np.broadcast_to(size[:, None], location.shape)
+    for axis in (1, 0):
+        v = velocity[:, axis]
+        wall = np.where(v > 0, upper[:, axis], lower[:, axis])
+        moving = v != 0
+        collisionTime = (wall[moving] - location[moving, axis]) / v[moving]
+        tmin[moving] = np.minimum(tmin[moving], collisionTime)
+    return tmin
+
+
+def collision_times(location, velocity, size, pairs, clock_location,
+                    clock_size, width, height):
+    '''
+    Batched collision kernel.
+
+    Description:
+        Computes, in one pass over arrays, the collision times of every
+        agent with the walls and with the (static) clock, and of every
+        candidate pair of agents.
+
+    Params:
+        location, velocity  # (n, 2) arrays for the agents
+        size                # (n,) array of agent radii
+        pairs               # (i, j) index arrays of the candidate pairs
+        clock_location, clock_size, width, height
+
+    Returns:
+        wall_times      # (n,)
+        clock_times     # (n,)
+        pair_times      # (len(i),)
+    '''
+    i, j = pairs
+    wall_times = collision_times_wall(location, velocity, size, width, height)
+    clock_times = collision_times_agents(location - clock_location, velocity,
+                                         size + clock_size)
+    pair_times = collision_times_agents(location[i] - location[j],
+                                        velocity[i] - velocity[j],
+                                        size[i] + size[j])
+    return wall_times, clock_times, pair_times
+
+
+def get_directions(location, loc_desire):
+    '''
+    Returns the unit vectors (k, 2) pointing from location to loc_desire
+    (zero where the two coincide).
+    '''
+    x = loc_desire[:, 0] - location[:, 0]
+    y = loc_desire[:, 1] - location[:, 1]
+    distance = (x*x + y*y)**.5
+    direction = np.zeros_like(location)
+    np.divide(loc_desire - location, distance[:, None], out=direction,
+              where=(distance != 0)[:, None])
+    return direction
+
+
+class SpatialIndex:
+    '''
+    Neighbour index over the locations of the agents of a model.
+
+    Description:
+        A KD-tree over a snapshot of the agents' locations, owned by the
+        model and rebuilt explicitly with rebuild() (once per sub-step).
+        Agents that move between rebuilds (an activation or a wiggle)
+        must be reported with move(); their new locations are kept aside
+        and checked directly by every query, so queries always reflect
+        the current locations. Once more than max_moved agents have
+        moved, the tree is rebuilt with the new locations.
+
+    Params:
+        locations   # (n, 2) array-like of agent locations
+        max_moved   # moves kept aside before the tree is rebuilt
+    '''
+
+    def __init__(self, locations, max_moved=32):
+        self.max_moved = max_moved
+        self.rebuild(locations)
+
+    def rebuild(self, locations):
+        '''
+        Rebuild the tree over the given agent locations.
+        '''
+        self.tree = cKDTree(np.asarray(locations, dtype=float),
+                            copy_data=True)
+        self.moved = dict()
+
+    def move(self, unique_id, location):
+        '''
+        Update the location of one agent in place.
+        '''
+        self.moved[unique_id] = np.asarray(location, dtype=float)
+        if len(self.moved) > self.max_moved:
+            locations = self.tree.data.copy()
+            for i, location in self.moved.items():
+                locations[i] = location
+            self.rebuild(locations)
+
+    def query_ball_point(self, location, radius):
+        '''
+        Returns the (sorted) unique_id of the agents within radius of
+        location.
+        '''
+        moved = self.moved
+        neighbours = [i for i in self.tree.query_ball_point(location, radius)
+                      if i not in moved]
+        for i, moved_location in moved.items():
+            x = moved_location[0] - location[0]
+            y = moved_location[1] - location[1]
+            if x*x + y*y <= radius*radius:
+                neighbours.append(i)
+        return sorted(neighbours)
+
+
+class HistoryRecorder:
+    '''
+    Array-backed record of the history of a StationSim model.
+
+    Description:
+        Once per step, record() writes the locations of all the agents
+        and which of them are active into preallocated arrays of shape
+        (steps, pop_total, 2) and (steps, pop_total). Collisions and
+        wiggles go into flat event arrays. All the arrays double in size
+        whenever they fill up.
+
+        If filename is given, the per-step arrays are memory-mapped to
+        '<filename>.state.dat' and '<filename>.active.dat' rather than
+        kept in memory (the event arrays stay in memory).
+
+    Params:
+        pop_total
+        dtype       # of the recorded locations (default float32)
+        filename    # optional prefix of the memory-mapped files
+        capacity    # initial number of steps
+
+    Returns:
+        state           # (steps, pop_total, 2) locations of all agents
+        locations       # the same, with NaN for the inactive agents
+        active          # (steps, pop_total) bool
+        collision_locs, collision_times, wiggle_locs
+    '''
+
+    def __init__(self, pop_total, dtype=np.float32, filename=None,
+                 capacity=1024):
+        self.dtype = np.dtype(dtype)
+        self.filename = filename
+        self._buffers = dict()
+        self._sizes = dict()
+        self._allocate('state', (capacity, pop_total, 2), self.dtype)
+        self._allocate('active', (capacity, pop_total), bool)
+        self._allocate('collision_locs', (capacity, 2), self.dtype)
+        self._allocate('collision_times', (capacity,), float)
+        self._allocate('wiggle_locs', (capacity, 2), self.dtype)
+
+    def _is_mapped(self, name):
+        return self.filename is not None and name in ('state', 'active')
+
+    def _allocate(self, name, shape, dtype):
+        if self._is_mapped(name):
+            path = f'{self.filename}.{name}.dat'
+            self._buffers[name] = np.memmap(path, dtype=dtype, mode='w+',
+                                            shape=shape)
+        else:
+            self._buffers[name] = np.empty(shape, dtype=dtype)
+        self._sizes[name] = 0
+
+    def _grow(self, name):
+        old = self._buffers[name]
+        shape = (2 * len(old),) + old.shape[1:]
+        if self._is_mapped(name):
+            # Rows are contiguous, so extending the file keeps them
+            old.flush()
+            path = f'{self.filename}.{name}.dat'
+            with open(path, 'r+b') as f:
+                f.truncate(int(np.prod(shape)) * old.dtype.itemsize)
+            new = np.memmap(path, dtype=old.dtype, mode='r+', shape=shape)
+        else:
+            new = np.empty(shape, dtype=old.dtype)
+            new[:len(old)] = old
+        self._buffers[name] = new
+
+    def _append(self, name, value):
+        n = self._sizes[name]
+        if n == len(self._buffers[name]):
+            self._grow(name)
+        self._buffers[name][n] = value
+        self._sizes[name] = n + 1
+
+    def _get(self, name):
+        return self._buffers[name][:self._sizes[name]]
+
+    def __len__(self):
+        return self._sizes['state']
+
+    def record(self, location, active):
+        '''
+        Record the locations (pop_total, 2) of the agents at one step,
+        and which of them are active.
+        '''
+        self._append('state', location)
+        self._append('active', active)
+
+    def record_collision(self, location, time):
+        self._append('collision_locs', location)
+        self._append('collision_times', time)
+
+    def record_wiggle(self, location):
+        self._append('wiggle_locs', location)
+
+    @property
+    def state(self):
+        return self._get('state')
+
+    @property
+    def active(self):
+        return self._get('active')
+
+    @property
+    def locations(self):
+        return np.where(self.active[:, :, None], self.state, np.nan)
+
+    @property
+    def collision_locs(self):
+        return self._get('collision_locs')
+
+    @property
+    def collision_times(self):
+        return self._get('collision_times')
+
+    @property
+    def wiggle_locs(self):
+        return self._get('wiggle_locs')
+
+    def arrays(self):
+        '''
+        Returns the recorded arrays (state, active and the event
+        arrays), e.g. to save them.
+        '''
+        return {name: np.array(self._get(name)) for name in self._buffers}
+
+    def load(self, arrays):
+        '''
+        Replace the record with the arrays returned by arrays().
+        '''
+        for name, array in arrays.items():
+            while len(self._buffers[name]) < len(array):
+                self._grow(name)
+            self._buffers[name][:len(array)] = array
+            self._sizes[name] = len(array)
+
+    def copy(self):
+        '''
+        Returns an in-memory copy of the recorder.
+        '''
+        recorder = copy(self)
+        recorder.filename = None
+        recorder._buffers = {name: np.array(buffer)
+                             for name, buffer in self._buffers.items()}
+        recorder._sizes = dict(self._sizes)
+        return recorder
+
+
+class AgentArrays:
+    '''
+    Struct-of-arrays storage for the agents of a StationSim model.
+
+    Description:
+        Holds the dynamic state of every agent in contiguous NumPy arrays
+        (one row per agent, indexed by agent.unique_id) so that the
+        model can activate, move and deactivate the whole population at
+        once. The Agent objects in model.agents remain available as thin
+        views onto these arrays (see Agent).
+
+    Params:
+        model       # the model owning the agents
+        agents      # the Agent objects to bind to the arrays
+    '''
+
+    fields = ('location', 'loc_desire', 'speed', 'status', 'gate_in',
+              'gate_out', 'step_start', 'steps_activate', 'size')
+
+    def __init__(self, model, agents):
+        self.model = model
+        n = len(agents)
+        self.location = np.zeros((n, 2))
+        self.loc_desire = np.zeros((n, 2))
+        self.speed = np.zeros(n)
+        self.status = np.zeros(n, dtype=int)
+        self.gate_in = np.zeros(n, dtype=int)
+        self.gate_out = np.zeros(n, dtype=int)
+        self.step_start = np.full(n, np.nan)
+        self.steps_activate = np.zeros(n)
+        self.size = np.zeros(n)
+        self.agents = agents
+        for agent in agents:
+            self.bind(agent)
+
+    def __len__(self):
+        return len(self.status)
+
+    def bind(self, agent):
+        '''
+        Move the attributes of a free-standing agent into the arrays and
+        make the agent a view onto its row.
+        '''
+        values = {name: agent.__dict__.pop(name) for name in self.fields}
+        agent._arrays = self
+        for name, value in values.items():
+            setattr(agent, name, value)
+
+    def _select(self, index, mask):
+        '''
+        Returns the indices of the agents (optionally restricted to
+        index) for which mask is true.
+        '''
+        if index is None:
+            return np.flatnonzero(mask)
+        index = np.asarray(index, dtype=int)
+        return index[mask[index]]
+
+    def get_directions(self, index=slice(None)):
+        '''
+        Returns the unit vectors pointing from the agents' locations to
+        their desired locations (zero for agents already there).
+        '''
+        return get_directions(self.location[index], self.loc_desire[index])
+
+    def get_velocities(self, index=slice(None)):
+        '''
+        Returns the velocity (speed * direction) of the agents.
+        '''
+        return self.speed[index, None] * self.get_directions(index)
+
+    def activate(self, index=None):
+        '''
+        Activate the agents whose activation time has passed.
+
+        Each candidate gets up to 10 attempts at an entrance location
+        that does not overlap another agent; candidates are processed in
+        unique_id order so that agents activated earlier in the same call
+        are taken into account. Otherwise, the agent is activated on the
+        next time step.
+        '''
+        model = self.model
+        ready = (self.status == 0) & (model.total_time > self.steps_activate)
+        for i in self._select(index, ready):
+            agent = self.agents[i]
+            for _ in range(10):
+                new_location = agent.set_agent_location(self.gate_in[i])
+                neighbour_agents = model.spatial_index.query_ball_point(
+                    new_location, agent.size*1.1)
+                if (neighbour_agents == [] or neighbour_agents == [i]):
+                    self.location[i] = new_location
+                    model.spatial_index.move(i, new_location)
+                    self.status[i] = 1
+                    model.pop_active += 1
+                    self.step_start[i] = model.total_time
+                    agent.loc_start = self.location[i].copy()
+                    break
+
+    def move(self, time_step, index=None):
+        '''
+        Move the active agents towards their destination, each at its
+        own speed, for time_step.
+        '''
+        active = self._select(index, self.status == 1)
+        self.location[active] += (self.get_velocities(active) *
+                                  time_step)
+
+    def deactivate(self, index=None):
+        '''
+        Deactivate the active agents that have reached their
+        destination.
+        '''
+        model = self.model
+        active = self._select(index, self.status == 1)
+        location = self.location[active]
+        x = location[:, 0] - self.loc_desire[active, 0]
+        y = location[:, 1] - self.loc_desire[active, 1]
+        finished = active[(x*x + y*y)**.5 < model.gates_space]
+        if len(finished) == 0:
+            return
+        if model.do_print:
+            for _ in finished:
+                print('deactivating agent')
+        self.status[finished] = 2
+        model.pop_active -= len(finished)
+        model.pop_finished += len(finished)
+        for i in finished:
+            agent = self.agents[i]
+            agent.step_end = model.total_time
+            if model.do_history:
+                steps_exped = (agent.distance(agent.loc_start,
+                                              self.loc_desire[i]) -
+                               model.gates_space) / agent.speeds[0]
+                model.steps_exped.append(steps_exped)
+                steps_taken = model.total_time - self.step_start[i]
+                model.steps_taken.append(steps_taken)
+                steps_delay = steps_taken - steps_exped
+                model.steps_delay.append(steps_delay)
+
+    def step(self, time, index=None):
+        '''
+        Move the active agents and deactivate those that arrived.
+        '''
+        active = self._select(index, self.status == 1)
+        self.move(time, active)
+        self.deactivate(active)
+
+
+class CollisionScheduler:
+    '''
+    Event-driven collision scheduler for one step of a Model.
+
+    Description:
+        Keeps, for every active agent, its next predicted collision event
+        (agent-wall, agent-clock or agent-agent) and the partner involved.
+        While agents move in a straight line towards their destination
+        their predicted collision times simply shift with the elapsed
+        time, so after a collision only the events of the agents that
+        wiggled are recomputed, together with the agents whose next event
+        was with one of them (or with an agent that has left). The next
+        collision of the model is the earliest of these per-agent events.
+
+        Events are stored as absolute times measured from the start of
+        the step (next_time). The exception are pairs of agents that
+        already overlap: collision_time_agents then returns the time
+        since they started to overlap, which grows with time until their
+        closest approach (after which they never collide). Those events
+        are stored as their value at the start of the step
+        (overlap_time), and the agents are recomputed once the closest
+        approach has passed (expiry).
+
+    Params:
+        model   # the Model being stepped
+        time    # the time budget of the step (usually 1.0)
+    '''
+
+    NONE = -3
+    CLOCK = -2
+    WALL = -1
+
+    def __init__(self, model, time=1.0):
+        self.model = model
+        self.arrays = model.agent_arrays
+        self.time = time
+        self.now = 0.0
+        n = len(self.arrays)
+        self.next_time = np.full(n, np.inf)
+        self.partner = np.full(n, self.NONE)
+        self.overlap_time = np.full(n, np.inf)
+        self.overlap_partner = np.full(n, self.NONE)
+        self.expiry = np.full(n, np.inf)
+        self.collisionTable = None
+        self.candidates = None
+        self.tree_agents = np.flatnonzero(self.arrays.status == 1)
+        self.tree = cKDTree(self.arrays.location[self.tree_agents],
+                            copy_data=True)
+        self.schedule(self.tree_agents)
+
+    def get_times(self):
+        '''
+        Returns the time from now to the next event of every agent.
+        '''
+        return np.minimum(self.next_time - self.now,
+                          self.overlap_time + self.now)
+
+    def schedule(self, agents):
+        '''
+        Recompute the next event of the given agents (and of the agents
+        whose next event involved one of them).
+        '''
+        model, arrays = self.model, self.arrays
+        active = arrays.status == 1
+        stale = np.zeros(len(active), dtype=bool)
+        stale[agents] = True
+        for partner in (self.partner, self.overlap_partner):
+            has_partner = partner >= 0
+            partner = partner[has_partner]
+            stale[has_partner] |= stale[partner] | ~active[partner]
+        stale &= active
+        agents = np.flatnonzero(stale)
+        for events in (self.next_time, self.overlap_time, self.expiry):
+            events[agents] = np.inf
+        self.partner[agents] = self.NONE
+        self.overlap_partner[agents] = self.NONE
+        if len(agents) == 0:
+            return
+
+        active = np.flatnonzero(active)
+        if len(agents) == len(active):
+            i, j = model.get_collisionCandidates(active,
+                                                 self.time - self.now)
+        else:
+            i, j = self._get_candidates(agents, active)
+
+        location, size = arrays.location, arrays.size
+        velocity = arrays.get_velocities()
+        clock_location = np.asarray(model.clock.location)
+        wall_times = collision_times_wall(location[agents], velocity[agents],
+                                          size[agents], model.width,
+                                          model.height)
+        self._set_events(agents, np.full(len(agents), self.WALL), wall_times,
+                         self.next_time, self.partner)
+        self._set_agent_events(
+            np.concatenate((agents, i, j)),
+            np.concatenate((np.full(len(agents), self.CLOCK), j, i)),
+            np.concatenate((location[agents] - clock_location,
+                            location[i] - location[j],
+                            location[i] - location[j])),
+            np.concatenate((velocity[agents], velocity[i] - velocity[j],
+                            velocity[i] - velocity[j])),
+            np.concatenate((size[agents] + model.clock.size,
+                            size[i] + size[j], size[i] + size[j])))
+
+    def _set_agent_events(self, agents, partners, rAB, vAB, sizeAB):
+        '''
+        Record the collisions of agents with other agents (or the clock)
+        given their relative positions and velocities.
+        '''
+        times = collision_times_agents(rAB, vAB, sizeAB)
+        overlap = ((np.einsum('ij,ij->i', rAB, rAB) < sizeAB**2) &
+                   (times < 1.0e300))
+        self._set_events(agents[~overlap], partners[~overlap],
+                         self.now + times[~overlap],
+                         self.next_time, self.partner)
+        self._set_events(agents[overlap], partners[overlap],
+                         times[overlap] - self.now,
+                         self.overlap_time, self.overlap_partner)
+        # Closest approach, after which overlapping agents never collide
+        rAB, vAB = rAB[overlap], vAB[overlap]
+        closest = (self.now - np.einsum('ij,ij->i', vAB, rAB) /
+                   np.einsum('ij,ij->i', vAB, vAB))
+        np.minimum.at(self.expiry, agents[overlap], closest)
+
+    @staticmethod
+    def _set_events(agents, partners, times, next_time, next_partner):
+        '''
+        Keep, for each agent, the earliest of its current and new events.
+        '''
+        collide = times < 1.0e300
+        agents, partners = agents[collide], partners[collide]
+        times = times[collide]
+        order = np.lexsort((times, agents))
+        agents, first = np.unique(agents[order], return_index=True)
+        times, partners = times[order][first], partners[order][first]
+        earlier = times < next_time[agents]
+        next_time[agents[earlier]] = times[earlier]
+        next_partner[agents[earlier]] = partners[earlier]
+
+    def _get_candidates(self, agents, active):
+        '''
+        Returns the pairs (i, j) with i in agents and j any other active
+        agent that can meet within the rest of the step (see
+        Model.get_collisionCandidates). Pairs with both agents in agents
+        are returned once.
+        '''
+        arrays = self.arrays
+        horizon = self.time - self.now + self.model.tolerance
+        reach = 2 * (arrays.speed[active].max() * horizon +
+                     arrays.size[active].max())
+        # The tree holds the locations at the start of the step: widen
+        # the search by the largest displacement since then
+        displacement = arrays.location[self.tree_agents] - self.tree.data
+        reach += np.sqrt(np.einsum('ij,ij->i', displacement,
+                                   displacement).max(initial=0))
+        neighbours = self.tree.query_ball_point(arrays.location[agents],
+                                                reach)
+        counts = [len(n) for n in neighbours]
+        i = np.repeat(agents, counts)
+        j = self.tree_agents[
+            np.fromiter(itertools.chain.from_iterable(neighbours),
+                        dtype=int, count=sum(counts))]
+        # Do not pair an agent with itself, nor count a pair twice (nor
+        # with agents that have left)
+        recomputed = np.zeros(len(arrays), dtype=bool)
+        recomputed[agents] = True
+        keep = (~recomputed[j] | (i < j)) & (arrays.status[j] == 1)
+        return i[keep], j[keep]
+
+    def get_tmin(self):
+        '''
+        Returns the time from now to the next collision, with the same
+        conventions as Model.get_collisionTable.
+        '''
+        active = self.arrays.status == 1
+        tmin = self.get_times()[active].min(initial=np.inf)
+        self.collisionTable = None
+        # The agents that may wiggle at tmin, including those that leave
+        # while moving up to it (as in the collision table)
+        self.candidates = active
+        if tmin == np.inf:
+            return 1.0e300
+        if tmin <= 1.0e-10:
+            # Events already overdue: let the full table decide which
+            # agents wiggle, since agents may have later events within
+            # the wiggle tolerance that are not their next event.
+            self.collisionTable, tmin = self.model.get_collisionTable(
+                self.time - self.now)
         return tmin
 
+    def get_wiggleTable(self, time):
+        '''
+        Returns the unique_id of all agents with an event within the
+        wiggle tolerance of time (see Model.get_wiggleTable).
+        '''
+        if self.collisionTable is not None:
+            return self.model.get_wiggleTable(self.collisionTable, time)
+        wiggle = (self.candidates &
+                  (np.abs(self.get_times() - time) < self.model.tolerance))
+        return set(np.flatnonzero(wiggle).tolist())
+
+    def advance(self, time, wiggled=()):
+        '''
+        Move the scheduler clock forward by time and recompute the events
+        of the agents that wiggled, or whose overlap with another agent
+        has ended.
+        '''
+        self.now += time
+        agents = self.expiry <= self.now
+        agents[list(wiggled)] = True
+        if agents.any():
+            self.schedule(np.flatnonzero(agents))
+
 
 class Model:
     '''
@@ -429,7 +1179,11 @@ class Model:
             'do_print': True,
             'random_seed': int.from_bytes(os.urandom(4), byteorder='little'),
             'tolerance': 0.1,  # new parameter
-            'station': None
+            'station': None,
+            'do_vectorised_collisions': True,
+            'do_event_scheduler': False,
+            'history_dtype': np.float32,
+            'history_file': None
         }
 
         # Defaults for old mode
@@ -520,12 +1274,13 @@ class Model:
         # Initialise agents
         self.agents = [Agent(self, unique_id) for unique_id in
                        range(self.pop_total)]
+        self.agent_arrays = AgentArrays(self, self.agents)
+        self.spatial_index = SpatialIndex(self.agent_arrays.location)
 
         if self.do_history:
-            self.history_state = []
-            self.history_wiggle_locs = []
-            self.history_collision_locs = []
-            self.history_collision_times = []
+            self.history = HistoryRecorder(self.pop_total,
+                                           self.history_dtype,
+                                           self.history_file)
             self.steps_taken = []
             self.steps_exped = []
             self.steps_delay = []
@@ -578,6 +1333,14 @@ class Model:
             self.gates_right = [3, 4, 5, 6]
             self.gates_bottom = [7, 8, 9, 10]
 
+            # Agents leave through any gate on a different side
+            side = np.zeros(self.gates_in, dtype=int)
+            for i, gates in enumerate([self.gates_left, self.gates_top,
+                                       self.gates_right, self.gates_bottom]):
+                side[gates] = i
+            exit_options = side[:, None] != side[None, :]
+            self.set_geometry(exit_options)
+
             # Set up clock
             self.clock = Agent(self, self.pop_total)
             self.clock.size = 56.0  # 4 m
@@ -591,6 +1354,12 @@ class Model:
                 Model._gates_init(self.width, self.height, self.gates_out)])
             self.gates_width = [20 for _ in range(len(self.gates_locations))]
 
+            # Agents leave through any of the exit gates
+            exit_options = np.zeros((len(self.gates_locations),) * 2,
+                                    dtype=bool)
+            exit_options[:, self.gates_in:] = True
+            self.set_geometry(exit_options)
+
             # create a clock outside the station.
             self.clock = Agent(self, self.pop_total)
             self.clock.speed = 0.0
@@ -602,6 +1371,18 @@ class Model:
                     RuntimeWarning
                 )
 
+    def set_geometry(self, exit_options):
+        '''
+        Build the (immutable) Station geometry from the gates of the
+        model, and share its arrays as the model's gates_locations and
+        gates_width.
+        '''
+        self.geometry = Station(self.width, self.height,
+                                self.gates_locations, self.gates_width,
+                                exit_options, self.agent_size)
+        self.gates_locations = self.geometry.gates_locations
+        self.gates_width = self.geometry.gates_width
+
     def is_within_bounds(self, agent, loc):
         return all((self.boundaries[0] + agent.size*2.0) < loc) and\
                all(loc < (self.boundaries[1] - agent.size*2.0))
@@ -642,27 +1423,46 @@ class Model:
                 self.step_id < self.step_limit and self.status == 1:
             if self.do_print and self.step_id % 100 == 0:
                 print(f'\tIteration: {self.step_id}/{self.step_limit}')
-            [agent.activate() for agent in self.agents]
+            self.spatial_index.rebuild(self.agent_arrays.location)
+            self.agent_arrays.activate()
 
             t = 1.0
+            start_time = self.total_time
+            if self.do_event_scheduler:
+                scheduler = CollisionScheduler(self, t)
             while (t > 0):
-                collisionTable, tmin = self.get_collisionTable()
+                if self.do_event_scheduler:
+                    tmin = scheduler.get_tmin()
+                else:
+                    collisionTable, tmin = self.get_collisionTable(t)
                 if (tmin > t):
-                    [agent.step(t) for agent in self.agents]
+                    self.agent_arrays.step(t)
                     self.total_time += t
                     t -= tmin
                 else:
                     tmin *= 0.98  # stop just before the collision
                     t -= tmin
-                    [agent.step(tmin) for agent in self.agents]
-                    wiggleTable = self.get_wiggleTable(collisionTable, tmin)
-                    [self.agents[i].set_wiggle() for i in wiggleTable]
+                    self.agent_arrays.step(tmin)
+                    self.spatial_index.rebuild(self.agent_arrays.location)
+                    if self.do_event_scheduler:
+                        wiggleTable = scheduler.get_wiggleTable(tmin)
+                    else:
+                        wiggleTable = self.get_wiggleTable(collisionTable,
+                                                           tmin)
+                    # In id order, so that the wiggles draw the same random
+                    # numbers whichever way the table was built
+                    for i in sorted(wiggleTable):
+                        self.agents[i].set_wiggle()
                     self.total_time += tmin
+                    if self.do_event_scheduler:
+                        scheduler.advance(tmin, wiggleTable)
+            # The sub-steps add up to one second, up to rounding that
+            # depends on how the collisions were found
+            self.total_time = start_time + 1.0
 
             if self.do_history:
-                state = self.get_state('location2D')
-                self.history_state.append(state)
-                [agent.history() for agent in self.agents]
+                self.history.record(self.agent_arrays.location,
+                                    self.agent_arrays.status == 1)
 
             self.step_id += 1
 
@@ -677,34 +1477,92 @@ class Model:
         #         self.status = 0
         #         self.finish_step_id = self.step_id
 
+    # History
+    @property
+    def history_state(self):
+        '''
+        The recorded locations (steps, pop_total, 2) of all the agents.
+        '''
+        return self.history.state
+
+    @property
+    def history_collision_locs(self):
+        return self.history.collision_locs
+
+    @property
+    def history_collision_times(self):
+        return self.history.collision_times
+
+    @property
+    def history_wiggle_locs(self):
+        return self.history.wiggle_locs
+
     # information about next collision
-    def get_collisionTable(self):
+    def get_collisionTable(self, time=None, vectorised=None):
         '''
         Returns the time of next colision (tmin) and a table with
         information about every possible colision:
         - collisionTable[0]: collision time
         - collisionTable[1]: agent agent.unique_id
+
+        If the remaining time budget of the step (time) is given, only
+        the pairs of agents that can meet within that time (see
+        get_collisionCandidates) are tested. This gives the same tmin
+        whenever tmin <= time and the same wiggle table.
+
+        If vectorised (default: the do_vectorised_collisions parameter),
+        the collision times are computed by the batched collision_times
+        kernel and the table is returned as a pair of arrays (collision
+        times, agent ids) rather than a list of tuples.
         '''
+        if vectorised is None:
+            vectorised = self.do_vectorised_collisions
+        arrays = self.agent_arrays
+        location = arrays.location
+        velocity = arrays.get_velocities()
+        clock_location = np.asarray(self.clock.location)
+        clock_size = self.clock.size
+        active = np.flatnonzero(arrays.status == 1)
+        pairs = self.get_collisionCandidates(active, time)
+
+        if vectorised:
+            i, j = pairs
+            wall_times, clock_times, pair_times = collision_times(
+                location[active], velocity[active], arrays.size[active],
+                (np.searchsorted(active, i), np.searchsorted(active, j)),
+                clock_location, clock_size, self.width, self.height)
+            collisionTable = (
+                np.concatenate((wall_times, clock_times, pair_times,
+                                pair_times)),
+                np.concatenate((active, active, i, j)))
+            tmin = collisionTable[0].min(initial=1.0e300)
+            if tmin <= 1.0e-10:
+                tmin = 0.02
+            return collisionTable, tmin
+
         collisionTable = []
-        for i in range(self.pop_total):
-            if (self.agents[i].status == 1):
-                collisionTime = self.agents[i].get_collisionTimeWall()
-                collision = (collisionTime, i)
-                collisionTable.append(collision)
-
-                collisionTime =\
-                    self.agents[i].get_collisionTime2Agents(self.clock)
-                collision = (collisionTime, i)
-                collisionTable.append(collision)
-
-                for j in range(i+1, self.pop_total):
-                    if (self.agents[j].status == 1):
-                        collisionTime = self.agents[i].\
-                            get_collisionTime2Agents(self.agents[j])
-                        collision = (collisionTime, i)
-                        collisionTable.append(collision)
-                        collision = (collisionTime, j)
-                        collisionTable.append(collision)
+        for i in active:
+            size = arrays.size[i]
+            collisionTime = collision_time_wall(location[i], velocity[i],
+                                                size, self.width,
+                                                self.height)
+            collision = (collisionTime, i)
+            collisionTable.append(collision)
+
+            # The clock does not move
+            collisionTime = collision_time_agents(
+                location[i] - clock_location, velocity[i], size + clock_size)
+            collision = (collisionTime, i)
+            collisionTable.append(collision)
+
+        for i, j in zip(*pairs):
+            collisionTime = collision_time_agents(
+                location[i] - location[j], velocity[i] - velocity[j],
+                arrays.size[i] + arrays.size[j])
+            collision = (collisionTime, i)
+            collisionTable.append(collision)
+            collision = (collisionTime, j)
+            collisionTable.append(collision)
 
         try:
             tmin = min(collisionTable)
@@ -716,7 +1574,30 @@ class Model:
 
         return collisionTable, tmin
 
-    def get_wiggleTable(self, collisionTable, time):
+    def get_collisionCandidates(self, active, time=None):
+        '''
+        Returns the pairs (i, j), i < j, of active agents that must be
+        tested for a collision, as two arrays of agent ids.
+
+        Without a time budget every pair is returned. Otherwise, only the
+        pairs whose swept discs can meet within time (plus the wiggle
+        tolerance, since the wiggle table looks that far past tmin) are
+        returned, i.e. those at most 2*(speed*time + agent_size) apart.
+        They are found with a KD-tree over the active agents.
+        '''
+        if time is None or len(active) < 2:
+            i, j = np.triu_indices(len(active), k=1)
+        else:
+            arrays = self.agent_arrays
+            horizon = time + self.tolerance
+            reach = 2 * (arrays.speed[active].max() * horizon +
+                         arrays.size[active].max())
+            tree = cKDTree(arrays.location[active])
+            pairs = tree.query_pairs(reach, output_type='ndarray')
+            i, j = pairs[:, 0], pairs[:, 1]
+        return active[i], active[j]
+
+    def get_wiggleTable(self, collisionTable, time, vectorised=None):
         '''
         Returns a table with the agent.unique_id of all agents that
         collide in the specified time. A tolerance time is used to
@@ -725,59 +1606,64 @@ class Model:
         Each line in the collisionTable has 2 columns:
         - Column 0: collision time
         - Column 1: agent.unique_id
+        (for a vectorised table, these are two arrays).
         '''
+        if vectorised is None:
+            vectorised = self.do_vectorised_collisions
+        if vectorised:
+            times, unique_ids = collisionTable
+            wiggle = np.abs(times - time) < self.tolerance
+            return set(unique_ids[wiggle].tolist())
         return set([line[1] for line in collisionTable
                     if (abs(line[0] - time) < self.tolerance)])
 
     # State
     def get_state(self, sensor=None, inactive_agents=True):
         '''
-        Convert list of agents in model to state vector.
+        Convert the agent arrays of the model to a state vector.
         '''
+        arrays = self.agent_arrays
         if inactive_agents:
-            agents = self.agents.copy()
+            index = np.arange(len(arrays))
         else:
-            agents = [agent for agent in self.agents if agent.status == 1]
+            index = np.flatnonzero(arrays.status == 1)
 
         if sensor is None:
-            state = [(agent.status, *agent.location, agent.speed) for agent in
-                     agents]
+            state = np.column_stack((arrays.status[index],
+                                     arrays.location[index],
+                                     arrays.speed[index]))
             state = np.append(self.step_id, np.ravel(state))
         elif sensor in self.state_gets:
             state_getter_func = self.state_gets[sensor]
-            state = state_getter_func(agents)
+            state = state_getter_func(index)
         else:
             raise ValueError(f'Sensor type ({sensor}) not recognised.')
         return state
 
-    @staticmethod
-    def get_state_location(agents):
-        state = [agent.location for agent in agents]
+    def get_state_location(self, index):
+        state = self.agent_arrays.location[index]
         state = np.ravel(state)
         return state
 
-    @staticmethod
-    def get_state_location_2d(agents):
-        state = [agent.location for agent in agents]
+    def get_state_location_2d(self, index):
+        state = self.agent_arrays.location[index].tolist()
+        state = [tuple(location) for location in state]
         return state
 
-    @staticmethod
-    def get_state_exit_number(agents):
-        state = [agent.gate_out for agent in agents]
+    def get_state_exit_number(self, index):
+        state = self.agent_arrays.gate_out[index].tolist()
         return state
 
-    def get_state_loc_exit(self, agents):
-        locations = self.get_state_location_2d(agents)
-        x, y = [l[0] for l in locations], [l[1] for l in locations]
-        exits = self.get_state_exit_number(agents)
-        # exits = [agent.gate_out for agent in agents]
+    def get_state_loc_exit(self, index):
+        locations = self.agent_arrays.location[index]
+        x, y = locations[:, 0].tolist(), locations[:, 1].tolist()
+        exits = self.get_state_exit_number(index)
         state = x + y + exits
         return state
 
-    @staticmethod
-    def get_state_exit_location(agents):
-        locations = [agent.loc_desire for agent in agents]
-        x, y = [l[0] for l in locations], [l[1] for l in locations]
+    def get_state_exit_location(self, index):
+        locations = self.agent_arrays.loc_desire[index]
+        x, y = locations[:, 0].tolist(), locations[:, 1].tolist()
         state = x + y
         return state
 
@@ -787,12 +1673,9 @@ class Model:
         state = x_y_g + exit_locs
         return state
 
-    @staticmethod
-    def get_state_locationVel(agents):
-        state0 = [agent.location for agent in agents]
-        state0 = np.ravel(state0)
-        state1 = [agent.speed for agent in agents]
-        state1 = np.ravel(state1)
+    def get_state_locationVel(self, index):
+        state0 = np.ravel(self.agent_arrays.location[index])
+        state1 = self.agent_arrays.speed[index]
         state = [state0, state1]
         return state
 
@@ -803,9 +1686,8 @@ class Model:
         if sensor is None:
             self.step_id = int(state[0])
             state = np.reshape(state[1:], (self.pop_total, 3))
-            for i, agent in enumerate(self.agents):
-                agent.status = int(state[i, 0])
-                agent.location = state[i, 1:]
+            self.agent_arrays.status[:] = state[:, 0].astype(int)
+            self.agent_arrays.location[:] = state[:, 1:]
         elif sensor in self.state_sets:
             state_setter_func = self.state_sets[sensor]
             state_setter_func(state)
@@ -814,36 +1696,30 @@ class Model:
 
     def set_state_location(self, state) -> None:
         state = np.reshape(state, (self.pop_total, 2))
-        for i, agent in enumerate(self.agents):
-            agent.location = state[i, :]
+        self.agent_arrays.location[:] = state
 
     def set_state_location_2d(self, state) -> None:
-        for i, agent in enumerate(self.agents):
-            agent.location = state[i, :]
+        self.agent_arrays.location[:] = state
 
     def set_state_exit(self, state) -> None:
+        self.agent_arrays.gate_out[:] = np.asarray(state).astype(int)
         for i, agent in enumerate(self.agents):
-            exit = int(state[i])
-            agent.gate_out = exit
-            agent.loc_desire = agent.set_agent_location(exit)
+            agent.loc_desire = agent.set_agent_location(agent.gate_out)
 
     def set_state_exit_number(self, state) -> None:
-        for i, agent in enumerate(self.agents):
-            agent.gate_out = state[i]
+        self.agent_arrays.gate_out[:] = state
 
     def set_state_loc_exit(self, state) -> None:
-        locations = state[: 2 * self.pop_total]
-        loc_state = list()
-        for i in range(self.pop_total):
-            loc_state.extend([locations[i], locations[self.pop_total+i]])
+        locations = np.asarray(state[: 2 * self.pop_total])
+        self.agent_arrays.location[:, 0] = locations[: self.pop_total]
+        self.agent_arrays.location[:, 1] = locations[self.pop_total:]
         exit_state = state[2 * self.pop_total:]
-        self.set_state_location(loc_state)
         self.set_state_exit(exit_state)
 
     def set_state_exit_location(self, state) -> None:
-        for i, agent in enumerate(self.agents):
-            loc_desire = (state[i], state[self.pop_total + i])
-            agent.loc_desire = loc_desire
+        self.agent_arrays.loc_desire[:, 0] = state[: self.pop_total]
+        self.agent_arrays.loc_desire[:, 1] = state[self.pop_total:
+                                                   2 * self.pop_total]
 
     def set_state_enkf_gate_angle(self, state) -> None:
         loc_exits = state[: 3 * self.pop_total]
@@ -852,11 +1728,101 @@ class Model:
         self.set_state_exit_location(destinations)
 
     def set_state_locationVel(self, state) -> None:
-        state0 = np.reshape(state[0], (self.pop_total, 2))
-        state1 = np.reshape(state[1], (self.pop_total, 1))
-        for i, agent in enumerate(self.agents):
-            agent.location = state0[i, :]
-            agent.speed = state1[i, :]
+        self.agent_arrays.location[:] = np.reshape(state[0],
+                                                   (self.pop_total, 2))
+        self.agent_arrays.speed[:] = np.reshape(state[1], self.pop_total)
+
+    # Snapshots
+    def snapshot(self):
+        '''
+        Returns a copy of the dynamic state of the model.
+
+        Description:
+            The snapshot is a dict of arrays: the agent arrays (see
+            AgentArrays.fields), the agents' loc_start and step_end (NaN
+            where unset) and the model counters (step_id, pop_active,
+            pop_finished, total_time and status). It does not include
+            the recorded history, which restore() leaves untouched.
+        '''
+        arrays = self.agent_arrays
+        snapshot = {name: getattr(arrays, name).copy()
+                    for name in AgentArrays.fields}
+        snapshot['loc_start'] = np.array(
+            [getattr(agent, 'loc_start', (np.nan, np.nan))
+             for agent in self.agents], dtype=float).reshape(-1, 2)
+        snapshot['step_end'] = np.array(
+            [_from_step(agent.step_end) for agent in self.agents],
+            dtype=float)
+        snapshot['counters'] = np.array([self.step_id, self.pop_active,
+                                         self.pop_finished, self.total_time,
+                                         self.status], dtype=float)
+        return snapshot
+
+    def restore(self, snapshot):
+        '''
+        Return the model to the dynamic state saved by snapshot().
+        '''
+        arrays = self.agent_arrays
+        for name in AgentArrays.fields:
+            getattr(arrays, name)[:] = snapshot[name]
+        for agent, loc_start, step_end in zip(self.agents,
+                                              snapshot['loc_start'],
+                                              snapshot['step_end']):
+            if np.isnan(loc_start).any():
+                agent.__dict__.pop('loc_start', None)
+            else:
+                agent.loc_start = loc_start.copy()
+            agent.step_end = _to_step(step_end)
+        step_id, pop_active, pop_finished, total_time, status = \
+            snapshot['counters']
+        self.step_id = int(step_id)
+        self.pop_active = int(pop_active)
+        self.pop_finished = int(pop_finished)
+        self.total_time = float(total_time)
+        self.status = int(status)
+        self.spatial_index.rebuild(arrays.location)
+
+    def clone(self):
+        '''
+        Returns an independent copy of the model.
+
+        Description:
+            A cheaper alternative to deepcopy(model): the station
+            geometry (gates, boundaries, clock) and the parameters are
+            shared with the original, which never modifies them, while
+            the agent arrays, the agents and the recorded history are
+            copied (the history in memory, even if the original's is
+            memory-mapped).
+        '''
+        model = copy(self)
+        model.state_gets = {key: getattr(model, func.__name__)
+                            for key, func in self.state_gets.items()}
+        model.state_sets = {key: getattr(model, func.__name__)
+                            for key, func in self.state_sets.items()}
+
+        model.agents = []
+        for agent in self.agents:
+            agent = copy(agent)
+            agent.model = model
+            for key, value in agent.__dict__.items():
+                if isinstance(value, list):
+                    agent.__dict__[key] = list(value)
+            model.agents.append(agent)
+        arrays = copy(self.agent_arrays)
+        arrays.model = model
+        arrays.agents = model.agents
+        for name in AgentArrays.fields:
+            setattr(arrays, name, getattr(arrays, name).copy())
+        for agent in model.agents:
+            agent._arrays = arrays
+        model.agent_arrays = arrays
+        model.spatial_index = SpatialIndex(arrays.location)
+
+        if self.do_history:
+            model.history = self.history.copy()
+            for key in ('steps_taken', 'steps_exped', 'steps_delay'):
+                model.__dict__[key] = list(self.__dict__[key])
+        return model
 
     # TODO: Deprecated, update PF
     def agents2state(self, do_ravel=True):
@@ -874,12 +1840,14 @@ class Model:
         Save all locations of all agents. there are many ways to
         organize this information. In principle, each frame will be
         stored in a different file.
+        With sensor='trajectories', all the frames are instead written
+        to a single binary trajectory store (see trajectory_store.py),
+        where frame f holds the locations after f steps.
         '''
         directory = sensor + '_' + time_id
         if not(os.path.exists(directory)):
             os.mkdir(directory)
-        locs = np.array([agent.history_locations for agent in
-                         self.agents[:agents]]).transpose((1, 2, 0))
+        locs = self.history.locations[:, :agents].transpose((0, 2, 1))
         if(sensor == 'frame'):
             for frame in range(self.step_id):
                 filename = directory + '/frame_' + str(frame+1) + '.dat'
@@ -888,9 +1856,17 @@ class Model:
                 x = locs[frame-1][0]
                 y = locs[frame-1][1]
                 for agent in range(self.pop_total):
-                    if(x[agent] is not None):
+                    if not np.isnan(x[agent]):
                         print(agent, x[agent], y[agent], file=save_file)
                 save_file.close()
+        elif(sensor == 'trajectories'):
+            locations = self.history.locations[:, :agents]
+            frame, agent_id = np.nonzero(~np.isnan(locations[:, :, 0]))
+            write_trajectories(os.path.join(directory, STORE_NAME),
+                               frame + 1, agent_id,
+                               locations[frame, agent_id, 0],
+                               locations[frame, agent_id, 1],
+                               frames=np.arange(1, len(locations) + 1))
         elif(sensor == 'activation'):
             save_file = open(directory+'/activation.dat', 'w')
             print('#agentID', 'time_activation', 'gate_in', 'gate_out',
@@ -908,7 +1884,7 @@ class Model:
                 save_file = open(filename, 'w')
                 loc = agent.history_locations
                 for xy in loc:
-                    if(xy[0] is not None):
+                    if not np.isnan(xy[0]):
                         print(xy[0], xy[1], file=save_file)
                 save_file.close()
 
@@ -961,6 +1937,7 @@ class Model:
         if plot_legend:
             plt.legend(['Active', 'Finished'])
         plt.tight_layout(pad=0)
+        locations = self.history.locations
         for agent in self.agents:
             if agent.status == 1:
                 alpha = 1
@@ -971,7 +1948,7 @@ class Model:
             else:
                 alpha = 1
                 colour = colours[2]
-            locs = np.array(agent.history_locations).T
+            locs = locations[:, agent.unique_id].T
             plt.plot(*locs, color=colour, alpha=alpha, linewidth=.5)
         if xlim is not None:  # Optionally set the x limits
             plt.xlim(xlim)
@@ -1039,12 +2016,7 @@ class Model:
         :param title: (optional) title for the plot
         :return:
         '''
-        history_locs = []
-        for agent in self.agents:
-            for loc in agent.history_locations:
-                if None not in loc:
-                    history_locs.append(loc)
-        history_locs = np.array(history_locs).T
+        history_locs = self.history.state[self.history.active].T
         fig, ax = plt.subplots(1, figsize=self._figsize, dpi=self._dpi)
         fig.tight_layout(pad=0)
         self._heightmap(data=history_locs, ax=ax, kdeplot=do_kdeplot,
@@ -1059,8 +2031,7 @@ class Model:
     def get_ani(self, agents=None, colour='k', alpha=.5, show_separation=False,
                 wiggle_map=False):
         # Load Data
-        locs = np.array([agent.history_locations for agent in
-                         self.agents[:agents]]).transpose((1, 2, 0))
+        locs = self.history.locations[:, :agents].transpose((0, 2, 1))
         markersize1 = self.separation * 216*self._rel  # 3*72px/in=216
         markersize2 = 216*self._rel
         #
@@ -1101,7 +2072,7 @@ class Model:
                 agent_ID = int(ID[i])
                 r1 = self.agents[agent_ID].history_locations[int(frame/dt)]
                 r2 = (x[i], y[i])
-                if np.all(r1 != (None, None)):
+                if not np.isnan(r1).any():
                     distance = self.agents[agent_ID].distance(r1, r2)
                     dist.append(distance)
                     time = int(frame - self.agents[agent_ID].step_start)
@@ -1147,6 +2118,239 @@ class Model:
         np.random.seed(new_seed)
 
 
+class ModelBatch:
+    '''
+    A batch of replicas of the StationSim model stepped together.
+
+    Description:
+        Takes E models of the same station and population (e.g. the
+        deep copies of a base model used as the members of an ensemble)
+        and moves the agent arrays of all of them into (E, N) arrays:
+        the AgentArrays of replica e becomes a view onto row e, so each
+        replica is still a complete Model (agents, get_state(), ...).
+
+        step() iterates every replica forward one second, as
+        Model.step() does. Activations and wiggles are still done
+        replica by replica, but the collision times and the moves of
+        the agents of the whole batch are computed at once, with every
+        replica sub-stepping to its own next collision. The batch always
+        uses the vectorised collision table (do_event_scheduler is
+        ignored).
+
+    Params:
+        models      # list of Models with the same station and pop_total
+
+    Returns:
+        models
+        get_state()
+        set_state()
+    '''
+
+    def __init__(self, models):
+        self.models = list(models)
+        base_model = self.models[0]
+        for model in self.models[1:]:
+            if (model.pop_total != base_model.pop_total or
+                    model.station != base_model.station):
+                raise ValueError('All the models of a ModelBatch must have '
+                                 'the same station and pop_total.')
+        self.n_replicas = len(self.models)
+        self.pop_total = base_model.pop_total
+        self.width = base_model.width
+        self.height = base_model.height
+        self.tolerance = base_model.tolerance
+        self.clock_location = np.asarray(base_model.clock.location,
+                                         dtype=float)
+        self.clock_size = base_model.clock.size
+
+        for name in AgentArrays.fields:
+            values = np.stack([getattr(model.agent_arrays, name)
+                               for model in self.models])
+            setattr(self, name, values)
+            for e, model in enumerate(self.models):
+                setattr(model.agent_arrays, name, values[e])
+
+    @classmethod
+    def from_model(cls, model, n_replicas):
+        '''
+        Create a batch of n_replicas clones of model.
+        '''
+        return cls([model.clone() for _ in range(n_replicas)])
+
+    def __len__(self):
+        return self.n_replicas
+
+    def __getitem__(self, e):
+        return self.models[e]
+
+    def __iter__(self):
+        return iter(self.models)
+
+    def step(self):
+        '''
+        Iterate every replica forward one second.
+        '''
+        stepping = np.array([model.pop_finished < model.pop_total and
+                             model.step_id < model.step_limit and
+                             model.status == 1 for model in self.models])
+        for e, model in enumerate(self.models):
+            if not stepping[e]:
+                model.step()  # only updates the status of the model
+                continue
+            if model.do_print and model.step_id % 100 == 0:
+                print(f'\tIteration: {model.step_id}/{model.step_limit}')
+            model.spatial_index.rebuild(model.agent_arrays.location)
+            model.agent_arrays.activate()
+
+        start_times = [model.total_time for model in self.models]
+        t = np.where(stepping, 1.0, 0.0)
+        while (t > 0).any():
+            running = t > 0
+            collisionTable, tmin = self.get_collisionTable(t)
+            free = running & (tmin > t)
+            collide = running & ~free
+            time_step = np.where(free, t, 0.98 * tmin)
+            time_step[~running] = 0.0
+            t[free] -= tmin[free]
+            t[collide] -= time_step[collide]
+
+            self.move(time_step)
+            self.deactivate()
+            self.wiggle(collisionTable, time_step, collide)
+            for e in np.flatnonzero(running):
+                self.models[e].total_time += time_step[e]
+
+        for e in np.flatnonzero(stepping):
+            model = self.models[e]
+            model.total_time = start_times[e] + 1.0
+            if model.do_history:
+                model.history.record(model.agent_arrays.location,
+                                     model.agent_arrays.status == 1)
+            model.step_id += 1
+
+    def get_velocities(self, active):
+        '''
+        Returns the velocities of the agents with the given flat indices
+        (e * pop_total + unique_id).
+        '''
+        location = self.location.reshape(-1, 2)[active]
+        loc_desire = self.loc_desire.reshape(-1, 2)[active]
+        speed = self.speed.reshape(-1)[active]
+        return speed[:, None] * get_directions(location, loc_desire)
+
+    def get_collisionTable(self, time):
+        '''
+        Returns the collision table of the whole batch and the time of
+        the next collision (tmin) of every replica.
+
+        The table is a pair of arrays (collision times, flat agent
+        indices), as returned by the vectorised Model.get_collisionTable.
+        Only the pairs of agents that can meet within the remaining time
+        of their replica are tested: the replicas are laid side by side
+        along x, far enough apart that a single KD-tree over all the
+        active agents never pairs agents of different replicas.
+        '''
+        n = self.pop_total
+        active = np.flatnonzero(self.status.reshape(-1) == 1)
+        replica = active // n
+        location = self.location.reshape(-1, 2)[active]
+        velocity = self.get_velocities(active)
+        size = self.size.reshape(-1)[active]
+
+        if len(active) > 1:
+            horizon = time.max() + self.tolerance
+            reach = 2 * (self.speed.reshape(-1)[active].max() * horizon +
+                         size.max())
+            shifted = location.copy()
+            shifted[:, 0] += replica * (self.width + 2 * reach)
+            pairs = cKDTree(shifted).query_pairs(reach, output_type='ndarray')
+            i, j = pairs[:, 0], pairs[:, 1]
+        else:
+            i = j = np.zeros(0, dtype=int)
+
+        wall_times, clock_times, pair_times = collision_times(
+            location, velocity, size, (i, j), self.clock_location,
+            self.clock_size, self.width, self.height)
+        collisionTable = (
+            np.concatenate((wall_times, clock_times, pair_times, pair_times)),
+            np.concatenate((active, active, active[i], active[j])))
+        tmin = np.full(self.n_replicas, 1.0e300)
+        np.minimum.at(tmin, collisionTable[1] // n, collisionTable[0])
+        tmin[tmin <= 1.0e-10] = 0.02
+        return collisionTable, tmin
+
+    def move(self, time_step):
+        '''
+        Move the active agents of every replica e for time_step[e].
+        '''
+        active = np.flatnonzero(self.status.reshape(-1) == 1)
+        time_step = time_step[active // self.pop_total]
+        self.location.reshape(-1, 2)[active] += (self.get_velocities(active) *
+                                                 time_step[:, None])
+
+    def deactivate(self):
+        '''
+        Deactivate the active agents that have reached their destination
+        (see AgentArrays.deactivate).
+        '''
+        x = self.location[:, :, 0] - self.loc_desire[:, :, 0]
+        y = self.location[:, :, 1] - self.loc_desire[:, :, 1]
+        gates_space = np.array([model.gates_space for model in self.models])
+        finished = ((self.status == 1) &
+                    ((x*x + y*y)**.5 < gates_space[:, None]))
+        for e in np.flatnonzero(finished.any(axis=1)):
+            self.models[e].agent_arrays.deactivate(
+                np.flatnonzero(finished[e]))
+
+    def wiggle(self, collisionTable, time, collide):
+        '''
+        Wiggle, in the replicas that stopped before a collision, the
+        agents that collide at time (see Model.get_wiggleTable).
+        '''
+        n = self.pop_total
+        times, flat_ids = collisionTable
+        replica = flat_ids // n
+        wiggle = collide[replica] & (np.abs(times - time[replica]) <
+                                     self.tolerance)
+        wiggle = np.flatnonzero(wiggle)
+        wiggle = wiggle[np.argsort(replica[wiggle], kind='stable')]
+        replicas, starts = np.unique(replica[wiggle], return_index=True)
+        for e, entries in zip(replicas, np.split(wiggle, starts[1:])):
+            model = self.models[e]
+            model.spatial_index.rebuild(model.agent_arrays.location)
+            wiggleTable = set((flat_ids[entries] - e * n).tolist())
+            for i in sorted(wiggleTable):
+                model.agents[i].set_wiggle()
+
+    def get_state(self, sensor=None):
+        '''
+        Returns the state vectors of all the replicas as an (E, d) array
+        (see Model.get_state).
+        '''
+        if sensor == 'location':
+            return self.location.reshape(self.n_replicas, -1).copy()
+        if sensor == 'location2D':
+            return self.location.copy()
+        if sensor == 'exit_number':
+            return self.gate_out.copy()
+        return np.array([model.get_state(sensor) for model in self.models])
+
+    def set_state(self, state, sensor=None):
+        '''
+        Set the state of every replica from an (E, d) array (see
+        Model.set_state).
+        '''
+        if sensor == 'location':
+            self.location[:] = np.reshape(state, self.location.shape)
+        elif sensor == 'location2D':
+            self.location[:] = state
+        elif sensor == 'exit_number':
+            self.gate_out[:] = state
+        else:
+            for model, model_state in zip(self.models, state):
+                model.set_state(model_state, sensor)
+
+
 if __name__ == '__main__':
     warnings.warn("The stationsim_gcs_model.py code should not be run directly"
                   ". Create a separate script and use that to run experimets "
@@ -0,0 +1,100 @@
+"""
+timing.py
+Per-phase timing and counters for the windows of a filter run.
+
+    timer = PhaseTimer()
+    with timer.phase('predict'):
+        ...
+    timer.add_bytes('predict', sent=..., received=...)
+    timer.end_window(window)
+
+Each finished window adds one record per phase to timer.records, with
+the wall time, the number of calls and the bytes sent to and received
+from worker processes in that window. The records can be summed with
+totals() and exported with to_csv() or to_json().
+"""
+# Imports
+import csv
+import json
+import time
+from contextlib import contextmanager
+
+FIELDS = ('window', 'phase', 'calls', 'seconds', 'bytes_sent',
+          'bytes_received')
+
+
+# Classes
+class PhaseTimer:
+    """
+    Wall time, call counts and bytes transferred for each phase of each
+    window.
+    """
+    def __init__(self):
+        self.records = list()
+        self._current = dict()
+
+    def _counters(self, name):
+        if name not in self._current:
+            self._current[name] = {'calls': 0, 'seconds': 0.0,
+                                   'bytes_sent': 0, 'bytes_received': 0}
+        return self._current[name]
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time one call of a phase (a context manager).
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            counters = self._counters(name)
+            counters['calls'] += 1
+            counters['seconds'] += time.perf_counter() - start_time
+
+    def add_bytes(self, name, sent=0, received=0):
+        """
+        Count bytes sent to and received from workers in a phase.
+        """
+        counters = self._counters(name)
+        counters['bytes_sent'] += sent
+        counters['bytes_received'] += received
+
+    def end_window(self, window):
+        """
+        Record the counters of the phases run since the last window.
+        """
+        for name, counters in self._current.items():
+            self.records.append(dict(window=window, phase=name, **counters))
+        self._current = dict()
+
+    def totals(self):
+        """
+        Returns the counters summed over all the windows, by phase.
+        """
+        totals = dict()
+        for record in self.records:
+            phase = totals.setdefault(record['phase'],
+                                      {'calls': 0, 'seconds': 0.0,
+                                       'bytes_sent': 0, 'bytes_received': 0})
+            for key in phase:
+                phase[key] += record[key]
+        return totals
+
+    def get_window(self, window):
+        """
+        Returns the counters of one window, by phase.
+        """
+        return {record['phase']: {key: record[key] for key in FIELDS[2:]}
+                for record in self.records if record['window'] == window}
+
+    def to_csv(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(self.records)
+
+    def to_json(self, path):
+        with open(path, 'w') as f:
+            json.dump({'records': self.records, 'totals': self.totals()},
+                      f, indent=1)
@@ -0,0 +1,318 @@
+"""
+trajectory_store.py
+A single-file binary store for pedestrian trajectories.
+
+The store holds one row (frame, agent_id, x, y) per agent per frame,
+sorted by frame, preceded by an index with the first and last row of
+every frame. Both arrays are written in the .npy format, one after the
+other, so the rows can be memory-mapped and a frame read without
+parsing the rest of the file.
+
+    write_trajectories()        # write a store from arrays of rows
+    TrajectoryReader            # read frames back from a store
+    TextFrameReader             # same interface over frame_*.dat files
+    open_frames()               # open a store or a directory of frames
+    ObservationFeed             # prefetch frames as model indices and locations
+    convert_frames_archive()    # convert a frames.tar.gz to a store
+"""
+# Imports
+import os
+import re
+import tarfile
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from numpy.lib import format as npy_format
+
+ROW_DTYPE = np.dtype([('frame', '<i8'), ('agent_id', '<i8'),
+                      ('x', '<f8'), ('y', '<f8')])
+INDEX_DTYPE = np.dtype([('frame', '<i8'), ('start', '<i8'),
+                        ('stop', '<i8')])
+STORE_NAME = 'trajectories.traj'
+FRAME_PATTERN = re.compile(r'frame_(\d+)(?:\.0)?\.dat$')
+
+
+# Functions
+def write_trajectories(path, frame, agent_id, x, y, frames=None):
+    """
+    Write a trajectory store.
+
+    Params:
+        path
+        frame, agent_id, x, y   # one entry per row, in any order
+        frames                  # optional list of all the frames, so that
+                                  frames without agents are kept
+
+    Returns:
+        None
+    """
+    rows = np.empty(len(frame), dtype=ROW_DTYPE)
+    rows['frame'] = frame
+    rows['agent_id'] = agent_id
+    rows['x'] = x
+    rows['y'] = y
+    rows = rows[np.lexsort((rows['agent_id'], rows['frame']))]
+
+    if frames is None:
+        frames = rows['frame']
+    frames = np.union1d(frames, rows['frame'])
+    index = np.empty(len(frames), dtype=INDEX_DTYPE)
+    index['frame'] = frames
+    index['start'] = np.searchsorted(rows['frame'], frames, side='left')
+    index['stop'] = np.searchsorted(rows['frame'], frames, side='right')
+
+    with open(path, 'wb') as f:
+        npy_format.write_array(f, index)
+        npy_format.write_array(f, rows)
+
+
+def _read_header(f):
+    version = npy_format.read_magic(f)
+    if version == (1, 0):
+        shape, _, dtype = npy_format.read_array_header_1_0(f)
+    else:
+        shape, _, dtype = npy_format.read_array_header_2_0(f)
+    return shape, dtype
+
+
+def open_frames(path):
+    """
+    Open the frames of a trajectory dataset.
+
+    Params:
+        path    # a trajectory store, or a directory with either a store
+                  (trajectories.traj) or frame_*.dat text files
+
+    Returns:
+        TrajectoryReader or TextFrameReader
+    """
+    if os.path.isdir(path):
+        store = os.path.join(path, STORE_NAME)
+        if os.path.exists(store):
+            return TrajectoryReader(store)
+        return TextFrameReader(path)
+    return TrajectoryReader(path)
+
+
+def _load_frame_text(f):
+    with warnings.catch_warnings():
+        # Frames without agents only have the header line
+        warnings.simplefilter('ignore', UserWarning)
+        data = np.loadtxt(f, ndmin=2)
+    if data.size == 0:
+        data = np.zeros((0, 3))
+    return data
+
+
+def convert_frames_archive(archive, path):
+    """
+    Convert an archive of frame_*.dat text files (e.g.
+    GCT_final_real_data/frames.tar.gz) to a trajectory store.
+
+    Params:
+        archive     # path to the .tar.gz archive
+        path        # path of the store to write
+
+    Returns:
+        None
+    """
+    frames = list()
+    with tarfile.open(archive) as tar:
+        for member in tar:
+            match = FRAME_PATTERN.search(member.name)
+            if match is None or not member.isfile():
+                continue
+            data = _load_frame_text(tar.extractfile(member))
+            frames.append((int(match.group(1)), data))
+    write_frames(path, frames)
+
+
+def write_frames(path, frames):
+    """
+    Write a trajectory store from a list of (frame, data) pairs, where
+    data is an (n, 3) array of (agent_id, x, y) rows.
+    """
+    frame = np.concatenate([np.full(len(data), f) for f, data in frames] +
+                           [np.zeros(0)])
+    data = np.concatenate([data for _, data in frames] + [np.zeros((0, 3))])
+    write_trajectories(path, frame, data[:, 0], data[:, 1], data[:, 2],
+                       frames=[f for f, _ in frames])
+
+
+# Classes
+class TrajectoryReader:
+    """
+    Read frames from a trajectory store.
+
+    The rows are memory-mapped, so opening a store is cheap and reading
+    a frame only touches that frame's rows.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            shape, dtype = _read_header(f)
+            self.index = np.fromfile(f, dtype=dtype, count=shape[0])
+            shape, dtype = _read_header(f)
+            offset = f.tell()
+        if shape[0]:
+            self.rows = np.memmap(path, dtype=dtype, mode='r',
+                                  offset=offset, shape=shape)
+        else:
+            self.rows = np.zeros(0, dtype=dtype)
+
+    @property
+    def frames(self):
+        """
+        The frames in the store (sorted).
+        """
+        return self.index['frame']
+
+    def __contains__(self, frame):
+        i = np.searchsorted(self.frames, frame)
+        return i < len(self.frames) and self.frames[i] == frame
+
+    def get_frame(self, frame):
+        """
+        Get the agents recorded in one frame.
+
+        Params:
+            frame
+
+        Returns:
+            agent_id, x, y  # arrays (sorted by agent_id; empty if the
+                              frame has no agents)
+
+        Raises:
+            KeyError if the frame is not in the store
+        """
+        i = np.searchsorted(self.frames, frame)
+        if i == len(self.frames) or self.frames[i] != frame:
+            raise KeyError(frame)
+        rows = self.rows[self.index['start'][i]:self.index['stop'][i]]
+        return (np.asarray(rows['agent_id']), np.asarray(rows['x']),
+                np.asarray(rows['y']))
+
+    def get_agent(self, agent_id):
+        """
+        Get the trajectory of one agent.
+
+        Returns:
+            frame, x, y     # arrays, sorted by frame
+        """
+        rows = self.rows[self.rows['agent_id'] == agent_id]
+        return rows['frame'], rows['x'], rows['y']
+
+
+class TextFrameReader:
+    """
+    Read frames from a directory of frame_<frame>.0.dat text files, with
+    the same interface as TrajectoryReader.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _file_name(self, frame):
+        return os.path.join(self.directory, f'frame_{frame}.0.dat')
+
+    def __contains__(self, frame):
+        return os.path.exists(self._file_name(frame))
+
+    def get_frame(self, frame):
+        """
+        Get the agents recorded in one frame (see TrajectoryReader).
+        """
+        try:
+            data = _load_frame_text(self._file_name(frame))
+        except OSError:
+            raise KeyError(frame)
+        return data[:, 0].astype(int), data[:, 1], data[:, 2]
+
+
+class ObservationFeed:
+    """
+    Frames of a trajectory dataset, loaded ahead in a background thread
+    and converted to the indices of a model's agents.
+
+    Frames are expected to be requested in increasing order: they are
+    loaded in blocks of `prefetch` frames, and the next block is loaded
+    while the caller works through the current one (e.g. stepping the
+    particles of a filter), so reading the data overlaps with it.
+    """
+    def __init__(self, frames, agent_ids, prefetch=16):
+        """
+        Params:
+            frames      # a TrajectoryReader or TextFrameReader (see
+                          open_frames())
+            agent_ids   # the unique_id of each agent of the model, in
+                          order
+            prefetch    # the number of frames loaded at a time
+        """
+        self.frames = frames
+        self.prefetch = prefetch
+        agent_ids = np.asarray(agent_ids, dtype=int)
+        # Dense lookup from agent_id to the agent's index (-1 if unknown)
+        self.lookup = np.full(agent_ids.max(initial=-1) + 1, -1, dtype=int)
+        self.lookup[agent_ids] = np.arange(len(agent_ids))
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = dict()
+
+    def _load(self, frame):
+        try:
+            agent_id, x, y = self.frames.get_frame(frame)
+        except KeyError:
+            return None
+        agent_id = np.asarray(agent_id, dtype=int)
+        known = (agent_id >= 0) & (agent_id < len(self.lookup))
+        index = np.full(len(agent_id), -1, dtype=int)
+        index[known] = self.lookup[agent_id[known]]
+        known = index >= 0
+        return index[known], np.column_stack((x, y))[known]
+
+    def _load_block(self, first):
+        return [self._load(frame)
+                for frame in range(first, first + self.prefetch)]
+
+    def _submit(self, first):
+        if first not in self._pending:
+            self._pending[first] = self._executor.submit(self._load_block,
+                                                         first)
+
+    def get(self, frame):
+        """
+        Get the agents recorded in one frame.
+
+        Params:
+            frame
+
+        Returns:
+            index, locations    # the model indices of the agents in the
+                                  frame, and an (n, 2) array of their
+                                  locations; or None if the frame is not
+                                  in the data
+        """
+        # Frames are loaded in blocks of `prefetch` frames, and the next
+        # block is queued as soon as one is used
+        first = frame - frame % self.prefetch
+        self._submit(first)
+        self._submit(first + self.prefetch)
+        for old in [f for f in self._pending if f < first]:
+            self._pending.pop(old).cancel()
+        return self._pending[first].result()[frame - first]
+
+    def close(self):
+        """
+        Stop loading frames.
+        """
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) != 3:
+        print('Usage: python trajectory_store.py <frames.tar.gz> '
+              f'<output, e.g. {STORE_NAME}>')
+        sys.exit(1)
+    convert_frames_archive(sys.argv[1], sys.argv[2])
@@ -775,9 +775,7 @@ def batch_save(model_params, n, seed):
         base_model.step()
         
     
-    truths = base_model.history_state
-    for i in range(len(truths)):
-        truths[i] = np.ravel(truths[i])
+    truths = [np.ravel(state) for state in base_model.history_state]
     
     batch_pickle = [truths, start_model]
     n = model_params["pop_total"]
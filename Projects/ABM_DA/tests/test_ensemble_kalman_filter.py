@@ -3,6 +3,7 @@ from generate_data.ensemble_kalman_filter_data import *
 from utils import *
 
 import numpy as np
+import pickle
 import pytest
 import sys
 sys.path.append('../stationsim/')
@@ -13,6 +14,10 @@ from ensemble_kalman_filter import AgentIncluder
 from ensemble_kalman_filter import GateEstimator
 from ensemble_kalman_filter import Inflation
 from ensemble_kalman_filter import ExitRandomisation
+from forecast import make_forecast
+from observation import (make_observation_operator, CallableOperator,
+                         MatrixOperator, SelectionOperator)
+from scipy import sparse
 
 # Test data
 round_destination_data = get_round_destination_data()
@@ -984,3 +989,402 @@ def test_unstandardise_ensemble(state, pop_size, en_size, n_var, gate_est,
     result = enkf.unstandardise_ensemble(state, n_var)
 
     np.testing.assert_equal(result, expected)
+
+
+def test_checkpoint_resume(tmp_path):
+    path = str(tmp_path / 'enkf.ckpt')
+    enkf = set_up_enkf(pop_size=8)
+    for _ in range(60):
+        enkf.step()
+        if enkf.time == 30:
+            enkf.checkpoint(path)
+
+    filter_params, model_params = make_enkf_params(pop_size=8)
+    resumed = EnsembleKalmanFilter.resume(path, Model, filter_params,
+                                          model_params)
+    assert resumed.time == 30
+    while resumed.time < 60:
+        resumed.step()
+
+    np.testing.assert_equal(resumed.state_ensemble, enkf.state_ensemble)
+    assert resumed.metrics == enkf.metrics
+    assert resumed.forecast_error == enkf.forecast_error
+    for result, expected in zip(resumed.results, enkf.results):
+        np.testing.assert_equal(result, expected)
+
+
+@pytest.mark.parametrize('backend', ['serial', 'thread', 'process'])
+def test_forecast_backends(backend):
+    base_model = Model(pop_total=8, station='Grand_Central', do_print=False)
+    models = [base_model.clone() for _ in range(5)]
+    expected = [model.clone() for model in models]
+
+    np.random.seed(3)
+    forecast = make_forecast(models, backend, numcores=2 if backend == 'process' else 1)
+    # Replay the random streams of the workers (one per shard)
+    np.random.seed(3)
+    if backend == 'process':
+        seeds = np.random.randint(2 ** 32, size=2, dtype=np.int64)
+        shards = [(expected[:2], seeds[0]), (expected[2:], seeds[1])]
+    else:
+        shards = [(expected, 3)]
+    for shard, seed in shards:
+        np.random.seed(seed)
+        for _ in range(50):
+            for model in shard:
+                model.step()
+
+    try:
+        np.random.seed(3)
+        for _ in range(50):
+            forecast.step()
+        states = forecast.get_states('location')
+        assert len(states) == 5
+        for state, model in zip(states, expected):
+            np.testing.assert_equal(state, model.get_state(sensor='location'))
+        np.testing.assert_equal(forecast.statuses(), [m.status for m in expected])
+        np.testing.assert_equal(forecast.agent_statuses(),
+                                [[a.status for a in m.agents] for m in expected])
+
+        new_states = [state + 1 for state in states]
+        forecast.set_states(new_states, 'location')
+        for state, model in zip(new_states, forecast.get_models()):
+            np.testing.assert_equal(model.get_state(sensor='location'), state)
+    finally:
+        forecast.close()
+
+    with pytest.raises(ValueError):
+        make_forecast(models, 'gpu')
+
+
+def test_enkf_process_backend(tmp_path):
+    filter_params, model_params = make_enkf_params(pop_size=8)
+    filter_params['forecast_backend'] = 'process'
+    filter_params['forecast_workers'] = 2
+    np.random.seed(666)
+    with EnsembleKalmanFilter(Model, filter_params, model_params) as enkf:
+        assert enkf.models is None
+        for _ in range(30):
+            enkf.step()
+        assert enkf.time == 30
+        assert len(enkf.metrics) == 5
+        assert np.all(np.isfinite(enkf.state_ensemble))
+        models = enkf.get_models()
+        assert len(models) == 5
+        for i, model in enumerate(models):
+            np.testing.assert_equal(model.get_state(sensor='location'),
+                                    enkf.state_ensemble[:, i])
+        enkf.checkpoint(str(tmp_path / 'enkf.ckpt'))
+
+    # Closing brings the members back, so the filter can still be used
+    assert enkf.forecast_backend == 'serial'
+    assert len(enkf.models) == 5
+    for i, model in enumerate(enkf.models):
+        np.testing.assert_equal(model.get_state(sensor='location'),
+                                enkf.state_ensemble[:, i])
+    enkf.step()
+    assert enkf.time == 31
+    pickle.dumps(enkf)
+
+
+@pytest.mark.parametrize('inflation, diagonal',
+                         [(Inflation.NONE, True),
+                          (Inflation.MULTIPLICATIVE, True),
+                          (Inflation.MULTIPLICATIVE, False)])
+def test_ensemble_space_analysis(inflation, diagonal):
+    enkf = set_up_enkf(pop_size=10, ensemble_size=6)
+    enkf.inflation = inflation
+    enkf.inflation_rate = 1.2
+    rng = np.random.default_rng(1)
+    state_ensemble = rng.normal(100, 10, size=(20, 6))
+    data_ensemble = rng.normal(100, 10, size=(16, 6))
+    H = np.eye(20)[:16]
+    if diagonal:
+        data_covariance = np.diag(rng.uniform(0.5, 2, size=16))
+    else:
+        L = rng.normal(size=(16, 16))
+        data_covariance = L @ L.T + 16 * np.eye(16)
+
+    gain_matrix = enkf.make_gain_matrix(state_ensemble, data_covariance,
+                                        H, H.T)
+    expected = state_ensemble + gain_matrix @ (data_ensemble -
+                                               H @ state_ensemble)
+    if diagonal:
+        data_covariance = np.diagonal(data_covariance)
+    result = enkf.make_analysis(state_ensemble, data_ensemble,
+                                data_covariance, H)
+
+    np.testing.assert_allclose(result, expected)
+
+
+def test_gain_methods():
+    results = dict()
+    for gain_method in ('ensemble', 'covariance'):
+        np.random.seed(666)
+        filter_params, model_params = make_enkf_params(pop_size=8)
+        filter_params['gain_method'] = gain_method
+        model_params['random_seed'] = 1
+        enkf = EnsembleKalmanFilter(Model, filter_params, model_params)
+        for _ in range(30):
+            enkf.step()
+        assert len(enkf.metrics) > 0
+        results[gain_method] = enkf.state_ensemble
+
+    np.testing.assert_allclose(results['ensemble'], results['covariance'])
+
+
+def make_local_analysis_inputs(pop_size=10, ensemble_size=6):
+    enkf = set_up_enkf(pop_size=pop_size, ensemble_size=ensemble_size)
+    rng = np.random.default_rng(1)
+    locations = rng.uniform(0, 700, size=(pop_size, 2))
+    state_ensemble = np.ravel(locations)[:, np.newaxis] + \
+        rng.normal(0, 5, size=(2 * pop_size, ensemble_size))
+    data = np.ravel(locations) + rng.normal(0, 1, size=2 * pop_size)
+    return enkf, state_ensemble, data
+
+
+@pytest.mark.parametrize('inflation', [Inflation.NONE,
+                                       Inflation.MULTIPLICATIVE])
+def test_local_analysis_global_limit(inflation):
+    enkf, state_ensemble, data = make_local_analysis_inputs()
+    enkf.inflation = inflation
+    enkf.inflation_rate = 1.2
+    enkf.localisation_radius = 1e6
+
+    gain_matrix = enkf.make_gain_matrix(state_ensemble, enkf.data_covariance,
+                                        enkf.H, enkf.H_transpose)
+    state_mean = np.mean(state_ensemble, axis=1)
+    expected = state_mean + gain_matrix @ (data - enkf.H @ state_mean)
+    result = enkf.make_local_analysis(state_ensemble, data)
+
+    np.testing.assert_allclose(np.mean(result, axis=1), expected)
+
+
+def test_local_analysis_radius():
+    enkf, state_ensemble, data = make_local_analysis_inputs()
+    enkf.localisation_radius = 50
+    state_mean = np.mean(state_ensemble, axis=1)
+    distances = np.linalg.norm(np.reshape(state_mean, (-1, 2)) -
+                               np.reshape(state_mean, (-1, 2))[0], axis=1)
+    far = np.argmax(distances)
+    assert distances[far] > 100
+
+    result = enkf.make_local_analysis(state_ensemble, data)
+    data[0:2] += 30
+    moved = enkf.make_local_analysis(state_ensemble, data)
+
+    np.testing.assert_equal(moved[2 * far:2 * far + 2],
+                            result[2 * far:2 * far + 2])
+    assert not np.allclose(moved[0:2], result[0:2])
+
+
+@pytest.mark.parametrize('tile', [None, 200])
+def test_local_analysis_workers(tile):
+    enkf, state_ensemble, data = make_local_analysis_inputs()
+    enkf.localisation_radius = 300
+    enkf.localisation_tile = tile
+    serial = enkf.make_local_analysis(state_ensemble, data)
+    enkf.analysis_workers = 4
+    threaded = enkf.make_local_analysis(state_ensemble, data)
+
+    np.testing.assert_equal(threaded, serial)
+
+
+def test_local_analysis_filter():
+    np.random.seed(666)
+    filter_params, model_params = make_enkf_params(pop_size=8)
+    filter_params['localisation_radius'] = 100
+    model_params['random_seed'] = 1
+    enkf = EnsembleKalmanFilter(Model, filter_params, model_params)
+    for _ in range(30):
+        enkf.step()
+    assert len(enkf.metrics) > 0
+    assert np.all(np.isfinite(enkf.state_ensemble))
+
+
+@pytest.mark.parametrize('kind', ['selection', 'dense', 'sparse', 'callable'])
+def test_observation_operators(kind):
+    rng = np.random.default_rng(1)
+    dense = np.hstack((np.identity(6), np.zeros((6, 3))))
+    if kind == 'dense':
+        dense[0, 1] = 0.5
+    if kind == 'selection':
+        H = make_observation_operator(dense)
+        assert isinstance(H, SelectionOperator)
+    elif kind == 'dense':
+        H = make_observation_operator(dense)
+        assert isinstance(H, MatrixOperator)
+    elif kind == 'sparse':
+        H = make_observation_operator(sparse.csr_matrix(dense))
+        assert isinstance(H, MatrixOperator)
+    else:
+        H = CallableOperator(lambda states: dense @ states, dense.shape,
+                             linear=True)
+    C = np.cov(rng.normal(size=(9, 20)))
+    states = rng.normal(size=(9, 4))
+
+    assert H.shape == (6, 9)
+    np.testing.assert_allclose(H @ states, dense @ states)
+    np.testing.assert_allclose(H @ states[:, 0], dense @ states[:, 0])
+    np.testing.assert_allclose(H.project(C), dense @ C @ dense.T)
+    np.testing.assert_allclose(H.cross(C), C @ dense.T)
+    np.testing.assert_allclose(H.to_matrix(), dense)
+
+
+def test_nonlinear_observation_operator():
+    H = make_observation_operator(lambda states: np.sum(states ** 2, axis=0,
+                                                        keepdims=True), 4)
+    assert H.shape == (1, 4)
+    np.testing.assert_allclose(H @ np.ones((4, 3)), [[4, 4, 4]])
+    with pytest.raises(ValueError):
+        H.project(np.eye(4))
+
+
+@pytest.mark.parametrize('filter_type', [EnsembleKalmanFilterType.STATE,
+                                         EnsembleKalmanFilterType.DUAL_EXIT])
+@pytest.mark.parametrize('gain_method', ['ensemble', 'covariance'])
+def test_observation_operator_update(filter_type, gain_method):
+    enkf = set_up_enkf(pop_size=6, ensemble_size=8, filter_type=filter_type)
+    enkf.gain_method = gain_method
+    assert isinstance(enkf.H, SelectionOperator)
+    rng = np.random.default_rng(1)
+    state_ensemble = enkf.state_ensemble + \
+        rng.normal(0, 3, size=enkf.state_ensemble.shape)
+    data_ensemble = rng.normal(100, 10, size=(12, 8))
+
+    enkf.state_ensemble = state_ensemble.copy()
+    enkf.update(data_ensemble)
+    result = enkf.state_ensemble
+    enkf.H = enkf.H.to_matrix()
+    enkf.H_transpose = enkf.H.T
+    enkf.state_ensemble = state_ensemble.copy()
+    enkf.update(data_ensemble)
+
+    np.testing.assert_allclose(result, enkf.state_ensemble)
+
+
+def test_construct_state_from_angles_ensemble():
+    enkf = set_up_enkf(pop_size=10, gate_estimator=GateEstimator.ANGLE)
+    rng = np.random.default_rng(1)
+    angles = rng.uniform(-np.pi, np.pi, size=(10, 5))
+
+    np.random.seed(1)
+    gates, locations = enkf.construct_state_from_angles(angles)
+    np.random.seed(1)
+    for i in range(5):
+        for j in range(10):
+            location, gate = enkf.get_destination_angle(angles[j, i],
+                                                        gate_out=True)
+            assert gates[j, i] == gate
+            np.testing.assert_allclose(locations[[j, 10 + j], i], location)
+
+
+def test_process_state_vector_ensemble():
+    enkf = set_up_enkf(pop_size=3, gate_estimator=GateEstimator.ANGLE,
+                       filter_type=EnsembleKalmanFilterType.DUAL_EXIT)
+    rng = np.random.default_rng(1)
+    states = rng.uniform(0, 700, size=(15, 4))
+
+    result = enkf.process_state_vector(states)
+
+    assert result.shape == (9, 4)
+    for i in range(4):
+        np.testing.assert_equal(result[:6, i], states[:6, i])
+        for j in range(3):
+            destination = (states[9 + j, i], states[12 + j, i])
+            expected = enkf.get_angle(enkf.model_centre, destination)
+            assert result[6 + j, i] == pytest.approx(expected, abs=1e-12)
+
+
+def test_round_target_angles_ties():
+    enkf = set_up_enkf(gate_estimator=GateEstimator.ANGLE)
+    enkf.unique_gate_angle_array = np.array([3.0, 2.0, 1.0])
+
+    np.random.seed(1)
+    result = enkf.round_target_angles(np.full(20, 2.5), np.ones(20, int))
+    np.random.seed(1)
+    expected = [np.random.choice((0, 1)) for _ in range(20)]
+
+    np.testing.assert_equal(result, expected)
+    assert 0 < np.sum(result) < 20
+
+
+def test_update_data_ensemble_draws():
+    enkf = set_up_enkf(pop_size=4, ensemble_size=6)
+    data = np.arange(8.0)
+
+    np.random.seed(1)
+    enkf.update_data_ensemble(data)
+    np.random.seed(1)
+    for i in range(6):
+        expected = data + np.random.normal(0, enkf.R_vector, len(data))
+        np.testing.assert_equal(enkf.data_ensemble[:, i], expected)
+
+
+@pytest.mark.parametrize('gate_estimator', [GateEstimator.ROUNDING,
+                                            GateEstimator.ANGLE])
+def test_dual_exit_filter(gate_estimator):
+    enkf = set_up_enkf(pop_size=6, ensemble_size=5,
+                       filter_type=EnsembleKalmanFilterType.DUAL_EXIT,
+                       gate_estimator=gate_estimator)
+    for _ in range(30):
+        enkf.step()
+    assert np.all(np.isfinite(enkf.state_ensemble))
+    gates = np.array([[agent.gate_out for agent in model.agents]
+                      for model in enkf.get_models()])
+    assert np.all((0 <= gates) & (gates < enkf.base_model.gates_out))
+
+
+def test_batch_forecast():
+    base_model = Model(pop_total=8, station='Grand_Central', do_print=False)
+    models = [base_model.clone() for _ in range(4)]
+    forecast = make_forecast(models, 'batch')
+    for _ in range(50):
+        forecast.step()
+
+    states = forecast.get_states('location')
+    assert len(states) == 4
+    for state, model in zip(states, forecast.get_models()):
+        assert model.step_id == 50
+        np.testing.assert_equal(state, model.get_state(sensor='location'))
+    new_states = [state + 1 for state in states]
+    forecast.set_states(new_states, 'location')
+    for state, model in zip(new_states, forecast.get_models()):
+        np.testing.assert_equal(model.get_state(sensor='location'), state)
+
+    # The members are still views onto the arrays of the batch
+    snapshots = forecast.snapshots()
+    forecast.step()
+    forecast.restore(snapshots)
+    np.testing.assert_equal(forecast.get_states('location'), new_states)
+
+
+def test_enkf_batch_backend():
+    np.random.seed(666)
+    filter_params, model_params = make_enkf_params(pop_size=8)
+    filter_params['forecast_backend'] = 'batch'
+    model_params['random_seed'] = 1
+    enkf = EnsembleKalmanFilter(Model, filter_params, model_params)
+    for _ in range(30):
+        enkf.step()
+    assert len(enkf.metrics) > 0
+    assert np.all(np.isfinite(enkf.state_ensemble))
+    for i, model in enumerate(enkf.get_models()):
+        assert model.step_id == 30
+        np.testing.assert_equal(model.get_state(sensor='location'),
+                                enkf.state_ensemble[:, i])
+
+
+@pytest.mark.parametrize('backend', ['serial', 'process'])
+def test_set_ensemble_statuses(backend):
+    np.random.seed(666)
+    filter_params, model_params = make_enkf_params(pop_size=4,
+                                                   ensemble_size=3)
+    filter_params['forecast_backend'] = backend
+    filter_params['forecast_workers'] = 2
+    with EnsembleKalmanFilter(Model, filter_params, model_params) as enkf:
+        statuses = [[1, 0, 2, 1], [0, 0, 1, 1], [2, 2, 2, 1]]
+        enkf.set_ensemble_statuses(statuses)
+        np.testing.assert_equal(enkf.forecast.agent_statuses(), statuses)
+        with pytest.raises(ValueError):
+            enkf.set_ensemble_statuses([[1, 0]] * 3)
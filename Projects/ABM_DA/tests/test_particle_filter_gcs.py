@@ -0,0 +1,351 @@
+# Imports
+import json
+import numpy as np
+import pytest
+import sys
+sys.path.append('../stationsim/')
+
+from filter import FilterPool
+from likelihood import log_likelihood, normalise_log_weights
+from particle_filter_gcs import (LATENT_FIELDS, ParticleFilter,
+                                 ResidentParticles)
+from resampling import (SCHEMES, effective_sample_size, resample,
+                        systematic)
+from stationsim_gcs_model import Model
+from timing import FIELDS
+
+# Test data
+model_params = {'pop_total': 10, 'station': 'Grand_Central',
+                'do_print': False, 'random_seed': 1,
+                'batch_iterations': 20}
+
+filter_params = {'number_of_particles': 6, 'number_of_runs': 1,
+                 'resample_window': 10, 'multi_step': True,
+                 'particle_std': 0.5, 'model_std': 1.0,
+                 'agents_to_visualise': 2, 'do_save': False,
+                 'p_save': False, 'plot_save': False, 'do_ani': False,
+                 'show_ani': False, 'do_external_data': False,
+                 'pf_method': 'sir'}
+
+
+# Tests
+def test_resident_particles():
+    """
+    Test that particles stepped and resampled in resident workers match
+    the same particles stepped in this process with the same seeds.
+    """
+    base_model = Model(pop_total=10, station='Grand_Central',
+                       do_print=False, random_seed=1)
+    models = [base_model.clone() for _ in range(5)]
+    expected = [model.clone() for model in models]
+    states = np.array([model.get_state(sensor='location')
+                       for model in models])
+    seeds = np.arange(5)
+
+    workers = ResidentParticles(models, states, numcores=2)
+    try:
+        workers.predict(20, 0.5, seeds)
+        for model, seed in zip(expected, seeds):
+            model.set_random_seed(seed)
+            for _ in range(20):
+                model.step()
+            noise = np.random.normal(0, 0.5 ** 2, size=states[0].shape)
+            model.set_state(model.get_state(sensor='location') + noise,
+                            sensor='location')
+        expected_states = np.array([model.get_state(sensor='location')
+                                    for model in expected])
+        np.testing.assert_array_equal(workers.states, expected_states)
+
+        # Resample every particle from the last one
+        workers.indexes[:] = 4
+        workers.states[:] = workers.states[workers.indexes]
+        workers.resample(copy_latent=True)
+        for model in workers.get_models():
+            np.testing.assert_array_equal(model.get_state(sensor='location'),
+                                          expected_states[4])
+            for name in LATENT_FIELDS:
+                np.testing.assert_array_equal(
+                    getattr(model.agent_arrays, name),
+                    getattr(expected[4].agent_arrays, name))
+    finally:
+        workers.close()
+
+
+def test_sir_resample():
+    """
+    Test that resampling with the 'sir' method copies the locations and
+    the hidden agent parameters of the resampled particles.
+    """
+    model_params = {'pop_total': 10, 'station': 'Grand_Central',
+                    'do_print': False, 'random_seed': 1,
+                    'batch_iterations': 10}
+    filter_params = {'number_of_particles': 6, 'number_of_runs': 1,
+                     'resample_window': 10, 'multi_step': True,
+                     'particle_std': 0.5, 'model_std': 1.0,
+                     'agents_to_visualise': 2, 'do_save': False,
+                     'p_save': False, 'plot_save': False, 'do_ani': False,
+                     'show_ani': False, 'do_external_data': False,
+                     'pf_method': 'sir'}
+    pf = ParticleFilter(Model, model_params, filter_params, numcores=1)
+    try:
+        for particle, model in enumerate(pf.models):
+            model.agent_arrays.speed[:] = particle
+            model.agent_arrays.gate_out[:] = particle
+            model.agent_arrays.loc_desire[:] = particle
+        pf.states[:] = np.arange(6)[:, np.newaxis]
+        pf.weights[:] = [0, 0, 0, 1, 0, 0]
+        pf.resample()
+        assert list(pf.indexes) == [3] * 6
+        for model in pf.models:
+            assert np.all(model.get_state(sensor='location') == 3)
+            for name in LATENT_FIELDS:
+                assert np.all(getattr(model.agent_arrays, name) == 3)
+    finally:
+        pf.close()
+
+
+@pytest.mark.parametrize('resident', [False, True])
+def test_localised_resample(resident):
+    """
+    Test that the localised filter weights and resamples every agent
+    separately: when each agent is only observed well in one particle,
+    every resampled particle takes each agent (and its hidden
+    parameters) from that particle.
+    """
+    params = dict(filter_params, localisation='agent', worker_resident=resident)
+    pf = ParticleFilter(Model, model_params, params, numcores=2)
+    try:
+        for _ in range(40):
+            pf.base_model.step()
+        pf.model_std = 0  # Measure the base model without noise
+        observation = pf.base_model.get_state(sensor='location').reshape(-1, 2)
+        active = np.flatnonzero(pf.base_model.agent_arrays.status == 1)
+        assert len(active) > 2
+
+        best = np.arange(10) % 6  # The particle that observes each agent well
+        states = np.tile(observation, (6, 1, 1)) + 50.
+        states[best, np.arange(10)] = observation
+        pf.states[:] = states.reshape(6, -1)
+        for particle in range(6):
+            if resident:
+                pf.workers.latent['speed'][particle] = particle
+            else:
+                pf.models[particle].agent_arrays.speed[:] = particle
+
+        pf.reweight()
+        assert pf.local_weights.shape == (len(active), 6)
+        pf.resample()
+        assert np.allclose(pf.weights, 1 / 6)
+        states = pf.states.reshape(6, -1, 2)
+        assert np.allclose(states[:, active], observation[active])
+        for model in pf.get_models():
+            assert np.allclose(model.get_state(sensor='location').reshape(-1, 2)[active],
+                               observation[active])
+            assert np.all(model.agent_arrays.speed[active] == best[active])
+    finally:
+        pf.close()
+
+
+def test_localisation_blocks():
+    """
+    Test that the 'cluster' localisation groups the observed agents
+    linked by neighbours within the radius.
+    """
+    params = dict(filter_params, localisation='cluster', localisation_radius=5)
+    pf = ParticleFilter(Model, model_params, params, numcores=1)
+    pf.close()
+    locations = np.array([[0, 0], [4, 0], [8, 0], [50, 50], [53, 50],
+                          [100, 0], [0, 100], [0, 0], [0, 0], [0, 0]])
+    active = np.array([True] * 7 + [False] * 3)
+    blocks, number_of_blocks = pf.get_blocks(locations.ravel(), active)
+    assert number_of_blocks == 4
+    assert list(blocks[7:]) == [-1] * 3
+    assert blocks[0] == blocks[1] == blocks[2]
+    assert blocks[3] == blocks[4] != blocks[0]
+    assert len(set(blocks[[0, 3, 5, 6]])) == 4
+
+    pf.localisation = 'agent'
+    blocks, number_of_blocks = pf.get_blocks(locations.ravel(), active)
+    assert number_of_blocks == 7
+    assert list(blocks) == list(range(7)) + [-1] * 3
+
+    with pytest.raises(ValueError):
+        ParticleFilter(Model, model_params,
+                       dict(filter_params, localisation='grid'), numcores=1)
+
+
+def test_resampling_schemes():
+    """
+    Test that every resampling scheme copies each particle roughly in
+    proportion to its weight, and that the vectorised systematic scheme
+    matches the sequential algorithm it replaces.
+    """
+    np.random.seed(1)
+    weights = np.random.uniform(size=1000) ** 3
+    weights /= np.sum(weights)
+    for scheme in SCHEMES:
+        indexes = resample(weights, scheme)
+        assert len(indexes) == len(weights)
+        counts = np.bincount(indexes, minlength=len(weights))
+        assert np.mean(np.abs(counts - 1000 * weights)) < 1
+    with pytest.raises(ValueError):
+        resample(weights, 'unknown')
+
+    np.random.seed(2)
+    indexes = systematic(weights)
+    np.random.seed(2)
+    partition = (np.arange(1000) + np.random.uniform()) / 1000
+    cumsum = np.cumsum(weights)
+    expected = np.zeros(1000, 'i')
+    i, j = 0, 0
+    while i < 1000:
+        if partition[i] < cumsum[j]:
+            expected[i] = j
+            i += 1
+        else:
+            j += 1
+    np.testing.assert_array_equal(indexes, expected)
+
+    assert effective_sample_size(np.ones(10)) == pytest.approx(10)
+    assert effective_sample_size([1, 0, 0]) == pytest.approx(1)
+
+
+def test_log_likelihoods():
+    """
+    Test that the likelihoods only compare the active agents, that they
+    match the densities they implement (up to a constant), and that
+    normalising very small log-weights does not underflow.
+    """
+    np.random.seed(1)
+    states = np.random.normal(size=(6, 8))
+    observation = np.random.normal(size=8)
+    active = np.array([True, False, True, True])
+    residuals = (states - observation).reshape(6, 4, 2)[:, active]
+
+    for name, params in [('gaussian', {'std': 2}),
+                         ('student_t', {'std': 2, 'dof': 3}),
+                         ('mahalanobis', {'variance': [1, 2, 3, 4]})]:
+        log_weights = log_likelihood(name, states, observation, active,
+                                     **params)
+        assert log_weights.shape == (6,)
+        # Moving an inactive agent does not change the weights
+        moved = states.copy()
+        moved[:, 2:4] += 100
+        np.testing.assert_allclose(
+            log_likelihood(name, moved, observation, active, **params),
+            log_weights)
+
+    np.testing.assert_allclose(
+        log_likelihood('gaussian', states, observation, active, std=2),
+        -0.5 * np.sum(residuals ** 2, axis=(1, 2)) / 4)
+    np.testing.assert_allclose(
+        log_likelihood('mahalanobis', states, observation, active,
+                       variance=[1, 2, 3, 4]),
+        -0.5 * np.sum(residuals ** 2 / np.array([1, 3, 4])[:, None],
+                      axis=(1, 2)))
+    distance2 = np.sum(residuals ** 2, axis=2)
+    np.testing.assert_allclose(
+        log_likelihood('student_t', states, observation, active, std=2,
+                       dof=3),
+        np.sum(np.log((1 + distance2 / 12) ** -2.5), axis=1))
+    with pytest.raises(ValueError):
+        log_likelihood('unknown', states, observation)
+
+    weights = normalise_log_weights([-5000, -5001, -6000])
+    np.testing.assert_allclose(weights, [1 / (1 + np.exp(-1)),
+                                         np.exp(-1) / (1 + np.exp(-1)), 0])
+
+
+def test_shared_pool():
+    """
+    Test that several filters can run on the same pool, which stays
+    open until it is closed by its owner.
+    """
+    with FilterPool(numcores=2) as pool:
+        assert pool.startup_time > 0
+        for _ in range(2):
+            pf = ParticleFilter(Model, model_params, filter_params,
+                                pool=pool)
+            pf.step()
+            assert pf.time == 20
+            assert np.all(np.isfinite(pf.states))
+        assert sorted(pool.map(abs, [-1, -2])) == [1, 2]
+
+
+def test_checkpoint_resume(tmp_path):
+    """
+    Test that a filter resumed from a checkpoint finishes the run with
+    the same particles and results as an uninterrupted filter (the
+    resident workers are seeded from the filter's random state, so the
+    runs are reproducible).
+    """
+    path = str(tmp_path / 'pf.ckpt')
+    params = dict(filter_params, worker_resident=True, do_save=True,
+                  resample_window=5)
+    np.random.seed(3)
+    pf = ParticleFilter(Model, model_params, params, numcores=2)
+    result = pf.step()
+
+    # Interrupted after two windows, with a checkpoint every two windows
+    np.random.seed(3)
+    ParticleFilter(Model, dict(model_params, batch_iterations=10),
+                   dict(params, checkpoint_every=2, checkpoint_path=path),
+                   numcores=2).step()
+    resumed = ParticleFilter.resume(path, Model, model_params, params,
+                                    numcores=2)
+    assert resumed.time == 10 and resumed.window_counter == 2
+    assert resumed.step() == result
+    np.testing.assert_array_equal(resumed.states, pf.states)
+    np.testing.assert_array_equal(resumed.estimate_model.history.state,
+                                  pf.estimate_model.history.state)
+
+
+@pytest.mark.parametrize('resident', [False, True])
+def test_phase_timer(tmp_path, resident):
+    """
+    Test that every window records the time of its phases and the
+    bytes sent to and from the workers, and that the records can be
+    exported.
+    """
+    params = dict(filter_params, worker_resident=resident)
+    pf = ParticleFilter(Model, model_params, params, numcores=2)
+    pf.step()
+
+    assert len(pf.resampled) == 2
+    for window in (1, 2):
+        phases = pf.timer.get_window(window)
+        for phase in ('base_model', 'predict', 'estimate', 'reweight',
+                      'resample'):
+            assert phases[phase]['calls'] >= 1
+            assert phases[phase]['seconds'] >= 0
+        assert phases['predict']['bytes_sent'] > 0
+        assert phases['predict']['bytes_received'] > 0
+        assert phases['reweight']['bytes_sent'] == 0
+    totals = pf.timer.totals()
+    assert totals['predict']['calls'] == 2
+    assert totals['reweight']['calls'] == 2
+
+    pf.timer.to_csv(tmp_path / 'timing.csv')
+    with open(tmp_path / 'timing.csv') as f:
+        lines = f.read().splitlines()
+    assert lines[0] == ','.join(FIELDS)
+    assert len(lines) == len(pf.timer.records) + 1
+
+    pf.timer.to_json(tmp_path / 'timing.json')
+    with open(tmp_path / 'timing.json') as f:
+        exported = json.load(f)
+    assert exported['records'] == pf.timer.records
+    assert exported['totals']['predict']['calls'] == 2
+
+
+def test_no_history():
+    """
+    Test that the filter runs, and records its estimate, when the models
+    keep no history.
+    """
+    np.random.seed(3)
+    pf = ParticleFilter(Model, dict(model_params, do_history=False),
+                        filter_params, numcores=1)
+    pf.step()
+    assert not pf.base_model.do_history
+    assert len(pf.estimate_model.history.state) == pf.window_counter == 2
@@ -4,7 +4,10 @@ import numpy as np
 import pytest
 import sys
 sys.path.append('../stationsim')
-from stationsim_gcs_model import Agent
+from trajectory_store import (ObservationFeed, TextFrameReader,
+                              TrajectoryReader, write_trajectories)
+from stationsim_gcs_model import (Agent, HistoryRecorder, Model, ModelBatch,
+                                  SpatialIndex, Station)
 
 
 # Data
@@ -566,3 +569,292 @@ def test_get_state_exit_location(agent_states, state_vector):
 
     result = model.get_state(sensor='exit_location')
     assert result == state_vector
+
+
+def test_collision_table_pruning():
+    """
+    Test the spatially pruned collision table.
+
+    Test that restricting the collision search to the pairs of agents that
+    can meet within the time budget gives the same next collision time and
+    the same wiggle table as testing every pair of active agents.
+    """
+    model = set_up_model(population_size=40)
+    model.do_print = False
+    for _ in range(300):
+        model.step()
+    assert model.pop_active > 2
+
+    for time in (1.0, 0.5, 0.1):
+        full_table, full_tmin = model.get_collisionTable()
+        pruned_table, pruned_tmin = model.get_collisionTable(time)
+        if full_tmin <= time:
+            assert pruned_tmin == full_tmin
+            wiggle_time = 0.98 * full_tmin
+            assert (model.get_wiggleTable(pruned_table, wiggle_time) ==
+                    model.get_wiggleTable(full_table, wiggle_time))
+        else:
+            assert pruned_tmin > time
+
+
+def test_collision_table_vectorised():
+    """
+    Test the batched collision kernel.
+
+    Test that the vectorised collision table gives, within a tolerance, the
+    same next collision time and the same wiggle table as the scalar
+    (per-pair) collision table.
+    """
+    model = set_up_model(population_size=40)
+    model.do_print = False
+    for _ in range(300):
+        model.step()
+    assert model.pop_active > 2
+
+    for time in (None, 1.0):
+        table, tmin = model.get_collisionTable(time, vectorised=False)
+        v_table, v_tmin = model.get_collisionTable(time, vectorised=True)
+        assert v_tmin == pytest.approx(tmin, rel=1e-9)
+
+        scalar_times = sorted(table)
+        vectorised_times = sorted(zip(*v_table))
+        assert len(scalar_times) == len(vectorised_times)
+        for (t0, _), (t1, _) in zip(scalar_times, vectorised_times):
+            assert t1 == pytest.approx(t0, rel=1e-9)
+
+        wiggle_time = 0.98 * tmin
+        assert (model.get_wiggleTable(table, wiggle_time, vectorised=False) ==
+                model.get_wiggleTable(v_table, wiggle_time, vectorised=True))
+
+
+@pytest.mark.parametrize('station', ['Grand_Central', None])
+@pytest.mark.parametrize('random_seed', [0, 1, 2, 42])
+def test_event_scheduler(station, random_seed):
+    """
+    Test the event-driven collision scheduler.
+
+    Test that stepping the model with the collision scheduler produces the
+    same trajectories as rebuilding the collision table after every
+    collision, for a fixed random seed, in Grand Central and in the default
+    station.
+    """
+    trajectories = list()
+    for do_event_scheduler in (False, True):
+        model = Model(pop_total=60, station=station, do_print=False,
+                      random_seed=random_seed,
+                      do_event_scheduler=do_event_scheduler)
+        for _ in range(400):
+            model.step()
+        trajectories.append(np.array(model.history_state))
+
+    # The history is recorded in float32
+    assert np.allclose(trajectories[0], trajectories[1], atol=1e-4,
+                       equal_nan=True)
+
+
+def test_spatial_index():
+    """
+    Test the spatial index shared by activation and wiggles.
+
+    Test that, after rebuilding and moving agents in place, the neighbour
+    queries match a brute-force search over the current locations.
+    """
+    rng = np.random.default_rng(0)
+    locations = rng.uniform(0, 50, size=(100, 2))
+    spatial_index = SpatialIndex(locations, max_moved=8)
+    for unique_id in rng.integers(0, 100, size=20):
+        locations[unique_id] = rng.uniform(0, 50, size=2)
+        spatial_index.move(unique_id, locations[unique_id])
+
+        for point in rng.uniform(0, 50, size=(5, 2)):
+            distances = np.linalg.norm(locations - point, axis=1)
+            expected = list(np.flatnonzero(distances <= 7.5))
+            assert spatial_index.query_ball_point(point, 7.5) == expected
+
+
+def test_model_batch():
+    """
+    Test stepping replicas of the model together.
+
+    Test that a batch of one replica follows the same trajectories as the
+    model stepped on its own, and that the state of a batch is exchanged
+    as a single (E, d) array.
+    """
+    trajectories = list()
+    for batch in (False, True):
+        model = Model(pop_total=30, station='Grand_Central', do_print=False,
+                      random_seed=42)
+        stepper = ModelBatch([model]) if batch else model
+        for _ in range(400):
+            stepper.step()
+        trajectories.append(np.array(model.history_state))
+    # The history is recorded in float32
+    assert np.allclose(trajectories[0], trajectories[1], atol=1e-4)
+
+    batch = ModelBatch.from_model(model, 3)
+    state = batch.get_state(sensor='location')
+    assert state.shape == (3, 2 * model.pop_total)
+    batch.set_state(state + 1, sensor='location')
+    for replica in batch:
+        assert np.allclose(replica.get_state(sensor='location'),
+                           model.get_state(sensor='location') + 1)
+
+
+def test_snapshot_restore_clone():
+    """
+    Test saving and restoring the state of the model, and cloning it.
+
+    Test that restoring a snapshot, or stepping a clone, reproduces the
+    steps taken from the original state, and that a clone is independent
+    of the original model.
+    """
+    model = Model(pop_total=30, station='Grand_Central', do_print=False,
+                  random_seed=42)
+    for _ in range(200):
+        model.step()
+    snapshot = model.snapshot()
+    clone = model.clone()
+
+    np.random.seed(1)
+    for _ in range(100):
+        model.step()
+    state = model.get_state(sensor='location')
+    assert model.step_id == 300
+
+    model.restore(snapshot)
+    assert model.step_id == 200
+    np.random.seed(1)
+    for _ in range(100):
+        model.step()
+    assert np.array_equal(model.get_state(sensor='location'), state)
+
+    assert clone.step_id == 200
+    np.random.seed(1)
+    for _ in range(100):
+        clone.step()
+    assert np.array_equal(clone.get_state(sensor='location'), state)
+    assert clone.gates_locations is model.gates_locations
+    assert clone.agents[0].model is clone
+
+
+def test_history_recorder(tmp_path):
+    """
+    Test the array-backed history recorder.
+
+    Test that the recorded steps and events survive the arrays growing
+    past their initial capacity, both in memory and memory-mapped, and
+    that inactive agents are recorded as NaN.
+    """
+    rng = np.random.default_rng(0)
+    states = rng.uniform(0, 100, size=(10, 4, 2))
+    active = rng.uniform(size=(10, 4)) < .5
+    for filename in (None, str(tmp_path / 'history')):
+        history = HistoryRecorder(4, filename=filename, capacity=3)
+        for state, is_active in zip(states, active):
+            history.record(state, is_active)
+            history.record_wiggle(state[0])
+        assert len(history) == 10
+        assert history.state.dtype == np.float32
+        assert np.allclose(history.state, states)
+        assert np.allclose(history.wiggle_locs, states[:, 0])
+        assert np.isnan(history.locations[~active]).all()
+        assert np.allclose(history.locations[active], states[active])
+
+    model = Model(pop_total=10, station='Grand_Central', do_print=False,
+                  random_seed=42)
+    for _ in range(50):
+        model.step()
+    assert model.history_state.shape == (50, 10, 2)
+    assert model.agents[9].history_locations.shape == (50, 2)
+    assert np.isnan(model.agents[9].history_locations[0]).all()
+
+
+def test_trajectory_store(tmp_path, monkeypatch):
+    """
+    Test writing the model trajectories to a binary store.
+
+    Test that every frame read back from the store has the locations of
+    the agents active after that many steps, including empty frames,
+    and that a directory of text frames is read the same way.
+    """
+    model = Model(pop_total=10, station='Grand_Central', do_print=False,
+                  random_seed=42)
+    for _ in range(50):
+        model.step()
+    monkeypatch.chdir(tmp_path)
+    model.get_data('test', sensor='trajectories')
+
+    reader = TrajectoryReader('trajectories_test/trajectories.traj')
+    assert list(reader.frames) == list(range(1, 51))
+    locations = model.history.locations
+    for frame in (1, 25, 50):
+        agent_id, x, y = reader.get_frame(frame)
+        expected = np.flatnonzero(~np.isnan(locations[frame - 1, :, 0]))
+        assert list(agent_id) == list(expected)
+        assert np.allclose(x, locations[frame - 1, expected, 0])
+        assert np.allclose(y, locations[frame - 1, expected, 1])
+    assert 51 not in reader
+    with pytest.raises(KeyError):
+        reader.get_frame(51)
+
+    (tmp_path / 'frame_1.0.dat').write_text('# pedestrianID x y\n')
+    (tmp_path / 'frame_2.0.dat').write_text('# pedestrianID x y\n3 1.5 2.5\n')
+    text_reader = TextFrameReader(str(tmp_path))
+    assert len(text_reader.get_frame(1)[0]) == 0
+    agent_id, x, y = text_reader.get_frame(2)
+    assert list(agent_id) == [3] and list(x) == [1.5] and list(y) == [2.5]
+    with pytest.raises(KeyError):
+        text_reader.get_frame(3)
+
+
+def test_observation_feed(tmp_path):
+    """
+    Test that the observation feed returns the model indices and the
+    locations of the agents in each frame, dropping unknown agents, and
+    None for frames that are not in the data.
+    """
+    frame = np.repeat(np.arange(1, 41), 2)
+    agent_id = np.tile([7, 99], 40)
+    x = np.arange(80, dtype=float)
+    y = -x
+    write_trajectories(str(tmp_path / 'test.traj'), frame, agent_id, x, y)
+
+    feed = ObservationFeed(TrajectoryReader(str(tmp_path / 'test.traj')),
+                           agent_ids=[3, 7, 5], prefetch=8)
+    try:
+        for f in range(1, 41):
+            index, locations = feed.get(f)
+            assert list(index) == [1]
+            assert np.array_equal(locations, [[2 * f - 2, 2 - 2 * f]])
+        assert feed.get(41) is None
+    finally:
+        feed.close()
+
+
+def test_station_geometry():
+    """
+    Test the station geometry shared by the model and its clones.
+
+    Test that the geometry is read-only and shared by clones, that exits
+    are only drawn from the exit table, and that agents enter the
+    station on the spawn segment of their gate.
+    """
+    model = set_up_model()
+    station = model.geometry
+    assert isinstance(station, Station)
+    assert model.clone().geometry is station
+    with pytest.raises(AttributeError):
+        station.gates_width = None
+    with pytest.raises(ValueError):
+        station.gates_locations[0, 0] = 1.0
+
+    assert np.allclose(station.exit_probabilities.sum(axis=1), 1)
+    for gate_in in range(len(station)):
+        for _ in range(10):
+            gate_out = model.agents[0].set_gate_out(gate_in)
+            assert station.exit_options[gate_in, gate_out]
+            location = model.agents[0].set_agent_location(gate_out)
+            low = station.spawn_low[gate_out]
+            high = station.spawn_high[gate_out]
+            assert np.all(location >= np.minimum(low, high) - 1e-9)
+            assert np.all(location <= np.maximum(low, high) + 1e-9)
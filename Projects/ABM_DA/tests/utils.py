@@ -42,6 +42,21 @@ def set_up_enkf(ensemble_size=5, pop_size=5,
                 exit_randomisation=ExitRandomisation.NONE,
                 n_adjacent=None, gate_estimator=None):
     np.random.seed(666)
+    filter_params, model_params = make_enkf_params(ensemble_size, pop_size,
+                                                   filter_type,
+                                                   error_normalisation,
+                                                   agent_inclusion,
+                                                   exit_randomisation,
+                                                   n_adjacent, gate_estimator)
+    enkf = EnsembleKalmanFilter(Model, filter_params, model_params)
+    return enkf
+
+
+def make_enkf_params(ensemble_size=5, pop_size=5,
+                     filter_type=EnsembleKalmanFilterType.STATE,
+                     error_normalisation=None, agent_inclusion=None,
+                     exit_randomisation=ExitRandomisation.NONE,
+                     n_adjacent=None, gate_estimator=None):
     pop_size = pop_size
     mode = filter_type
     data_mode = EnsembleKalmanFilterType.STATE
@@ -77,5 +92,4 @@ def set_up_enkf(ensemble_size=5, pop_size=5,
                      'run_vanilla': False,
                      'vis': False}
 
-    enkf = EnsembleKalmanFilter(Model, filter_params, model_params)
-    return enkf
+    return filter_params, model_params